@@ -1,9 +1,42 @@
+import array
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import copy
+import csv
+import gzip
+import itertools
 import json
+import lzma
+import math
+import mmap
+import operator
+import os
+import pickle
+import queue
+import random
+import re
 import sys
+import threading
+import time
+import weakref
+import zlib
+from json.decoder import JSONDecodeError, scanstring
+from json.encoder import encode_basestring_ascii
+from json.scanner import NUMBER_RE
 
+_limits = None
 _MAX_INT = sys.maxsize
 _MIN_INT = -sys.maxsize - 1
 
+# default for StringFields that do not set intern themselves
+_string_interning = False
+
+def set_string_interning(enabled):
+    global _string_interning
+    _string_interning = bool(enabled)
+
 def _is_builtin_name(s):
     if not isinstance(s, str):
         return False
@@ -12,28 +45,202 @@ def _is_builtin_name(s):
     return False
 
 
+class BatchValidator:
+    # a check over a list of values returning a list of bools, bulk validation
+    # calls it once with every value of its field in the batch
+    def __init__(self, func):
+        if not callable(func):
+            raise TypeError('"func" must be a callable taking a list of values')
+        self.func = func
+        self.__name__ = getattr(func, '__name__', type(func).__name__)
+
+    def __call__(self, value):
+        return self.func([value])[0]
+
+def _validator_error(name, validator):
+    return str.format('Field "{}" failed validator: {}', name, getattr(validator, '__name__', type(validator).__name__))
+
+# integer sets at least this large are kept as a sorted array unless compact
+# says otherwise
+_COMPACT_MIN = 1 << 16
+
+def _integral(value):
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return None
+
+class ConstraintSet:
+    # an immutable set of allowed or forbidden values that fields, models and
+    # files loaded more than once share, compact sets of ints take 8 bytes a
+    # value and are searched with bisect, ranges only store their bounds
+    __slots__ = ('_index', '_sorted', '_starts', '_stops', '_size', '_items', '__weakref__')
+
+    def __init__(self, values=(), ranges=(), compact=None):
+        values = list(values)
+        if compact is None:
+            compact = len(values) >= _COMPACT_MIN
+        self._index = None
+        self._sorted = None
+        if compact and all(type(v) is int and _MIN_INT <= v <= _MAX_INT for v in values):
+            self._sorted = array.array('q', sorted(set(values)))
+        else:
+            # maps each value to the object it was given as, see StringField._canonical
+            self._index = {v: v for v in values}
+        bounds = []
+        for r in ranges:
+            if not isinstance(r, range) or r.step != 1:
+                raise TypeError(str.format('invalid range: {}, ranges must be range objects with a step of 1', r))
+            if len(r) > 0:
+                bounds.append((r.start, r.stop))
+        bounds.sort()
+        self._starts = []
+        self._stops = []
+        for start, stop in bounds:
+            if self._stops and start <= self._stops[-1]:
+                self._stops[-1] = max(self._stops[-1], stop)
+            else:
+                self._starts.append(start)
+                self._stops.append(stop)
+        stored = len(self._index) if self._index is not None else len(self._sorted)
+        self._size = stored + sum(stop - start for start, stop in zip(self._starts, self._stops))
+        self._items = None
+
+    def __contains__(self, value):
+        if self._index is not None:
+            try:
+                if value in self._index:
+                    return True
+            except TypeError:
+                return False
+            if not self._starts:
+                return False
+        integer = _integral(value)
+        if integer is None:
+            return False
+        if self._sorted is not None:
+            idx = bisect.bisect_left(self._sorted, integer)
+            if idx < len(self._sorted) and self._sorted[idx] == integer:
+                return True
+        idx = bisect.bisect_right(self._starts, integer) - 1
+        return idx >= 0 and integer < self._stops[idx]
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def __iter__(self):
+        stored = self._index if self._index is not None else self._sorted
+        return itertools.chain(stored, *[range(start, stop) for start, stop in zip(self._starts, self._stops)])
+
+    def _canonical(self, value):
+        if self._index is None:
+            return value
+        return self._index.get(value, value)
+
+    def _pick(self, rng):
+        # a uniformly drawn member, used by generate
+        idx = rng.randrange(self._size)
+        if self._items is None:
+            self._items = tuple(self._index) if self._index is not None else self._sorted
+        if idx < len(self._items):
+            return self._items[idx]
+        idx = idx - len(self._items)
+        for start, stop in zip(self._starts, self._stops):
+            if idx < stop - start:
+                return start + idx
+            idx = idx - (stop - start)
+
+_NO_CONSTRAINTS = ConstraintSet()
+
+def _constraint_set(values):
+    if values is None:
+        return _NO_CONSTRAINTS
+    if isinstance(values, ConstraintSet):
+        return values
+    if isinstance(values, range):
+        return ConstraintSet(ranges=[values])
+    return ConstraintSet(values)
+
+_loaded_sets = weakref.WeakValueDictionary()
+
+def load_constraint_set(path, kind=str, compact=None):
+    # one value per line, blank lines and lines starting with # are skipped,
+    # with kind=int a line "low..high" adds the inclusive range, loading the
+    # same unchanged file again returns the same set
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size, kind, compact)
+    loaded = _loaded_sets.get(key)
+    if loaded is not None:
+        return loaded
+    values = []
+    ranges = []
+    with open_compressed(path, 'rb') as f:
+        for line in f:
+            line = line.decode('utf-8').strip()
+            if not line or line.startswith('#'):
+                continue
+            if kind is int and '..' in line:
+                low, high = line.split('..', 1)
+                ranges.append(range(int(low), int(high) + 1))
+            else:
+                values.append(kind(line))
+    loaded = ConstraintSet(values, ranges, compact)
+    _loaded_sets[key] = loaded
+    return loaded
+
 class DataField:
+    # fields holding models or lists are expanded by the iterative engine
+    _nested = False
+    _value_type = object
+
     def __init__(
         self,
         required = False,
         nullable = False,
-        allowed = [],
-        forbidden = []
+        allowed = None,
+        forbidden = None,
+        validators = None
     ):
         self.required = required
         self.nullable = nullable
-        self.allowed = allowed
-        self.forbidden = forbidden
+        # lists and ranges become ConstraintSets, which are shared when given
+        self.allowed = _constraint_set(allowed)
+        self.forbidden = _constraint_set(forbidden)
+        self._constrained = bool(self.allowed) or bool(self.forbidden)
+        # run on values that are not None and passed the built-in checks
+        self.validators = tuple(validators) if validators is not None else ()
+        for validator in self.validators:
+            if not callable(validator):
+                raise TypeError(str.format('invalid validator: {}, validators must be callables', validator))
+        self._plain_validators = tuple(v for v in self.validators if not isinstance(v, BatchValidator))
+        self._batch_validators = tuple(v for v in self.validators if isinstance(v, BatchValidator))
 
     def _check_permitted(self, name, value):
-        if (len(self.allowed) > 0 and not value in self.allowed) or (len(self.forbidden) > 0 and value in self.forbidden):
+        if self._constrained and ((self.allowed._size and not value in self.allowed) or (self.forbidden._size and value in self.forbidden)):
             return False, [str.format('Field "{}" is not a permitted value', name)]
         return True, []
 
     def _check_instance(self, name, value):
         return True, []
 
-    def is_valid(self, name, value):
+    def _interns(self):
+        return False
+
+    def _check_type(self, name, value):
+        # the cheap part of is_valid, used for records that are not sampled
+        if value is None:
+            if self.nullable:
+                return True, []
+            return False, [str.format('Field "{}" is not nullable', name)]
+        if not isinstance(value, self._value_type):
+            return False, [str.format('Field "{}" must be a {}', name, self._value_type.__name__)]
+        return True, []
+
+    def is_valid(self, name, value, validators=None):
         if self.nullable and value == None:
             return True, []
 
@@ -53,14 +260,23 @@ class DataField:
             result = False
             errors.extend(permitted_check_errors)
 
+        if result and self.validators:
+            for validator in self.validators if validators is None else validators:
+                if not validator(value):
+                    result = False
+                    errors.append(_validator_error(name, validator))
+
         return result, errors
 
 class BoolField(DataField):
+    _value_type = bool
+
     def __init__(self,
         required = False,
-        nullable = False
+        nullable = False,
+        validators = None
     ):
-        super().__init__(required, nullable)
+        super().__init__(required, nullable, validators=validators)
 
     def _check_permitted(self, name, value):
         return True, []
@@ -71,32 +287,54 @@ class BoolField(DataField):
         return True, []
 
 class StringField(DataField):
+    _value_type = str
+
     def __init__(
         self,
         required = False,
         nullable = False,
-        allowed = [],
-        forbidden = []
+        allowed = None,
+        forbidden = None,
+        intern = None,
+        validators = None
     ):
-        super().__init__(required, nullable, allowed, forbidden)
+        super().__init__(required, nullable, allowed, forbidden, validators)
+        self.intern = intern
 
     def _check_instance(self, name, value):
         if not isinstance(value, str):
             return False, [str.format('Field "{}" must be a str', name)]
         return True, []
 
+    def _interns(self):
+        if self.intern is None:
+            return _string_interning
+        return self.intern
+
+    def _canonical(self, value):
+        # one shared object per distinct deserialized string
+        if type(value) is not str:
+            return value
+        if self.allowed._size:
+            # the allowed set's own object
+            return self.allowed._canonical(value)
+        return sys.intern(value)
+
 
 class IntegerField(DataField):
+    _value_type = int
+
     def __init__(
         self,
         required = False,
         nullable = False,
-        allowed = [],
-        forbidden = [],
+        allowed = None,
+        forbidden = None,
         _min = _MIN_INT,
-        _max = _MAX_INT
+        _max = _MAX_INT,
+        validators = None
     ):
-        super().__init__(required, nullable, allowed, forbidden)
+        super().__init__(required, nullable, allowed, forbidden, validators)
         self.min = _min
         self.max = _max
 
@@ -110,16 +348,19 @@ class IntegerField(DataField):
         return True, []
 
 class FloatField(DataField):
+    _value_type = float
+
     def __init__(
         self,
         required = False,
         nullable = False,
-        allowed = [],
-        forbidden = [],
+        allowed = None,
+        forbidden = None,
         _min = _MIN_INT,
-        _max = _MAX_INT
+        _max = _MAX_INT,
+        validators = None
     ):
-        super().__init__(required, nullable, allowed, forbidden)
+        super().__init__(required, nullable, allowed, forbidden, validators)
         self.min = _min
         self.max = _max
 
@@ -138,15 +379,19 @@ class FloatField(DataField):
         return result, errors
 
 class ListField(DataField):
+    _nested = True
+    _value_type = list
+
     def __init__(
         self,
         type_mapping,
         required = False,
         nullable = False,
         min_length = 0,
-        max_length = _MAX_INT
+        max_length = _MAX_INT,
+        validators = None
     ):
-        super().__init__(required, nullable)
+        super().__init__(required, nullable, validators=validators)
         if not isinstance(type_mapping, list):
             raise TypeError('"type_mapping" must be a list of data field types')
         if len(type_mapping) == 0:
@@ -161,6 +406,44 @@ class ListField(DataField):
     def _check_permitted(self, name, value):
         return True, []
 
+    def _element_types(self):
+        if len(self.type_mapping) == 1:
+            return itertools.repeat(self.type_mapping[0])
+        return self.type_mapping
+
+    def _holds_nested(self):
+        for t in self.type_mapping:
+            if t._nested:
+                return True
+        return False
+
+    def _length_errors(self, name, length):
+        errors = []
+        if length > self.max_length:
+            errors.append(str.format('List Field "{}" exceeded its maximum length: {}, with length: {}', name, self.max_length, length))
+        if length < self.min_length:
+            errors.append(str.format('List Field "{}" does not satisfy the length requirement: {}, with length: {}', name, self.min_length, length))
+        return errors
+
+    def _check_nested(self, name, value):
+        if not isinstance(value, list):
+            return False, [str.format('Field "{}" must be a list', name)]
+        if len(self.type_mapping) != 1 and len(value) != len(self.type_mapping):
+            return False, [str.format('List Field "{}" length mismatch between schema and value', name)]
+        if self._holds_nested():
+            return _ListCheck(self, name, value)
+
+        # lists of scalars are checked in place, there is nothing to descend into
+        errors = []
+        for t, i in zip(self._element_types(), value):
+            subresult, suberrors = t.is_valid(name, i)
+            if not subresult:
+                errors.append(str.format('invalid type: {}, expected: {} for Field "{}"', type(i).__name__, type(t).__name__, name))
+        errors.extend(self._length_errors(name, len(value)))
+        if not errors and self.validators:
+            errors = [_validator_error(name, validator) for validator in self.validators if not validator(value)]
+        return len(errors) == 0, errors
+
     def _check_instance(self, name, value):
 
         if not isinstance(value, list):
@@ -186,24 +469,46 @@ class ListField(DataField):
                     errors.append(str.format('invalid type: {}, expected: {} for Field "{}"', type(i).__name__, type(self.type_mapping[idx]).__name__, name))
                 idx = idx + 1
 
-        if len(value) > self.max_length:
-            result = False
-            errors.append(str.format('List Field "{}" exceeded its maximum length: {}, with length: {}', name, self.max_length, len(value)))
-        if len(value) < self.min_length:
+        length_errors = self._length_errors(name, len(value))
+        if len(length_errors) > 0:
             result = False
-            errors.append(str.format('List Field "{}" does not satisfy the length requirement: {}, with length: {}', name, self.min_length, len(value)))
+            errors.extend(length_errors)
 
         return result, errors
 
+    def _copy_leaf(self, value):
+        type_obj = self.type_mapping[0]
+        if type_obj._interns():
+            return [type_obj._canonical(v) for v in value]
+        return list(value)
+
+    def _build_nested(self, value, stack):
+        if not isinstance(value, list):
+            return value
+        if len(self.type_mapping) == 1 and not self.type_mapping[0]._nested:
+            return self._copy_leaf(value)
+        child = []
+        stack.append((self, value, child))
+        return child
+
 class ObjectField(DataField):
+    _nested = True
+
     def __init__(
         self,
         cls,
         required = False,
-        nullable = False
+        nullable = False,
+        validators = None
     ):
-        super().__init__(required, nullable)
+        super().__init__(required, nullable, validators=validators)
         self.cls = cls
+        self._value_type = cls
+
+    def _check_nested(self, name, value):
+        if not isinstance(value, self.cls):
+            return False, [str.format('Field "{}" must be of type: {}', name, self.cls.__name__)]
+        return _ModelCheck(value)
 
     def _check_instance(self, name, value):
         if not isinstance(value, self.cls):
@@ -211,38 +516,671 @@ class ObjectField(DataField):
 
         errors = []
         result = True
-        subresult, suberrors = value.validate()
+        subresult, suberrors = value._validate()
         if not subresult:
             result = False
             errors.extend(suberrors)
 
         return result, errors
 
+    def _build_nested(self, value, stack):
+        if not isinstance(value, dict):
+            return value
+        child = self.cls()
+        stack.append((self.cls, value, child))
+        return child
+
+    def _payload_cls(self, value):
+        return self.cls
+
+class UnionField(DataField):
+    # a model of one of several classes, the value of its key field picks the
+    # class through mapping, a payload is built straight into that class
+    _nested = True
+
+    def __init__(
+        self,
+        key,
+        mapping,
+        required = False,
+        nullable = False,
+        validators = None
+    ):
+        super().__init__(required, nullable, validators=validators)
+        if not isinstance(mapping, dict):
+            raise TypeError('"mapping" must be a dict of key values to SchemaModel classes')
+        if len(mapping) == 0:
+            raise ValueError('"mapping" requires at least one SchemaModel class')
+        for cls in mapping.values():
+            if not isinstance(cls, Schema):
+                raise TypeError(str.format('invalid type: {}, provided for "mapping", type must derive from SchemaModel', cls))
+            if not key in getattr(cls, '__plan').known:
+                raise ValueError(str.format('{} must define the key field "{}"', cls.__name__, key))
+        self.key = key
+        self.mapping = dict(mapping)
+        self.classes = tuple(dict.fromkeys(self.mapping.values()))
+        self._value_type = SchemaModel
+
+    def _select(self, tag):
+        try:
+            return self.mapping.get(tag)
+        except TypeError:
+            return None
+
+    def _payload_cls(self, value):
+        return self._select(value.get(self.key))
+
+    def _mismatch(self, name, value):
+        if not isinstance(value, self.classes):
+            return [str.format('Field "{}" must be of type: {}', name, ' | '.join(cls.__name__ for cls in self.classes))]
+        cls = self._select(value.__dict__.get(self.key))
+        if cls is None or not isinstance(value, cls):
+            return [str.format('Field "{}" holds a {} that its key "{}" does not select', name, type(value).__name__, self.key)]
+        return None
+
+    def _check_nested(self, name, value):
+        errors = self._mismatch(name, value)
+        if errors is not None:
+            return False, errors
+        return _ModelCheck(value)
+
+    def _check_instance(self, name, value):
+        errors = self._mismatch(name, value)
+        if errors is not None:
+            return False, errors
+        return value._validate()
+
+    def _build_nested(self, value, stack):
+        if not isinstance(value, dict):
+            return value
+        cls = self._payload_cls(value)
+        if cls is None:
+            return value
+        child = cls()
+        stack.append((cls, value, child))
+        return child
+
+# json keys are strings, an IntegerField key is read back from one of these
+_INT_KEY = re.compile(r'(0|-?[1-9][0-9]*)\Z')
+
+class LazyDict(collections.abc.MutableMapping):
+    # the value of a lazy DictField, each value is built from its payload and
+    # validated the first time it is read
+    __slots__ = ('_field', '_data', '_pending')
+
+    def __init__(self, field, data, pending):
+        self._field = field
+        self._data = data
+        self._pending = pending
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if key in self._pending:
+            value_field = self._field.value_field
+            value = _build_value(value_field, value)
+            result, errors = value_field.is_valid(str(key), value)
+            if not result:
+                raise ValidationError(errors)
+            self._data[key] = value
+            self._pending.discard(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._pending.discard(key)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._pending.discard(key)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return str.format('LazyDict({} values, {} built)', len(self._data), len(self._data) - len(self._pending))
+
+    def _built_items(self):
+        return [(k, v) for k, v in self._data.items() if not k in self._pending]
+
+_MAPPINGS = (dict, LazyDict)
+
+class DictField(DataField):
+    _nested = True
+    _value_type = collections.abc.Mapping
+
+    def __init__(
+        self,
+        key_field,
+        value_field,
+        required = False,
+        nullable = False,
+        min_length = 0,
+        max_length = _MAX_INT,
+        lazy = False,
+        validators = None
+    ):
+        super().__init__(required, nullable, validators=validators)
+        if not isinstance(key_field, (StringField, IntegerField)):
+            raise TypeError('"key_field" must be a StringField or an IntegerField')
+        if not isinstance(value_field, DataField):
+            raise TypeError(str.format('invalid type: {}, provided for "value_field", type must derive from DataField', type(value_field)))
+        self.key_field = key_field
+        self.value_field = value_field
+        self.min_length = min_length
+        self.max_length = max_length
+        # scalar values cost nothing to build, only nested ones are deferred
+        self.lazy = lazy and value_field._nested
+        self._int_keys = isinstance(key_field, IntegerField)
+
+    def _check_permitted(self, name, value):
+        return True, []
+
+    def _key(self, k):
+        if self._int_keys and type(k) is str and _INT_KEY.match(k):
+            return int(k)
+        return k
+
+    def _items(self, value):
+        # the values not yet built by a LazyDict are checked when they are read
+        if type(value) is LazyDict:
+            return value._built_items()
+        return value.items()
+
+    def _key_errors(self, name, value):
+        errors = []
+        for k in value:
+            if not self.key_field.is_valid(name, k)[0]:
+                errors.append(str.format('invalid key: {!r}, expected: {} for Field "{}"', k, type(self.key_field).__name__, name))
+        return errors
+
+    def _length_errors(self, name, length):
+        errors = []
+        if length > self.max_length:
+            errors.append(str.format('Dict Field "{}" exceeded its maximum length: {}, with length: {}', name, self.max_length, length))
+        if length < self.min_length:
+            errors.append(str.format('Dict Field "{}" does not satisfy the length requirement: {}, with length: {}', name, self.min_length, length))
+        return errors
+
+    def _check_nested(self, name, value):
+        if not isinstance(value, _MAPPINGS):
+            return False, [str.format('Field "{}" must be a dict', name)]
+        if self.value_field._nested:
+            return _DictCheck(self, name, value)
+        return self.is_valid(name, value)
+
+    def _check_instance(self, name, value):
+        if not isinstance(value, _MAPPINGS):
+            return False, [str.format('Field "{}" must be a dict', name)]
+        errors = self._key_errors(name, value)
+        for k, v in self._items(value):
+            result, value_errors = self.value_field.is_valid(name, v)
+            if not result:
+                errors.extend(value_errors)
+        errors.extend(self._length_errors(name, len(value)))
+        return len(errors) == 0, errors
+
+    def _build(self, value, shared=None):
+        key = self._key
+        value_field = self.value_field
+        if self.lazy:
+            data = {key(k): v for k, v in value.items()}
+            return LazyDict(self, data, set(data))
+        if value_field._nested:
+            return {key(k): _build_value(value_field, v, shared) for k, v in value.items()}
+        if value_field._interns():
+            return {key(k): value_field._canonical(v) for k, v in value.items()}
+        if self._int_keys:
+            return {key(k): v for k, v in value.items()}
+        return dict(value)
+
+    def _build_nested(self, value, stack):
+        if not isinstance(value, dict):
+            return value
+        if self.lazy or not self.value_field._nested:
+            return self._build(value)
+        child = {}
+        stack.append((self, value, child))
+        return child
+
+class _Check:
+    # a pending validation of one model or list, expanded before its children
+    # and resolved after them
+    __slots__ = ('value', 'parts', 'depth', 'mark', 'trusted', 'result', 'errors')
+
+    def _descend(self, child, checks):
+        if self.trusted is not None and id(child.value) in self.trusted:
+            child.result = True
+            child.errors = []
+            return
+
+        # a value reappearing below itself is a cycle, comparing against the
+        # ancestor at the last power of two depth finds it in linear time
+        if child.value is self.mark:
+            raise ValueError('Circular reference detected')
+        depth = self.depth + 1
+        child.depth = depth
+        child.mark = child.value if depth & (depth - 1) == 0 else self.mark
+        child.trusted = self.trusted
+        checks.append(child)
+
+def _resolved(check, name, field):
+    # a nested value is checked without its field's validators, they run once
+    # everything below it passed, as is_valid runs them
+    if not check.result or not field.validators:
+        return check.result, check.errors
+    errors = [_validator_error(name, validator) for validator in field.validators if not validator(check.value)]
+    return len(errors) == 0, errors
+
+class _ModelCheck(_Check):
+    __slots__ = ()
+
+    def __init__(self, value):
+        self.value = value
+
+    def expand(self, checks):
+        obj = self.value
+        parts = []
+        plan = getattr(obj, '__plan')
+        instance_attrs = obj.__dict__
+        for k, v in plan.items:
+            if k in instance_attrs:
+                value = instance_attrs[k]
+                if v._nested and value is not None:
+                    part = v._check_nested(k, value)
+                    if type(part) is not tuple:
+                        self._descend(part, checks)
+                        parts.append((part, k, v))
+                        continue
+                else:
+                    part = v.is_valid(k, value)
+                if not part[0]:
+                    parts.append(part)
+            else:
+                if v.required:
+                    parts.append((False, [str.format('required field is missing: {}', k)]))
+        if not plan.allow_unknowns and not plan.known.issuperset(instance_attrs):
+            for attr_name in instance_attrs:
+                if not attr_name in plan.known:
+                    parts.append((False, [str.format('unknown fields not permitted, attribute must be defined in schema: {}', attr_name)]))
+        self.parts = parts
+
+    def resolve(self):
+        result = True
+        errors = []
+        for part in self.parts:
+            if len(part) == 2:
+                subresult, suberrors = part
+            else:
+                subresult, suberrors = _resolved(*part)
+            if not subresult:
+                result = False
+                errors.extend(suberrors)
+        self.result = result
+        self.errors = errors
+
+class _ListCheck(_Check):
+    # elements only contribute pass or fail to the list's own errors
+    __slots__ = ('field', 'name')
+
+    def __init__(self, field, name, value):
+        self.field = field
+        self.name = name
+        self.value = value
+
+    def expand(self, checks):
+        name = self.name
+        parts = []
+        for t, i in zip(self.field._element_types(), self.value):
+            if t._nested and i is not None:
+                part = t._check_nested(name, i)
+                if type(part) is not tuple:
+                    self._descend(part, checks)
+                    parts.append((part, i, t))
+                    continue
+                subresult = part[0]
+            else:
+                subresult = t.is_valid(name, i)[0]
+            if not subresult:
+                parts.append(str.format('invalid type: {}, expected: {} for Field "{}"', type(i).__name__, type(t).__name__, name))
+        self.parts = parts
+
+    def resolve(self):
+        name = self.name
+        errors = []
+        for part in self.parts:
+            if type(part) is str:
+                errors.append(part)
+            elif not _resolved(part[0], name, part[2])[0]:
+                errors.append(str.format('invalid type: {}, expected: {} for Field "{}"', type(part[1]).__name__, type(part[2]).__name__, name))
+        errors.extend(self.field._length_errors(name, len(self.value)))
+        self.result = len(errors) == 0
+        self.errors = errors
+
+class _DictCheck(_Check):
+    # keys are checked in place, values contribute their own errors
+    __slots__ = ('field', 'name')
+
+    def __init__(self, field, name, value):
+        self.field = field
+        self.name = name
+        self.value = value
+
+    def expand(self, checks):
+        name = self.name
+        field = self.field
+        parts = [(False, field._key_errors(name, self.value))]
+        for k, v in field._items(self.value):
+            if v is not None:
+                part = field.value_field._check_nested(name, v)
+                if type(part) is not tuple:
+                    self._descend(part, checks)
+                    part = (part, name, field.value_field)
+            else:
+                part = field.value_field.is_valid(name, v)
+            parts.append(part)
+        self.parts = parts
+
+    def resolve(self):
+        errors = []
+        for part in self.parts:
+            if len(part) == 2:
+                errors.extend(part[1])
+            else:
+                errors.extend(_resolved(*part)[1])
+        errors.extend(self.field._length_errors(self.name, len(self.value)))
+        self.result = len(errors) == 0
+        self.errors = errors
+
+def _run_checks(root, trusted=None):
+    # every check is created after its parent, so expanding them in order and
+    # resolving them in reverse never needs the call stack, models whose id is
+    # in trusted are taken as valid
+    root.depth = 1
+    root.mark = root.value
+    root.trusted = trusted
+    checks = [root]
+    idx = 0
+    while idx < len(checks):
+        checks[idx].expand(checks)
+        idx = idx + 1
+    for check in reversed(checks):
+        check.resolve()
+    return root.result, root.errors
+
 class ValidationError(Exception):
     def __init__(self, validation_errors):
         self.errors = validation_errors
 
 
+class SchemaPlan:
+    # the flattened schema of a model class, inherited fields included, built
+    # once when the class is created
+    def __init__(self, cls, declared, allow_unknowns, frozen=False):
+        fields = {}
+        for base in reversed(cls.__mro__[1:]):
+            base_plan = base.__dict__.get('__plan')
+            if base_plan is not None:
+                fields.update(base_plan.declared)
+        fields.update(declared)
+
+        self.cls = cls
+        self.declared = declared
+        self.fields = fields
+        self.allow_unknowns = allow_unknowns
+        self.frozen = frozen
+        self.items = tuple(fields.items())
+        self.names = tuple(fields)
+        self.field_values = operator.itemgetter(*self.names) if len(self.names) > 1 else None
+        # pickles carry it so a changed schema is caught when they are loaded
+        self.fingerprint = zlib.crc32(','.join(k + ':' + type(v).__name__ for k, v in self.items).encode('utf-8'))
+        self.required = frozenset(k for k, v in self.items if v.required)
+        self.known = frozenset(fields)
+        self.nested = tuple((k, v) for k, v in self.items if v._nested)
+        self.nested_names = tuple(k for k, v in self.nested)
+        self.strings = tuple((k, v) for k, v in self.items if isinstance(v, StringField))
+        self.interns = any(v.intern for k, v in self.strings)
+        # fields with batch validators are checked a column at a time by validate_many
+        self.batch = tuple((k, v) for k, v in self.items if v._batch_validators)
+        self.unbatched = tuple((k, v) for k, v in self.items if not v._batch_validators)
+
+    def __reduce__(self):
+        # a plan is pickled once per stream as its class and fingerprint
+        return (_load_plan, (self.cls, _PICKLE_VERSION, self.fingerprint))
+
+    def __call__(self):
+        # an empty instance with its frozen state, pickled and generated
+        # models are created by calling their plan
+        obj = self.cls.__new__(self.cls)
+        if self.frozen:
+            object.__setattr__(obj, '_frozen_state', _FrozenState())
+        return obj
+
+    def container_keys(self, attrs):
+        # attributes of an instance that may hold models or lists, absent
+        # fields included
+        if self.known.issuperset(attrs):
+            return self.nested_names
+        return self.nested_names + tuple(k for k in attrs if not k in self.known)
+
+_PICKLE_VERSION = 1
+
+def _load_plan(cls, version, fingerprint):
+    plan = getattr(cls, '__plan')
+    if version != _PICKLE_VERSION or fingerprint != plan.fingerprint:
+        raise TypeError(str.format('pickled {} was written with a different schema', cls.__name__))
+    return plan
+
+def schema_plan(model):
+    if not isinstance(model, Schema):
+        model = type(model)
+    if not isinstance(model, Schema):
+        raise TypeError("Model must be a SchemaModel class or instance")
+    return getattr(model, '__plan')
+
+class _FrozenState:
+    # what a frozen model memoizes, filled on first use, sealed tells whether
+    # everything it holds was made immutable, see _seal
+    __slots__ = ('validation', 'fingerprint', 'json', 'json_bytes', 'sealed')
+
+    def __init__(self):
+        self.validation = None
+        self.fingerprint = None
+        self.json = None
+        self.json_bytes = None
+        self.sealed = None
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError(str.format('{} can not be modified', type(self).__name__))
+
+class FrozenList(list):
+    # the lists held by frozen models
+    __slots__ = ()
+    append = extend = insert = remove = pop = clear = sort = reverse = _read_only
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+class FrozenDict(dict):
+    # the dicts held by frozen models
+    __slots__ = ()
+    update = pop = popitem = clear = setdefault = _read_only
+    __setitem__ = __delitem__ = __ior__ = _read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+def _sealed_child(v, stack):
+    # the read only counterpart of v, filled later from the stack, or None
+    # when v can not be made immutable
+    if type(v) in _CLONED_SCALARS:
+        return v
+    if isinstance(v, list):
+        out = FrozenList()
+    elif type(v) is dict or type(v) is FrozenDict:
+        out = FrozenDict()
+    elif isinstance(v, SchemaModel) and v._frozen_state is not None:
+        stack.append((v, None))
+        return v
+    else:
+        return None
+    stack.append((v, out))
+    return out
+
+def _seal(root):
+    # swaps the lists and dicts below a frozen model for read only copies
+    # once, its memoized results are only kept when nothing below it, such as
+    # a mutable model in an unknown attribute, can still change
+    sealed = True
+    models = []
+    stack = [(root, None)]
+    while stack:
+        src, out = stack.pop()
+        if out is None:
+            state = src._frozen_state
+            if state.sealed is not None:
+                sealed = sealed and state.sealed
+                continue
+            # marks it before its children so cycles end here
+            state.sealed = True
+            models.append(state)
+            d = src.__dict__
+            for k in getattr(src, '__plan').container_keys(d):
+                if k in d:
+                    child = _sealed_child(d[k], stack)
+                    if child is None:
+                        sealed = False
+                    else:
+                        d[k] = child
+        elif type(out) is FrozenList:
+            items = [_sealed_child(v, stack) for v in src]
+            if None in items:
+                sealed = False
+                items = [v if c is None else c for v, c in zip(src, items)]
+            list.extend(out, items)
+        else:
+            for k, v in src.items():
+                child = _sealed_child(v, stack)
+                if child is None:
+                    sealed = False
+                    child = v
+                dict.__setitem__(out, k, child)
+    for state in models:
+        state.sealed = sealed
+    return sealed
+
+def _frozen_setattr(self, name, value):
+    raise AttributeError(str.format('cannot assign to "{}", {} is frozen', name, type(self).__name__))
+
+def _frozen_delattr(self, name):
+    raise AttributeError(str.format('cannot delete "{}", {} is frozen', name, type(self).__name__))
+
+def _frozen_validate(self, batch=True):
+    if not batch or not _seal(self):
+        return SchemaModel._validate(self, batch)
+    state = self._frozen_state
+    if state.validation is None:
+        state.validation = SchemaModel._validate(self)
+    result, errors = state.validation
+    return result, list(errors)
+
+def _frozen_fingerprint(self):
+    if not _seal(self):
+        return _json_dumps(self.to_json_obj(), sort_keys=True)
+    state = self._frozen_state
+    if state.fingerprint is None:
+        state.fingerprint = _json_dumps(self.to_json_obj(), sort_keys=True)
+    return state.fingerprint
+
+def _frozen_hash(self):
+    return hash((type(self), _frozen_fingerprint(self)))
+
+def _frozen_eq(self, other):
+    if type(other) is not type(self):
+        return NotImplemented
+    return self is other or _frozen_fingerprint(self) == _frozen_fingerprint(other)
+
+# added to classes declared with frozen=True, their subclasses inherit them
+_FROZEN_METHODS = (
+    ('__setattr__', _frozen_setattr),
+    ('__delattr__', _frozen_delattr),
+    ('__hash__', _frozen_hash),
+    ('__eq__', _frozen_eq),
+    ('_validate', _frozen_validate)
+)
+
+def _check_frozen_field(cls_name, name, field):
+    # a frozen model can only hold what _seal can make immutable
+    fields = [field]
+    while fields:
+        field = fields.pop()
+        if isinstance(field, ListField):
+            fields.extend(field.type_mapping)
+        elif isinstance(field, DictField):
+            if field.lazy:
+                raise TypeError(str.format('{} is frozen, its field "{}" can not be a lazy DictField', cls_name, name))
+            fields.append(field.value_field)
+        elif isinstance(field, (ObjectField, UnionField)):
+            for cls in field.classes if isinstance(field, UnionField) else (field.cls,):
+                if isinstance(cls, Schema) and not getattr(cls, '__plan').frozen:
+                    raise TypeError(str.format('{} is frozen, its field "{}" must hold frozen models, {} is not', cls_name, name, cls.__name__))
+
 class Schema(type):
     def __new__(metaclass, metaclass_name, bases, namespace, **options):
         new_namespace = {}
-        new_namespace['__schema'] = {}
-        new_namespace['__allow_unknowns'] = options.get('allow_unknowns', False)
+        declared = {}
         for k, v in namespace.items():
             if not _is_builtin_name(k):
                 if isinstance(v, DataField):
-                    new_namespace['__schema'][k] = v
+                    declared[k] = v
                 else:
                     new_namespace[k] = v
             else:
                 new_namespace[k] = v
-        return super().__new__(metaclass, metaclass_name, bases, new_namespace)
+
+        inherits_frozen = any(isinstance(base, Schema) and getattr(base, '__plan').frozen for base in bases)
+        frozen = options.get('frozen', inherits_frozen)
+        if inherits_frozen and not frozen:
+            raise TypeError(str.format('{} cannot be mutable, it inherits from a frozen model', metaclass_name))
+        if frozen and not inherits_frozen:
+            new_namespace['__slots__'] = ('_frozen_state',)
+            for k, v in _FROZEN_METHODS:
+                new_namespace.setdefault(k, v)
+        cls = super().__new__(metaclass, metaclass_name, bases, new_namespace)
+
+        if 'allow_unknowns' in options:
+            allow_unknowns = options['allow_unknowns']
+        else:
+            allow_unknowns = getattr(cls, '__allow_unknowns', False)
+        plan = SchemaPlan(cls, declared, allow_unknowns, frozen)
+        if frozen:
+            for k, v in plan.nested:
+                _check_frozen_field(metaclass_name, k, v)
+        setattr(cls, '__plan', plan)
+        setattr(cls, '__schema', plan.fields)
+        setattr(cls, '__allow_unknowns', allow_unknowns)
+        return cls
 
     def __init__(cls, cls_name, bases, namespace, **options):
         super().__init__(cls_name, bases, namespace)
 
 class SchemaModel(metaclass=Schema, allow_unknowns=False):
+    _frozen_state = None
+
     def __init__(self, **kwargs):
+        if getattr(self, '__plan').frozen:
+            # attributes of a frozen model are only written while it is built
+            object.__setattr__(self, '_frozen_state', _FrozenState())
+            if kwargs:
+                self.__dict__.update(kwargs)
+                _seal(self)
+            return
         for k, v in kwargs.items():
             setattr(self, k, v)
 
@@ -250,32 +1188,53 @@ class SchemaModel(metaclass=Schema, allow_unknowns=False):
         list_of_models = []
         for i in v:
             if isinstance(i, SchemaModel):
-                list_of_models.append(i.to_json_obj())
+                list_of_models.append(i._to_json_obj())
             elif isinstance(i, list):
                 list_of_models.append(self._list_to_json_obj(i))
+            elif isinstance(i, _MAPPINGS):
+                list_of_models.append(self._dict_to_json_obj(i))
             else:
                 list_of_models.append(i)
         return list_of_models
 
-    def to_json_obj(self):
-        d = {}
-        for k, v in self.__dict__.items():
-            if isinstance(v, SchemaModel):
-                d[k] = v.to_json_obj()
-            elif isinstance(v, list):
+    def _dict_to_json_obj(self, v):
+        # values a LazyDict has not built are still their payload
+        d = dict(v._data) if type(v) is LazyDict else dict(v)
+        for k, i in d.items():
+            if isinstance(i, SchemaModel):
+                d[k] = i._to_json_obj()
+            elif isinstance(i, list):
+                d[k] = self._list_to_json_obj(i)
+            elif isinstance(i, _MAPPINGS):
+                d[k] = self._dict_to_json_obj(i)
+        return d
+
+    def _to_json_obj(self):
+        d = dict(self.__dict__)
+        for k in getattr(self, '__plan').container_keys(d):
+            v = d.get(k)
+            if isinstance(v, list):
                 d[k] = self._list_to_json_obj(v)
-            else:
-                d[k] = v
+            elif isinstance(v, SchemaModel):
+                d[k] = v._to_json_obj()
+            elif isinstance(v, _MAPPINGS):
+                d[k] = self._dict_to_json_obj(v)
         return d
 
-    def validate(self):
+    def to_json_obj(self):
+        try:
+            return self._to_json_obj()
+        except RecursionError:
+            return _encode_iterative(self, {})
+
+    def _validate(self, batch=True):
         result = True
         errors = []
-        schema = getattr(self, '__schema')
-        instance_attr_names = self.__dict__.keys()
-        for k, v in schema.items():
-            if k in instance_attr_names:
-                subresult, suberrors = v.is_valid(k, self.__dict__[k])
+        plan = getattr(self, '__plan')
+        instance_attrs = self.__dict__
+        for k, v in plan.items if batch else plan.unbatched:
+            if k in instance_attrs:
+                subresult, suberrors = v.is_valid(k, instance_attrs[k])
                 if not subresult:
                     result = False
                     errors.extend(suberrors)
@@ -283,103 +1242,2805 @@ class SchemaModel(metaclass=Schema, allow_unknowns=False):
                 if v.required:
                     result = False
                     errors.append(str.format('required field is missing: {}', k))
-        allow_unknowns = getattr(self, '__allow_unknowns')
-        if not allow_unknowns:
-            schema_keys = schema.keys()
-            for attr_name in instance_attr_names:
-                if not attr_name in schema_keys:
+        if not plan.allow_unknowns and not plan.known.issuperset(instance_attrs):
+            for attr_name in instance_attrs:
+                if not attr_name in plan.known:
                     result = False
-                    errors.append(str.format('unknown fields not permitted, attribute must be defined in schema: {}', k))
+                    errors.append(str.format('unknown fields not permitted, attribute must be defined in schema: {}', attr_name))
 
         return result, errors
 
+    def validate(self):
+        try:
+            return self._validate()
+        except RecursionError:
+            return _run_checks(_ModelCheck(self))
+
+    def __reduce__(self):
+        # the field values in schema order instead of a dict keyed by name,
+        # the instance is created first and filled by __setstate__ so cycles
+        # still pickle
+        plan = getattr(self, '__plan')
+        d = self.__dict__
+        if plan.field_values is not None and len(d) == len(plan.names) and plan.known.issuperset(d):
+            return (plan, (), plan.field_values(d))
+        # absent fields are marked and an extras slot is always present
+        extras = None
+        if not plan.known.issuperset(d):
+            extras = {k: v for k, v in d.items() if not k in plan.known}
+        return (plan, (), tuple([d.get(k, _ABSENT) for k in plan.names] + [extras]))
+
+    def __setstate__(self, state):
+        plan = getattr(self, '__plan')
+        d = self.__dict__
+        if isinstance(state, dict):
+            # pickles written before the state became a tuple hold the __dict__
+            d.update(state)
+            if plan.frozen and getattr(self, '_frozen_state', None) is None:
+                object.__setattr__(self, '_frozen_state', _FrozenState())
+        elif len(state) == len(plan.names):
+            d.update(zip(plan.names, state))
+        else:
+            d.update([(k, v) for k, v in zip(plan.names, state) if v is not _ABSENT])
+            if state[-1]:
+                d.update(state[-1])
+        if plan.interns or _string_interning:
+            _intern_strings(plan, d)
+
+    def clone(self):
+        # a deep copy, see _clone
+        return _clone(self)
+
+class _Absent:
+    # marks a field that is not set in a pickled model, pickled by reference
+    __slots__ = ()
+
+    def __reduce__(self):
+        return '_ABSENT'
+
+    def __repr__(self):
+        return '_ABSENT'
+
+_ABSENT = _Absent()
+
+_ENCODED_CONTAINERS = (SchemaModel, list, dict, LazyDict)
+
+_CLONED_SCALARS = frozenset((str, int, float, bool, type(None)))
+
+def _clone_value(v, memo, stack):
+    # scalars and frozen models are shared, models and lists get an empty copy
+    # filled later from the stack, anything else is left to deepcopy
+    if type(v) in _CLONED_SCALARS:
+        return v
+    c = memo.get(id(v))
+    if c is not None:
+        return c
+    if type(v) is list:
+        if _CLONED_SCALARS.issuperset(map(type, v)):
+            c = v[:]
+        else:
+            c = []
+            stack.append((v, c))
+    elif isinstance(v, SchemaModel):
+        plan = getattr(v, '__plan')
+        if plan.frozen:
+            return v
+        c = plan()
+        stack.append((v, c))
+    elif type(v) is dict:
+        c = {}
+        stack.append((v, c))
+    elif type(v) is LazyDict:
+        # payloads not built yet are plain json, deepcopy keeps them pending
+        c = LazyDict(v._field, {}, set(v._pending))
+        stack.append((v, c))
+    else:
+        return copy.deepcopy(v, memo)
+    memo[id(v)] = c
+    return c
+
+def _clone(root):
+    # copies are memoized by the id of their source so cycles and sub-objects
+    # shared within the tree are kept, only the attributes that may hold
+    # containers are looked at
+    memo = {}
+    stack = []
+    root_copy = _clone_value(root, memo, stack)
+    while stack:
+        src, out = stack.pop()
+        if type(out) is list:
+            out.extend([v if type(v) in _CLONED_SCALARS else _clone_value(v, memo, stack) for v in src])
+        elif type(out) is dict:
+            out.update([(k, v if type(v) in _CLONED_SCALARS else _clone_value(v, memo, stack)) for k, v in src.items()])
+        elif type(out) is LazyDict:
+            pending = src._pending
+            out._data.update([(k, copy.deepcopy(v, memo) if k in pending else _clone_value(v, memo, stack)) for k, v in src._data.items()])
+        else:
+            d = out.__dict__
+            d.update(src.__dict__)
+            for k in getattr(src, '__plan').container_keys(d):
+                if k in d and not type(d[k]) in _CLONED_SCALARS:
+                    d[k] = _clone_value(d[k], memo, stack)
+    return root_copy
+
+class Footprint:
+    # bytes of a model graph, every object counted once under the first model
+    # class or (class, attribute) found holding it
+    __slots__ = ('total', 'by_class', 'by_field', 'counts')
+
+    def __init__(self):
+        self.total = 0
+        self.by_class = {}
+        self.by_field = {}
+        self.counts = {}
+
+_FOOTPRINT_CONTAINERS = (list, tuple, set, frozenset)
+
+def _footprint(roots):
+    # by_class holds the instances themselves, their __dict__ and the frozen
+    # state, by_field what their attributes hold apart from models, None and
+    # the booleans are never counted
+    footprint = Footprint()
+    seen = set()
+    stack = [(root, None) for root in reversed(roots)]
+    while stack:
+        v, key = stack.pop()
+        if v is None or v is True or v is False or id(v) in seen:
+            continue
+        seen.add(id(v))
+        if isinstance(v, SchemaModel):
+            cls = type(v)
+            size = sys.getsizeof(v) + sys.getsizeof(v.__dict__)
+            state = v._frozen_state
+            if state is not None:
+                size = size + sys.getsizeof(state)
+                for memo in (state.json, state.json_bytes, state.fingerprint):
+                    if memo is not None and not id(memo) in seen:
+                        seen.add(id(memo))
+                        size = size + sys.getsizeof(memo)
+            footprint.by_class[cls] = footprint.by_class.get(cls, 0) + size
+            footprint.counts[cls] = footprint.counts.get(cls, 0) + 1
+            stack.extend([(x, (cls, k)) for k, x in list(v.__dict__.items())[::-1]])
+            continue
+        footprint.by_field[key] = footprint.by_field.get(key, 0) + sys.getsizeof(v)
+        if isinstance(v, _FOOTPRINT_CONTAINERS):
+            stack.extend([(x, key) for x in list(v)[::-1]])
+        elif isinstance(v, dict):
+            # dict views are only reversible from Python 3.8
+            for k, x in list(v.items())[::-1]:
+                stack.append((x, key))
+                stack.append((k, key))
+        elif type(v) is LazyDict:
+            stack.append((v._pending, key))
+            stack.append((v._data, key))
+    footprint.total = sum(footprint.by_class.values()) + sum(footprint.by_field.values())
+    return footprint
+
+def footprint(obj):
+    if not isinstance(obj, SchemaModel):
+        raise TypeError("Object must be an instance of a SchemaModel")
+    return _footprint([obj])
+
+def footprint_many(cls, instances):
+    # objects shared between the instances are counted once for all of them
+    if not issubclass(cls, SchemaModel):
+        raise TypeError("Class must be a subclass of SchemaModel")
+    instances = list(instances)
+    for obj in instances:
+        if not isinstance(obj, cls):
+            raise TypeError(str.format('Model must be an instance of {}', cls.__name__))
+    return _footprint(instances)
+
+def _encode_iterative(root, root_out):
+    # pre-order over an explicit stack: every container is copied first and
+    # only its nested models and lists are swapped for output placeholders
+    stack = [(root, root_out, 1, root)]
+    while stack:
+        src, out, depth, mark = stack.pop()
+        if type(out) is list:
+            out.extend(src)
+            keys = range(len(out))
+        elif isinstance(src, SchemaModel):
+            out.update(src.__dict__)
+            keys = getattr(src, '__plan').container_keys(out)
+        else:
+            out.update(src._data if type(src) is LazyDict else src)
+            keys = list(out)
+        depth = depth + 1
+        for k in keys:
+            v = out.get(k) if type(out) is dict else out[k]
+            if isinstance(v, _ENCODED_CONTAINERS):
+                # see _Check._descend
+                if v is mark:
+                    raise ValueError('Circular reference detected')
+                child = [] if isinstance(v, list) else {}
+                stack.append((v, child, depth, v if depth & (depth - 1) == 0 else mark))
+                out[k] = child
+    return root_out
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_LITERALS = (
+    ('null', None),
+    ('true', True),
+    ('false', False),
+    ('NaN', float('nan')),
+    ('Infinity', float('inf')),
+    ('-Infinity', float('-inf'))
+)
+
+def _skip_whitespace(s, idx):
+    return _JSON_WHITESPACE.match(s, idx).end()
+
+def _decode_key(s, idx):
+    if s[idx:idx + 1] != '"':
+        raise JSONDecodeError('Expecting property name enclosed in double quotes', s, idx)
+    key, idx = scanstring(s, idx + 1)
+    idx = _skip_whitespace(s, idx)
+    if s[idx:idx + 1] != ':':
+        raise JSONDecodeError('Expecting \':\' delimiter', s, idx)
+    return key, _skip_whitespace(s, idx + 1)
+
+def _decode_scalar(s, idx):
+    if s[idx:idx + 1] == '"':
+        return scanstring(s, idx + 1)
+    for literal, value in _JSON_LITERALS:
+        if s.startswith(literal, idx):
+            return value, idx + len(literal)
+    match = NUMBER_RE.match(s, idx)
+    if match is None:
+        raise JSONDecodeError('Expecting value', s, idx)
+    integer, frac, exp = match.groups()
+    if frac or exp:
+        return float(integer + (frac or '') + (exp or '')), match.end()
+    return int(integer), match.end()
+
+def _loads_iterative(s):
+    # explicit stack counterpart of json.loads for documents nested deeper
+    # than the interpreter's recursion limit
+    if isinstance(s, (bytes, bytearray)):
+        s = s.decode(json.detect_encoding(s), 'surrogatepass')
+    containers = []
+    keys = []
+    idx = _skip_whitespace(s, 0)
+    while True:
+        c = s[idx:idx + 1]
+        if c == '{' or c == '[':
+            closing = '}' if c == '{' else ']'
+            idx = _skip_whitespace(s, idx + 1)
+            if s[idx:idx + 1] == closing:
+                value = {} if c == '{' else []
+                idx = idx + 1
+            elif c == '{':
+                key, idx = _decode_key(s, idx)
+                containers.append({})
+                keys.append(key)
+                continue
+            else:
+                containers.append([])
+                keys.append(None)
+                continue
+        else:
+            value, idx = _decode_scalar(s, idx)
+
+        # attach the value to its container, closing every container that ends here
+        while True:
+            if not containers:
+                idx = _skip_whitespace(s, idx)
+                if idx != len(s):
+                    raise JSONDecodeError('Extra data', s, idx)
+                return value
+            top = containers[-1]
+            if type(top) is list:
+                top.append(value)
+            else:
+                top[keys[-1]] = value
+            idx = _skip_whitespace(s, idx)
+            c = s[idx:idx + 1]
+            if c == ',':
+                idx = _skip_whitespace(s, idx + 1)
+                if type(top) is dict:
+                    keys[-1], idx = _decode_key(s, idx)
+                break
+            if c == ('}' if type(top) is dict else ']'):
+                idx = idx + 1
+                keys.pop()
+                value = containers.pop()
+                continue
+            raise JSONDecodeError('Expecting \',\' delimiter', s, idx)
+
+def _encode_scalar(o):
+    if isinstance(o, str):
+        return encode_basestring_ascii(o)
+    if o is None:
+        return 'null'
+    if o is True:
+        return 'true'
+    if o is False:
+        return 'false'
+    if isinstance(o, int):
+        return int.__repr__(o)
+    if isinstance(o, float):
+        if o != o:
+            return 'NaN'
+        if o == float('inf'):
+            return 'Infinity'
+        if o == float('-inf'):
+            return '-Infinity'
+        return float.__repr__(o)
+    raise TypeError(str.format('Object of type {} is not JSON serializable', type(o).__name__))
+
+def _encode_key(k):
+    if isinstance(k, str):
+        return encode_basestring_ascii(k)
+    if isinstance(k, (int, float)) or k is None:
+        return '"' + _encode_scalar(k) + '"'
+    raise TypeError(str.format('keys must be str, int, float, bool or None, not {}', type(k).__name__))
+
+def _dumps_iterative(obj, sort_keys=False):
+    # explicit stack counterpart of json.dumps with its default separators
+    parts = []
+    active = set()
+    # frame: [items iterator, closing bracket, first item pending, container id]
+    stack = [[iter((obj,)), '', True, None]]
+    while stack:
+        frame = stack[-1]
+        for item in frame[0]:
+            if frame[2]:
+                frame[2] = False
+            else:
+                parts.append(', ')
+            if frame[1] == '}':
+                k, item = item
+                parts.append(_encode_key(k))
+                parts.append(': ')
+            if isinstance(item, dict):
+                if not item:
+                    parts.append('{}')
+                    continue
+                parts.append('{')
+                key = id(item)
+                if key in active:
+                    raise ValueError('Circular reference detected')
+                active.add(key)
+                stack.append([iter(sorted(item.items()) if sort_keys else item.items()), '}', True, key])
+                break
+            if isinstance(item, (list, tuple)):
+                if not item:
+                    parts.append('[]')
+                    continue
+                parts.append('[')
+                key = id(item)
+                if key in active:
+                    raise ValueError('Circular reference detected')
+                active.add(key)
+                stack.append([iter(item), ']', True, key])
+                break
+            parts.append(_encode_scalar(item))
+        else:
+            stack.pop()
+            parts.append(frame[1])
+            active.discard(frame[3])
+    return ''.join(parts)
+
+def _json_loads(s):
+    try:
+        return json.loads(s)
+    except RecursionError:
+        return _loads_iterative(s)
+
+def _json_dumps(obj, sort_keys=False):
+    try:
+        return json.dumps(obj, sort_keys=sort_keys)
+    except RecursionError:
+        return _dumps_iterative(obj, sort_keys)
+
+# strings and the brackets and commas of a json text, strings are matched
+# without backtracking so a huge one costs a single scan
+_SCAN_TOKENS = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|([\[\]{},])')
+
+class Limits:
+    # bounds checked while scanning a payload, before it is parsed, with schema
+    # the max_length of every ListField is enforced as well
+    def __init__(self, max_bytes=None, max_depth=None, max_string=None, max_list=None, schema=True):
+        for name, value in (('max_bytes', max_bytes), ('max_depth', max_depth), ('max_string', max_string), ('max_list', max_list)):
+            if value is not None and value < 0:
+                raise ValueError(str.format('"{}" must not be negative', name))
+        self.max_bytes = max_bytes
+        self.max_depth = _MAX_INT if max_depth is None else max_depth
+        self.max_string = _MAX_INT if max_string is None else max_string
+        self.max_list = _MAX_INT if max_list is None else max_list
+        self.schema = schema
+        self._floors = {}
+        self._unions = {}
+
+    def _floor(self, cls):
+        # the shortest payload able to break a bound, shorter ones are not scanned
+        floor = self._floors.get(cls)
+        if floor is None:
+            shortest_list = self.max_list
+            if self.schema:
+                seen = set()
+                fields = list(getattr(cls, '__plan').fields.values())
+                while fields:
+                    field = fields.pop()
+                    if isinstance(field, ListField):
+                        shortest_list = min(shortest_list, field.max_length)
+                        fields.extend(field.type_mapping)
+                    elif isinstance(field, ObjectField) and not field.cls in seen:
+                        seen.add(field.cls)
+                        fields.extend(getattr(field.cls, '__plan').fields.values())
+                    elif isinstance(field, DictField):
+                        fields.append(field.value_field)
+                    elif isinstance(field, UnionField):
+                        for union_cls in field.classes:
+                            if not union_cls in seen:
+                                seen.add(union_cls)
+                                fields.extend(getattr(union_cls, '__plan').fields.values())
+            floor = min(2 * self.max_depth + 2, self.max_string + 3, 2 * shortest_list + 3)
+            self._floors[cls] = floor
+        return floor
+
+    def _check(self, cls, s):
+        if self.max_bytes is not None and len(s) > self.max_bytes // 4 and self._size(s) > self.max_bytes:
+            raise ValidationError([str.format('payload exceeds the maximum size: {} bytes', self.max_bytes)])
+        if len(s) < self._floor(cls):
+            return
+        if isinstance(s, (bytes, bytearray)):
+            s = s.decode(json.detect_encoding(s), 'surrogatepass')
+        self._scan(cls, s)
+
+    def _size(self, s):
+        # a str is measured as utf-8, only encoded when its length can not
+        # decide, no character takes more than four bytes
+        if isinstance(s, str) and len(s) <= self.max_bytes:
+            return len(s.encode('utf-8', 'surrogatepass'))
+        return len(s)
+
+    def _union_fields(self, field):
+        # until its key is read, an object of a union is typed by the fields
+        # all of its member classes that define them agree on
+        fields = self._unions.get(field)
+        if fields is None:
+            fields = {}
+            conflicts = set()
+            for union_cls in field.classes:
+                for k, v in getattr(union_cls, '__plan').items:
+                    if fields.setdefault(k, v) is not v:
+                        conflicts.add(k)
+            for k in conflicts:
+                del fields[k]
+            self._unions[field] = fields
+        return fields
+
+    def _select_member(self, frame, s, idx):
+        # a scalar key value following the key picks the member class that
+        # types the rest of the object
+        idx = _skip_whitespace(s, idx)
+        if s[idx:idx + 1] != ':':
+            return
+        idx = _skip_whitespace(s, idx + 1)
+        if s[idx:idx + 1] == '"':
+            tag = scanstring(s, idx + 1)[0]
+        else:
+            match = NUMBER_RE.match(s, idx)
+            if match is None:
+                return
+            integer, frac, exp = match.groups()
+            tag = float(integer + (frac or '') + (exp or '')) if frac or exp else int(integer)
+        member = frame.schema._select(tag)
+        if member is not None:
+            frame.schema = getattr(member, '__plan')
+
+    def _open(self, frame, is_list, start, cls):
+        # the frame of a container starting at start, typed by the schema where
+        # the payload follows it
+        if frame is None:
+            field = ObjectField(cls)
+            name = None
+        elif frame.is_list:
+            name = frame.name
+            field = None
+            if frame.schema is not None:
+                mapping = frame.schema.type_mapping
+                if len(mapping) == 1:
+                    field = mapping[0]
+                elif frame.items < len(mapping):
+                    field = mapping[frame.items]
+        elif isinstance(frame.schema, DictField):
+            # every value is typed by the value field and named after the dict
+            name = frame.name
+            field = frame.schema.value_field
+        elif isinstance(frame.schema, UnionField):
+            name = frame.key
+            field = self._union_fields(frame.schema).get(name)
+        else:
+            name = frame.key
+            field = frame.schema.fields.get(name) if frame.schema is not None else None
+        if not is_list:
+            if isinstance(field, ObjectField):
+                schema = getattr(field.cls, '__plan')
+            elif isinstance(field, (DictField, UnionField)):
+                schema = field
+            else:
+                schema = None
+            return _ScanFrame(False, schema, None, name, start)
+        if self.schema and isinstance(field, ListField):
+            return _ScanFrame(True, field, min(self.max_list, field.max_length), name, start)
+        return _ScanFrame(True, None, self.max_list, name, start)
+
+    def _scan(self, cls, s):
+        stack = []
+        frame = None
+        expect_key = False
+        max_string = self.max_string
+        for match in _SCAN_TOKENS.finditer(s):
+            c = match.group(1)
+            if c is None:
+                start, end = match.span()
+                if end - start - 2 > max_string:
+                    if s.find('\\', start, end) < 0 or len(scanstring(s, start + 1)[0]) > max_string:
+                        raise ValidationError([str.format('payload has a string exceeding the maximum length: {}', max_string)])
+                if expect_key:
+                    expect_key = False
+                    if isinstance(frame.schema, SchemaPlan):
+                        frame.key = scanstring(s, start + 1)[0]
+                    elif isinstance(frame.schema, UnionField):
+                        frame.key = scanstring(s, start + 1)[0]
+                        if frame.key == frame.schema.key:
+                            self._select_member(frame, s, end)
+            elif c == '{' or c == '[':
+                frame = self._open(frame, c == '[', match.start(), cls)
+                stack.append(frame)
+                if len(stack) > self.max_depth:
+                    raise ValidationError([str.format('payload exceeds the maximum depth: {}', self.max_depth)])
+                expect_key = c == '{'
+            elif frame is None:
+                # malformed, left for the parser to report
+                continue
+            elif c == ',':
+                if frame.is_list:
+                    frame.items = frame.items + 1
+                    if frame.items >= frame.limit:
+                        self._list_exceeded(frame)
+                else:
+                    expect_key = True
+            else:
+                if frame.is_list and frame.limit == 0 and _skip_whitespace(s, frame.start + 1) < match.start():
+                    self._list_exceeded(frame)
+                stack.pop()
+                frame = stack[-1] if stack else None
+                expect_key = False
+
+    def _list_exceeded(self, frame):
+        if frame.schema is not None and frame.limit == frame.schema.max_length:
+            raise ValidationError([str.format('List Field "{}" exceeded its maximum length: {}', frame.name, frame.limit)])
+        raise ValidationError([str.format('payload has a list exceeding the maximum length: {}', frame.limit)])
+
+class _ScanFrame:
+    # an open container met by Limits._scan, items counts the commas seen
+    __slots__ = ('is_list', 'schema', 'limit', 'name', 'start', 'items', 'key')
+
+    def __init__(self, is_list, schema, limit, name, start):
+        self.is_list = is_list
+        self.schema = schema
+        self.limit = limit
+        self.name = name
+        self.start = start
+        self.items = 0
+        self.key = None
+
+def set_limits(limits):
+    # the limits applied when a deserializer is not given any, None for none
+    global _limits
+    if limits is not None and not isinstance(limits, Limits):
+        raise TypeError('"limits" must be an instance of Limits or None')
+    _limits = limits
+
+def _load_payload(cls, json_string, limits):
+    if limits is None:
+        limits = _limits
+    if limits is not None:
+        limits._check(cls, json_string)
+    return _json_loads(json_string)
+
 def serialize(obj):
     if not isinstance(obj, SchemaModel):
         raise TypeError("Object must be an instance of a SchemaModel")
+    state = obj._frozen_state
+    if state is not None and not _seal(obj):
+        state = None
+    if state is not None and state.json is not None:
+        return state.json
     result, errors = obj.validate()
     if not result:
         raise ValidationError(errors)
-    return json.dumps(obj.to_json_obj())
+    json_string = _json_dumps(obj.to_json_obj())
+    if state is not None:
+        state.json = json_string
+    return json_string
 
-def _instantiate_list_field(list_schema_obj, list_obj):
+def serialize_bytes(obj):
+    state = obj._frozen_state if isinstance(obj, SchemaModel) else None
+    if state is not None and not _seal(obj):
+        state = None
+    if state is not None and state.json_bytes is not None:
+        return state.json_bytes
+    json_bytes = serialize(obj).encode('utf-8')
+    if state is not None:
+        state.json_bytes = json_bytes
+    return json_bytes
+
+def _build_list_field(list_schema_obj, list_obj, shared=None):
     populated_list = []
     if len(list_schema_obj.type_mapping) == 1:
+        type_obj = list_schema_obj.type_mapping[0]
+        if not type_obj._nested:
+            return list_schema_obj._copy_leaf(list_obj)
         for item in list_obj:
-            if isinstance(list_schema_obj.type_mapping[0], ObjectField):
-                populated_list.append(
-                    _instantiate_obj_field(
-                        list_schema_obj.type_mapping[0].cls,
-                        item
-                    )
-                )
-            elif isinstance(list_schema_obj.type_mapping[0], ListField):
-                populated_list.append(
-                    _instantiate_list_field(
-                        list_schema_obj.type_mapping[0],
-                        item
-                    )
-                )
-            else:
-                populated_list.append(item)
+            populated_list.append(_build_value(type_obj, item, shared))
     else:
         # multiple types for the list, fixed length
         if len(list_schema_obj.type_mapping) != len(list_obj):
             raise TypeError('list does not match the defined ListField\'s type_mapping schema')
-        
+
         idx = 0
         for type_obj in list_schema_obj.type_mapping:
-            if isinstance(type_obj, ObjectField):
-                populated_list.append(
-                    _instantiate_obj_field(
-                        type_obj.cls,
-                        list_obj[idx]
-                    )
-                )
-            elif isinstance(type_obj, ListField):
-                populated_list.append(
-                    _instantiate_list_field(
-                        type_obj,
-                        list_obj[idx]
-                    )
-                )
-            else:
-                populated_list.append(list_obj[idx])
+            populated_list.append(_build_value(type_obj, list_obj[idx], shared))
             idx = idx + 1
-    return populated_list    
+    return populated_list
 
-def _instantiate_obj_field(cls, data_dict):
+def _build_obj_field(cls, data_dict, shared=None):
     obj = cls()
-    schema = getattr(cls, '__schema')
-    for schema_key, schema_obj in schema.items():
+    plan = getattr(cls, '__plan')
+    instance_attrs = obj.__dict__
+    for schema_key, schema_obj in plan.items:
         if schema_key in data_dict:
-            if isinstance(schema_obj, ObjectField):
-                obj.__dict__[schema_key] = _instantiate_obj_field(
-                    schema_obj.cls,
-                    data_dict[schema_key]
-                )
-            elif isinstance(schema_obj, ListField):
-                obj.__dict__[schema_key] = _instantiate_list_field(
-                    schema_obj,
-                    data_dict[schema_key]
-                )
-            else:
-                obj.__dict__[schema_key] = data_dict[schema_key]
-    instance_keys = obj.__dict__.keys()
+            value = data_dict[schema_key]
+            if schema_obj._nested:
+                value = _build_value(schema_obj, value, shared)
+            instance_attrs[schema_key] = value
+    if len(plan.strings) > 0:
+        _intern_strings(plan, instance_attrs)
 
     # load the remaining dictionary items into the class
-    for k, v in data_dict.items():
-        if not k in instance_keys:
-            obj.__dict__[k] = v
+    if len(instance_attrs) != len(data_dict):
+        for k, v in data_dict.items():
+            if not k in instance_attrs:
+                instance_attrs[k] = v
+    if plan.frozen:
+        _seal(obj)
     return obj
 
-def deserialize(cls, json_string):
-    if not issubclass(cls, SchemaModel):
-        raise TypeError("Class must be a subclass of SchemaModel")
-    d = json.loads(json_string)
+def _intern_strings(plan, instance_attrs):
+    for k, field in plan.strings:
+        if k in instance_attrs and field._interns():
+            instance_attrs[k] = field._canonical(instance_attrs[k])
+
+def _build_value(schema_obj, value, shared=None):
+    # values of the wrong shape are kept as is and reported by validation
+    if isinstance(schema_obj, ObjectField):
+        if isinstance(value, dict):
+            if shared is not None and schema_obj.cls in shared.objects.classes:
+                return shared.instance(schema_obj.cls, value)
+            return _build_obj_field(schema_obj.cls, value, shared)
+    elif isinstance(schema_obj, ListField):
+        if isinstance(value, list):
+            return _build_list_field(schema_obj, value, shared)
+    elif isinstance(schema_obj, DictField):
+        if isinstance(value, dict):
+            return schema_obj._build(value, shared)
+    elif isinstance(schema_obj, UnionField):
+        cls = schema_obj._payload_cls(value) if isinstance(value, dict) else None
+        if cls is not None:
+            if shared is not None and cls in shared.objects.classes:
+                return shared.instance(cls, value)
+            return _build_obj_field(cls, value, shared)
+    elif schema_obj._interns():
+        return schema_obj._canonical(value)
+    return value
+
+def _build_iterative(field, data, out):
+    # pre-order over an explicit stack, nested models and lists are created
+    # and linked into their parent before their own contents are filled in
+    stack = [(field, data, out)]
+    while stack:
+        field, data, container = stack.pop()
+        if type(container) is list:
+            type_mapping = field.type_mapping
+            if len(type_mapping) == 1:
+                element_types = itertools.repeat(type_mapping[0])
+            elif len(type_mapping) != len(data):
+                # multiple types for the list, fixed length
+                raise TypeError('list does not match the defined ListField\'s type_mapping schema')
+            else:
+                element_types = type_mapping
+            for type_obj, item in zip(element_types, data):
+                if type_obj._nested:
+                    item = type_obj._build_nested(item, stack)
+                elif type_obj._interns():
+                    item = type_obj._canonical(item)
+                container.append(item)
+        elif type(container) is dict:
+            # only DictFields with nested values are pushed
+            value_field = field.value_field
+            for k, item in data.items():
+                container[field._key(k)] = value_field._build_nested(item, stack)
+        else:
+            instance_attrs = container.__dict__
+            plan = getattr(field, '__plan')
+            for schema_key, schema_obj in plan.items:
+                if schema_key in data:
+                    value = data[schema_key]
+                    if schema_obj._nested:
+                        value = schema_obj._build_nested(value, stack)
+                    instance_attrs[schema_key] = value
+            if len(plan.strings) > 0:
+                _intern_strings(plan, instance_attrs)
+
+            # load the remaining dictionary items into the class
+            if len(instance_attrs) != len(data):
+                for k, v in data.items():
+                    if not k in instance_attrs:
+                        instance_attrs[k] = v
+    return out
+
+def _instantiate_list_field(list_schema_obj, list_obj):
+    try:
+        return _build_list_field(list_schema_obj, list_obj)
+    except RecursionError:
+        return _build_iterative(list_schema_obj, list_obj, [])
+
+def _instantiate_obj_field(cls, data_dict, shared=None):
+    try:
+        return _build_obj_field(cls, data_dict, shared)
+    except RecursionError:
+        return _build_iterative(cls, data_dict, cls())
+
+class SharedObjects:
+    # bounded LRU of validated sub-objects of the given classes, keyed on their
+    # canonical JSON, reused wherever the same payload appears again, only
+    # frozen classes can be shared as a change would show in every record
+    def __init__(self, classes, maxsize=4096):
+        for cls in classes:
+            if not isinstance(cls, Schema):
+                raise TypeError("Class must be a subclass of SchemaModel")
+            if not getattr(cls, '__plan').frozen:
+                raise TypeError(str.format('{} must be frozen to be shared', cls.__name__))
+        if maxsize < 1:
+            raise ValueError('"maxsize" must be at least 1')
+        self.classes = frozenset(classes)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, key):
+        with self._lock:
+            obj = self._entries.get(key)
+            if obj is None:
+                self.misses = self.misses + 1
+            else:
+                self.hits = self.hits + 1
+                self._entries.move_to_end(key)
+            return obj
+
+    def _put(self, key, obj):
+        with self._lock:
+            self._entries[key] = obj
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+class _SharedBuild:
+    # a single deserialization through SharedObjects, trusted holds the
+    # instances already known to be valid
+    def __init__(self, objects):
+        self.objects = objects
+        self.trusted = {}
+
+    def instance(self, cls, data_dict):
+        key = (cls, json.dumps(data_dict, sort_keys=True))
+        obj = self.objects._get(key)
+        if obj is None:
+            obj = _build_obj_field(cls, data_dict, self)
+            result, errors = _run_checks(_ModelCheck(obj), self.trusted)
+            if not result:
+                return obj
+            self.objects._put(key, obj)
+        self.trusted[id(obj)] = obj
+        return obj
+
+def _deserialize_data(cls, d, shared):
     # create an instance of the given class
     # populate that instance with the data from the json dict
-    obj = _instantiate_obj_field(cls, d)
+    if shared is None:
+        obj = _instantiate_obj_field(cls, d)
+        result, errors = obj.validate()
+    else:
+        build = _SharedBuild(shared)
+        obj = _instantiate_obj_field(cls, d, build)
+        result, errors = _run_checks(_ModelCheck(obj), build.trusted)
+    if not result:
+        raise ValidationError(errors)
+    return obj
+
+def _shares_unknowns(obj):
+    # whether obj or a model below it holds a list or dict outside its schema,
+    # those are the only values the builders do not copy
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, list):
+            stack.extend(value)
+            continue
+        if not isinstance(value, SchemaModel):
+            continue
+        known = getattr(value, '__plan').known
+        for k, v in value.__dict__.items():
+            if k in known:
+                stack.append(v)
+            elif isinstance(v, (list, dict)):
+                return True
+    return False
+
+class DeserializeCache:
+    # bounded LRU of validated payloads keyed on (model class, payload), hits
+    # return the frozen instance itself or a fresh copy of a mutable one
+    def __init__(self, maxsize=1024, maxbytes=None):
+        if maxsize < 1:
+            raise ValueError('"maxsize" must be at least 1')
+        if maxbytes is not None and maxbytes < 1:
+            raise ValueError('"maxbytes" must be at least 1')
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses = self.misses + 1
+            else:
+                self.hits = self.hits + 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        size = len(key[1])
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self.nbytes = self.nbytes + size
+            while len(self._entries) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes):
+                old_key, old_entry = self._entries.popitem(last=False)
+                self.nbytes = self.nbytes - len(old_key[1])
+
+    def _deserialize(self, cls, json_string, shared, limits):
+        # the limits of this call apply to hits as well
+        if limits is None:
+            limits = _limits
+        if limits is not None:
+            limits._check(cls, json_string)
+        key = (cls, json_string)
+        entry = self._get(key)
+        if entry is not None:
+            obj, data, deep = entry
+            if obj is not None:
+                return obj
+            if deep:
+                data = copy.deepcopy(data)
+            return _instantiate_obj_field(cls, data)
+
+        data = _json_loads(json_string)
+        obj = _deserialize_data(cls, data, shared)
+        if getattr(cls, '__plan').frozen and _seal(obj):
+            # nothing below it can change, see _seal
+            self._put(key, (obj, None, False))
+        else:
+            # the instance is handed out, the cached data must not share with it
+            deep = _shares_unknowns(obj)
+            self._put(key, (None, copy.deepcopy(data) if deep else data, deep))
+        return obj
+
+def deserialize(cls, json_string, shared=None, cache=None, limits=None):
+    if not issubclass(cls, SchemaModel):
+        raise TypeError("Class must be a subclass of SchemaModel")
+    if cache is not None:
+        return cache._deserialize(cls, json_string, shared, limits)
+    return _deserialize_data(cls, _load_payload(cls, json_string, limits), shared)
+
+def _refill_obj(obj, data_dict, reused):
+    # the attributes of obj follow data_dict, like a model built from it
+    plan = getattr(obj, '__plan')
+    instance_attrs = obj.__dict__
+    for schema_key, schema_obj in plan.items:
+        if schema_key in data_dict:
+            value = data_dict[schema_key]
+            if schema_obj._nested:
+                value = _refill_value(schema_obj, value, instance_attrs.get(schema_key), reused)
+            instance_attrs[schema_key] = value
+        elif schema_key in instance_attrs:
+            del instance_attrs[schema_key]
+    if len(plan.strings) > 0:
+        _intern_strings(plan, instance_attrs)
+    if len(instance_attrs) != len(data_dict) or not plan.known.issuperset(data_dict):
+        # unknown attributes follow the payload too
+        for k in [k for k in instance_attrs if not k in plan.known and not k in data_dict]:
+            del instance_attrs[k]
+        for k, v in data_dict.items():
+            if not k in plan.known:
+                instance_attrs[k] = v
+
+def _refill_value(schema_obj, value, old, reused):
+    # reuses the model or list already in place, each at most once so trees
+    # sharing a sub-object do not end up aliased
+    if type(old) is list:
+        if isinstance(schema_obj, ListField) and isinstance(value, list) and not id(old) in reused:
+            reused.add(id(old))
+            _refill_list(schema_obj, value, old, reused)
+            return old
+    elif isinstance(schema_obj, (ObjectField, UnionField)) and isinstance(value, dict) and type(old) is schema_obj._payload_cls(value):
+        if not getattr(old, '__plan').frozen and not id(old) in reused:
+            reused.add(id(old))
+            _refill_obj(old, value, reused)
+            return old
+    return _build_value(schema_obj, value)
+
+def _refill_list(list_schema_obj, list_obj, old, reused):
+    type_mapping = list_schema_obj.type_mapping
+    if len(type_mapping) == 1:
+        if not type_mapping[0]._nested:
+            old[:] = list_schema_obj._copy_leaf(list_obj) if type_mapping[0]._interns() else list_obj
+            return
+        element_types = itertools.repeat(type_mapping[0])
+    elif len(type_mapping) != len(list_obj):
+        raise TypeError('list does not match the defined ListField\'s type_mapping schema')
+    else:
+        element_types = type_mapping
+    kept = len(old)
+    for idx, (type_obj, item) in enumerate(zip(element_types, list_obj)):
+        if idx >= kept:
+            old.append(_build_value(type_obj, item))
+        elif type_obj._nested:
+            old[idx] = _refill_value(type_obj, item, old[idx], reused)
+        else:
+            old[idx] = _build_value(type_obj, item)
+    del old[len(list_obj):]
+
+def _fill_into(obj, data_dict):
+    try:
+        _refill_obj(obj, data_dict, {id(obj)})
+    except RecursionError:
+        fresh = _instantiate_obj_field(type(obj), data_dict)
+        obj.__dict__.clear()
+        obj.__dict__.update(fresh.__dict__)
+
+def deserialize_into(obj, json_string, limits=None):
+    # overwrites obj with the payload, the models and lists already inside it
+    # are refilled instead of allocated again, obj keeps the payload even when
+    # it does not validate
+    if not isinstance(obj, SchemaModel):
+        raise TypeError("Object must be an instance of a SchemaModel")
+    if getattr(obj, '__plan').frozen:
+        raise AttributeError(str.format('cannot deserialize into {}, it is frozen', type(obj).__name__))
+    _fill_into(obj, _load_payload(type(obj), json_string, limits))
     result, errors = obj.validate()
     if not result:
         raise ValidationError(errors)
     return obj
+
+class ModelPool:
+    # released instances of one class handed out again by the streaming
+    # deserializers, which refill them in place
+    def __init__(self, cls, maxsize=64):
+        if not issubclass(cls, SchemaModel):
+            raise TypeError("Class must be a subclass of SchemaModel")
+        if getattr(cls, '__plan').frozen:
+            raise TypeError(str.format('{} is frozen, its instances can not be refilled', cls.__name__))
+        self.cls = cls
+        self.maxsize = maxsize
+        self.created = 0
+        self.reused = 0
+        self._free = []
+        self._free_ids = set()
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self):
+        if self._free:
+            obj = self._free.pop()
+            self._free_ids.discard(id(obj))
+            self.reused = self.reused + 1
+            return obj
+        self.created = self.created + 1
+        return self.cls()
+
+    def release(self, obj):
+        if type(obj) is not self.cls:
+            raise TypeError(str.format('Model must be an instance of {}', self.cls.__name__))
+        if len(self._free) < self.maxsize and not id(obj) in self._free_ids:
+            self._free.append(obj)
+            self._free_ids.add(id(obj))
+
+class Sampling:
+    # validation policy of the bulk deserializers, every Nth record or a seeded
+    # fraction of them is fully validated and the others only get the required
+    # field and type check, the counts accumulate across calls
+    def __init__(self, every=None, fraction=None, seed=None):
+        if (every is None) == (fraction is None):
+            raise ValueError('exactly one of "every" and "fraction" must be given')
+        if every is not None and every < 1:
+            raise ValueError('"every" must be at least 1')
+        if fraction is not None and not 0 <= fraction <= 1:
+            raise ValueError('"fraction" must be within [0, 1]')
+        self.every = every
+        self.fraction = fraction
+        self.records = 0
+        self.sampled = 0
+        self.invalid = 0
+        self.failures = {}
+        self._random = random.Random(seed)
+
+    def _picks(self):
+        self.records = self.records + 1
+        if self.every is not None:
+            return (self.records - 1) % self.every == 0
+        return self._random.random() < self.fraction
+
+    def failure_rates(self):
+        # share of the sampled records failing on each field
+        if self.sampled == 0:
+            return {}
+        return {k: v / self.sampled for k, v in self.failures.items()}
+
+def _field_failures(obj, full):
+    # the errors of a model grouped by attribute, only presence, type and
+    # nullability are checked unless full
+    plan = getattr(obj, '__plan')
+    instance_attrs = obj.__dict__
+    failures = {}
+    for k, v in plan.items:
+        if k in instance_attrs:
+            value = instance_attrs[k]
+            if not full:
+                result, errors = v._check_type(k, value)
+            else:
+                try:
+                    result, errors = v.is_valid(k, value)
+                except RecursionError:
+                    part = v._check_nested(k, value)
+                    result, errors = part if type(part) is tuple else _run_checks(part)
+            if not result:
+                failures[k] = errors
+        elif v.required:
+            failures[k] = [str.format('required field is missing: {}', k)]
+    if not plan.allow_unknowns and not plan.known.issuperset(instance_attrs):
+        for attr_name in instance_attrs:
+            if not attr_name in plan.known:
+                failures[attr_name] = [str.format('unknown fields not permitted, attribute must be defined in schema: {}', attr_name)]
+    return failures
+
+def _sampled_validate(obj, sampling):
+    full = sampling._picks()
+    failures = _field_failures(obj, full)
+    if full:
+        sampling.sampled = sampling.sampled + 1
+        for k in failures:
+            sampling.failures[k] = sampling.failures.get(k, 0) + 1
+    if len(failures) == 0:
+        return True, []
+    sampling.invalid = sampling.invalid + 1
+    errors = []
+    for field_errors in failures.values():
+        errors.extend(field_errors)
+    return False, errors
+
+def _column_failures(plan, models):
+    # the errors of the batch validated fields of models, by position
+    failures = {}
+    for k, field in plan.batch:
+        column = []
+        owners = []
+        for idx, obj in enumerate(models):
+            instance_attrs = obj.__dict__
+            if not k in instance_attrs:
+                if field.required:
+                    failures.setdefault(idx, []).append(str.format('required field is missing: {}', k))
+                continue
+            value = instance_attrs[k]
+            result, errors = field.is_valid(k, value, field._plain_validators)
+            if not result:
+                failures.setdefault(idx, []).extend(errors)
+            elif value is not None:
+                column.append(value)
+                owners.append(idx)
+        if not column:
+            continue
+        for validator in field._batch_validators:
+            outcomes = list(validator.func(column))
+            if len(outcomes) != len(column):
+                raise ValueError(str.format('batch validator {} returned {} results for {} values', validator.__name__, len(outcomes), len(column)))
+            for idx, outcome in zip(owners, outcomes):
+                if not outcome:
+                    failures.setdefault(idx, []).append(_validator_error(k, validator))
+    return failures
+
+def validate_many(models):
+    # (result, errors) for every model, the batch validators of a class's
+    # fields are called once with the values of all its models
+    models = list(models)
+    results = []
+    batches = {}
+    for obj in models:
+        plan = getattr(obj, '__plan')
+        if plan.batch:
+            try:
+                results.append(obj._validate(False))
+                batches.setdefault(plan, []).append(len(results) - 1)
+                continue
+            except RecursionError:
+                pass
+        results.append(obj.validate())
+    for plan, positions in batches.items():
+        failures = _column_failures(plan, [models[idx] for idx in positions])
+        for idx, errors in failures.items():
+            position = positions[idx]
+            results[position] = (False, results[position][1] + errors)
+    return results
+
+_WHERE_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, values: value in values,
+    'not in': lambda value, values: not value in values
+}
+
+def _where_predicate(path, field, condition):
+    if callable(condition):
+        return condition
+    if not isinstance(condition, tuple) or len(condition) != 2 or not condition[0] in _WHERE_OPERATORS:
+        raise TypeError(str.format('filter on "{}" must be a callable or an (operator, value) tuple, operators: {}', path, ', '.join(_WHERE_OPERATORS)))
+    if field._nested:
+        raise TypeError(str.format('filter on "{}" must be a callable, operators only apply to scalar fields', path))
+    op, operand = condition
+    if op == 'in' or op == 'not in':
+        operand = list(operand)
+        operands = operand
+        try:
+            operand = frozenset(operand)
+        except TypeError:
+            pass
+    else:
+        operands = [operand]
+    for v in operands:
+        result, errors = field._check_type(path, v)
+        if not result:
+            raise TypeError(str.format('filter on "{}" can not match {!r}: {}', path, v, errors[0]))
+    compare = _WHERE_OPERATORS[op]
+
+    def predicate(value):
+        try:
+            return compare(value, operand)
+        except TypeError:
+            return False
+    return predicate
+
+def _compile_where(cls, where):
+    # checks the filter against the schema once, dotted paths go through ObjectFields
+    conditions = []
+    for path, condition in where.items():
+        names = path.split('.')
+        field_cls = cls
+        for idx, name in enumerate(names):
+            field = getattr(field_cls, '__plan').fields.get(name)
+            if field is None:
+                raise ValueError(str.format('filter field "{}" is not defined in the schema of {}', path, field_cls.__name__))
+            if idx < len(names) - 1:
+                if not isinstance(field, ObjectField):
+                    raise ValueError(str.format('filter path "{}" must only pass through ObjectFields', path))
+                field_cls = field.cls
+        conditions.append((tuple(names), _where_predicate(path, field, condition)))
+    return tuple(conditions)
+
+def _where_matches(d, conditions):
+    # records missing a filtered field never match
+    for names, predicate in conditions:
+        value = d
+        for name in names:
+            if type(value) is not dict or not name in value:
+                return False
+            value = value[name]
+        if not predicate(value):
+            return False
+    return True
+
+def deserialize_stream(cls, json_strings, sampling=None, skip_invalid=False, where=None, limits=None, pool=None):
+    # yields a model per non blank json string, such as the lines of a file,
+    # records not matching where are dropped before any model is built, with a
+    # pool the models are taken from it and refilled
+    if not issubclass(cls, SchemaModel):
+        raise TypeError("Class must be a subclass of SchemaModel")
+    if pool is not None and pool.cls is not cls:
+        raise TypeError(str.format('pool must hold instances of {}', cls.__name__))
+    conditions = _compile_where(cls, where) if where else None
+    return _deserialize_records(cls, json_strings, sampling, skip_invalid, conditions, limits, True, pool)
+
+def _deserialize_records(cls, json_strings, sampling, skip_invalid, conditions, limits, validate=True, pool=None):
+    for json_string in json_strings:
+        if not json_string.strip():
+            continue
+        try:
+            d = _load_payload(cls, json_string, limits)
+        except ValidationError:
+            if skip_invalid:
+                continue
+            raise
+        if conditions is not None and not _where_matches(d, conditions):
+            continue
+        if pool is None:
+            obj = _instantiate_obj_field(cls, d)
+        else:
+            obj = pool.acquire()
+            _fill_into(obj, d)
+        if not validate:
+            yield obj
+            continue
+        if sampling is None:
+            result, errors = obj.validate()
+        else:
+            result, errors = _sampled_validate(obj, sampling)
+        if not result:
+            if pool is not None:
+                pool.release(obj)
+            if skip_invalid:
+                continue
+            raise ValidationError(errors)
+        yield obj
+
+def deserialize_many(cls, json_strings, sampling=None, skip_invalid=False, where=None, limits=None):
+    if sampling is not None or not issubclass(cls, SchemaModel) or not getattr(cls, '__plan').batch:
+        return list(deserialize_stream(cls, json_strings, sampling, skip_invalid, where, limits))
+    # the whole list is validated at once so batch validators see every record
+    conditions = _compile_where(cls, where) if where else None
+    models = list(_deserialize_records(cls, json_strings, None, skip_invalid, conditions, limits, False))
+    valid = []
+    for obj, (result, errors) in zip(models, validate_many(models)):
+        if result:
+            valid.append(obj)
+        elif not skip_invalid:
+            raise ValidationError(errors)
+    return valid
+
+# codec: file extensions, magic bytes, opener
+_COMPRESSIONS = {
+    'gzip': (('.gz', '.gzip'), b'\x1f\x8b', gzip.open),
+    'bz2': (('.bz2',), b'BZh', bz2.open),
+    'xz': (('.xz', '.lzma'), b'\xfd7zXZ\x00', lzma.open)
+}
+
+def _compression(path=None, head=b''):
+    if path is not None:
+        name = os.fsdecode(path)
+        for codec, (extensions, magic, opener) in _COMPRESSIONS.items():
+            if name.endswith(extensions):
+                return codec
+    for codec, (extensions, magic, opener) in _COMPRESSIONS.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+class _Prefixed:
+    # a binary file whose first bytes were read to recognize its codec
+    def __init__(self, head, f):
+        self.head = head
+        self.f = f
+
+    def read(self, size=-1):
+        head = self.head
+        if not head:
+            return self.f.read(size)
+        self.head = b''
+        if size < 0:
+            return head + self.f.read()
+        if size < len(head):
+            self.head = head[size:]
+            return head[:size]
+        return head + self.f.read(size - len(head))
+
+def open_compressed(path, mode='rb'):
+    # opens a plain, gzip, bz2 or xz file, the codec is taken from the
+    # extension, or when reading from the magic bytes
+    codec = _compression(path)
+    if codec is None and 'r' in mode:
+        with open(path, 'rb') as f:
+            codec = _compression(None, f.read(6))
+    if codec is None:
+        return open(path, mode)
+    return _COMPRESSIONS[codec][2](path, mode)
+
+def _decompressed_chunks(source, chunk_size, workers=1):
+    # the decompressed content of a path or file in chunks, str chunks for text files
+    if isinstance(source, (str, bytes, os.PathLike)):
+        if workers > 1 and _compression(source) in (None, 'gzip'):
+            with open(source, 'rb') as f:
+                if _compression(None, f.read(2)) == 'gzip':
+                    yield from _gzip_members(f, workers, chunk_size)
+                    return
+        with open_compressed(source, 'rb') as f:
+            yield from _file_chunks(f, chunk_size)
+        return
+    head = source.read(6)
+    if isinstance(head, str) or _compression(None, head) is None:
+        if head:
+            yield head
+        yield from _file_chunks(source, chunk_size)
+        return
+    with _COMPRESSIONS[_compression(None, head)][2](_Prefixed(head, source), 'rb') as f:
+        yield from _file_chunks(f, chunk_size)
+
+def _file_chunks(f, chunk_size):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def _gzip_member_starts(data):
+    # every plausible gzip header, the members start at some of them
+    start = data.find(b'\x1f\x8b\x08')
+    while start >= 0:
+        if start + 10 <= len(data) and data[start + 3] & 0xe0 == 0 and data[start + 8] in (0, 2, 4):
+            yield start
+        start = data.find(b'\x1f\x8b\x08', start + 1)
+
+_GZIP_TRUNCATED = 'Compressed file ended before the end-of-stream marker was reached'
+
+def _gzip_member(data, start, chunk_size, limit):
+    # (chunks, end) of the member at start, (None, None) when start is not a
+    # member, (None, start) when it holds more than limit bytes, a member cut
+    # short by the end of the data raises EOFError as gzip does
+    decompressor = zlib.decompressobj(31)
+    chunks = []
+    size = 0
+    position = start
+    try:
+        while not decompressor.eof and position < len(data):
+            chunk = decompressor.decompress(data[position:position + chunk_size])
+            position = position + chunk_size
+            size = size + len(chunk)
+            if size > limit:
+                return None, start
+            if chunk:
+                chunks.append(chunk)
+    except zlib.error:
+        return None, None
+    if not decompressor.eof:
+        # as in gzip, padding or a lone byte is not the start of a member
+        if len(data) - start < 2 or data[start:].strip(b'\x00') == b'':
+            return None, None
+        raise EOFError(_GZIP_TRUNCATED)
+    return chunks, min(position, len(data)) - len(decompressor.unused_data)
+
+def _gzip_stream_member(data, start, chunk_size):
+    # decompresses one member chunk by chunk, returns where it ends
+    decompressor = zlib.decompressobj(31)
+    position = start
+    while not decompressor.eof:
+        if position >= len(data):
+            raise EOFError(_GZIP_TRUNCATED)
+        chunk = decompressor.decompress(data[position:position + chunk_size])
+        position = position + chunk_size
+        if chunk:
+            yield chunk
+    return min(position, len(data)) - len(decompressor.unused_data)
+
+def _gzip_members(f, workers, chunk_size):
+    # the members of a gzip file are decompressed by a thread pool, zlib lets
+    # go of the GIL, every plausible header is tried ahead and only those met
+    # by following the members from the start are used
+    if os.fstat(f.fileno()).st_size == 0:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        limit = chunk_size * 8
+        starts = _gzip_member_starts(data)
+        tried = collections.OrderedDict()
+        position = 0
+        while position < len(data):
+            while len(tried) < workers * 2:
+                start = next(starts, None)
+                if start is None:
+                    break
+                if start >= position:
+                    tried[start] = pool.submit(_gzip_member, data, start, chunk_size, limit)
+            while tried and next(iter(tried)) < position:
+                tried.popitem(last=False)[1].cancel()
+            if position in tried:
+                chunks, end = tried.pop(position).result()
+            else:
+                chunks, end = _gzip_member(data, position, chunk_size, limit)
+            if end is None:
+                if data[position:].strip(b'\x00') == b'':
+                    return
+                raise OSError('Not a gzipped file')
+            if chunks is None:
+                end = yield from _gzip_stream_member(data, position, chunk_size)
+            else:
+                yield from chunks
+            position = end
+        for future in tried.values():
+            future.cancel()
+
+def _line_blocks(chunks):
+    # the lines of a sequence of chunks, a list per chunk
+    pending = None
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        lines = chunk.split(b'\n' if isinstance(chunk, bytes) else '\n')
+        pending = lines.pop()
+        if lines:
+            yield lines
+    if pending:
+        yield [pending]
+
+def _queue_put(items, item, stop):
+    # blocks while the queue is full, gives up once the consumer stopped
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+_QUEUE_END = object()
+
+def _produce(items, stop, produced):
+    try:
+        for item in produced:
+            if not _queue_put(items, item, stop):
+                return
+        _queue_put(items, _QUEUE_END, stop)
+    except BaseException as e:
+        _queue_put(items, e, stop)
+
+def _threaded(produced, queue_size):
+    # iterates produced in a thread of its own, handing the items over a bounded queue
+    items = queue.Queue(queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce, args=(items, stop, produced), daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _QUEUE_END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def read_lines(source, chunk_size=1 << 20, workers=1, queue_size=4):
+    # the lines of a plain or compressed path or file, read and decompressed
+    # in a separate thread
+    return itertools.chain.from_iterable(_line_blocks(_threaded(_decompressed_chunks(source, chunk_size, workers), queue_size)))
+
+def serialize_many(models, dest, compression=None, chunk_size=1 << 20, queue_size=4):
+    # writes a json line per model to a path or binary file, compressed by the
+    # path's extension or the given codec on a separate thread, returns the count
+    is_path = isinstance(dest, (str, bytes, os.PathLike))
+    if is_path and compression is None:
+        compression = _compression(dest)
+    # checked before opening, a bad codec must not truncate the file
+    if compression is not None and not compression in _COMPRESSIONS:
+        raise ValueError(str.format('"compression" must be one of: {}', ', '.join(_COMPRESSIONS)))
+    out = open(dest, 'wb') if is_path else None
+    try:
+        target = out if out is not None else dest
+        if compression is not None:
+            target = _COMPRESSIONS[compression][2](target, 'wb')
+        try:
+            writer = _ThreadedWriter(target, queue_size)
+            try:
+                count = 0
+                block = []
+                size = 0
+                for obj in models:
+                    line = serialize(obj).encode('utf-8') + b'\n'
+                    block.append(line)
+                    size = size + len(line)
+                    count = count + 1
+                    if size >= chunk_size:
+                        writer.write(b''.join(block))
+                        block = []
+                        size = 0
+                if block:
+                    writer.write(b''.join(block))
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+        finally:
+            if target is not out and target is not dest:
+                target.close()
+    finally:
+        if out is not None:
+            out.close()
+    return count
+
+class _ThreadedWriter:
+    # writes the chunks it is given to target from a thread of its own
+    def __init__(self, target, queue_size):
+        self.target = target
+        self.items = queue.Queue(queue_size)
+        self.stop = threading.Event()
+        self.errors = []
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        try:
+            while True:
+                chunk = self.items.get()
+                if chunk is _QUEUE_END:
+                    return
+                self.target.write(chunk)
+        except BaseException as e:
+            self.errors.append(e)
+            self.stop.set()
+
+    def write(self, chunk):
+        if not _queue_put(self.items, chunk, self.stop):
+            self.close()
+
+    def close(self):
+        _queue_put(self.items, _QUEUE_END, self.stop)
+        self.thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def abort(self):
+        # drops the queued chunks and ends the thread without raising
+        self.stop.set()
+        while True:
+            try:
+                self.items.get_nowait()
+            except queue.Empty:
+                break
+        self.items.put_nowait(_QUEUE_END)
+        self.thread.join()
+
+class StageStats:
+    # what a pipeline stage did, seconds only count the time it was busy
+    __slots__ = ('name', 'items', 'seconds', 'queue_depth')
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+        self.queue_depth = 0
+
+    def throughput(self):
+        if self.seconds == 0:
+            return 0.0
+        return self.items / self.seconds
+
+def _pipeline_batch(cls, lines, skip_invalid, where):
+    # runs in the consuming thread or in a worker process
+    start = time.perf_counter()
+    models = deserialize_many(cls, lines, None, skip_invalid, where)
+    return models, time.perf_counter() - start
+
+class Pipeline:
+    # read -> split -> deserialize -> consume, the reading runs in a thread and
+    # hands batches of lines over a bounded queue, the batches are deserialized
+    # inline or in a process pool with at most queue_size of them in flight
+    def __init__(self, cls, source, workers=0, ordered=True, batch_size=1000, queue_size=4, chunk_size=1 << 20, skip_invalid=False, where=None, decompress_workers=1):
+        if not issubclass(cls, SchemaModel):
+            raise TypeError("Class must be a subclass of SchemaModel")
+        if batch_size < 1 or queue_size < 1 or chunk_size < 1:
+            raise ValueError('"batch_size", "queue_size" and "chunk_size" must be at least 1')
+        if where:
+            _compile_where(cls, where)
+        if workers > 0:
+            # checked here, a pool that cannot receive its work never returns it
+            try:
+                pickle.dumps((cls, where))
+            except Exception as e:
+                raise TypeError(str.format('"cls" and "where" must be picklable to use workers: {}', e))
+        self.cls = cls
+        self.source = source
+        self.workers = workers
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.skip_invalid = skip_invalid
+        self.where = where
+        self.decompress_workers = decompress_workers
+        self.stats = {name: StageStats(name) for name in ('read', 'deserialize', 'consume')}
+
+    def _batches(self):
+        # batches of records from a plain or compressed path or file, or an
+        # iterable, the reading thread also decompresses
+        source = self.source
+        if isinstance(source, (str, bytes, os.PathLike)) or hasattr(source, 'read'):
+            blocks = _line_blocks(_decompressed_chunks(source, self.chunk_size, self.decompress_workers))
+        else:
+            blocks = [source]
+        batch = []
+        for lines in blocks:
+            for line in lines:
+                batch.append(line)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def _read(self, batches, stop):
+        stats = self.stats['read']
+        try:
+            start = time.perf_counter()
+            for batch in self._batches():
+                stats.seconds = stats.seconds + time.perf_counter() - start
+                stats.items = stats.items + len(batch)
+                if not _queue_put(batches, batch, stop):
+                    return
+                stats.queue_depth = max(stats.queue_depth, batches.qsize())
+                start = time.perf_counter()
+            _queue_put(batches, _QUEUE_END, stop)
+        except BaseException as e:
+            _queue_put(batches, e, stop)
+
+    def __iter__(self):
+        batches = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read, args=(batches, stop), daemon=True)
+        reader.start()
+        executor = concurrent.futures.ProcessPoolExecutor(self.workers) if self.workers > 0 else None
+        in_flight = collections.deque()
+        deserialize_stats = self.stats['deserialize']
+        consume_stats = self.stats['consume']
+        reading = True
+        finished = False
+        try:
+            while True:
+                while reading and len(in_flight) < (self.queue_size if executor is not None else 1):
+                    batch = batches.get()
+                    if batch is _QUEUE_END:
+                        reading = False
+                    elif isinstance(batch, BaseException):
+                        raise batch
+                    elif executor is None:
+                        in_flight.append(_pipeline_batch(self.cls, batch, self.skip_invalid, self.where))
+                    else:
+                        in_flight.append(executor.submit(_pipeline_batch, self.cls, batch, self.skip_invalid, self.where))
+                        deserialize_stats.queue_depth = max(deserialize_stats.queue_depth, len(in_flight))
+                if not in_flight:
+                    break
+                if executor is None or self.ordered:
+                    result = in_flight.popleft()
+                else:
+                    done, not_done = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    result = done.pop()
+                    in_flight.remove(result)
+                if executor is not None:
+                    result = result.result()
+                models, seconds = result
+                deserialize_stats.items = deserialize_stats.items + len(models)
+                deserialize_stats.seconds = deserialize_stats.seconds + seconds
+                # the generator is suspended while the consumer works on a batch
+                start = time.perf_counter()
+                for obj in models:
+                    yield obj
+                    consume_stats.items = consume_stats.items + 1
+                consume_stats.seconds = consume_stats.seconds + time.perf_counter() - start
+            finished = True
+        finally:
+            stop.set()
+            if executor is not None:
+                # cancelled by hand as cancel_futures needs Python 3.9+, after
+                # an error or an early close the workers are not waited on
+                for future in in_flight:
+                    future.cancel()
+                executor.shutdown(wait=finished)
+            reader.join()
+
+def pipeline(cls, source, **options):
+    return Pipeline(cls, source, **options)
+
+def _ranges(count, parts):
+    # contiguous (start, stop) ranges covering count items, one per worker
+    parts = max(1, min(parts, count))
+    size, extra = divmod(count, parts)
+    result = []
+    start = 0
+    for idx in range(parts):
+        stop = start + size + (1 if idx < extra else 0)
+        result.append((start, stop))
+        start = stop
+    return result
+
+# header of a persisted line index: magic, indexed file size and mtime, count
+_INDEX_MAGIC = 0x3178646e6d737370
+_INDEX_HEADER = 4
+
+def _suffixed(path, suffix):
+    # paths may be pathlib paths or bytes as well
+    path = os.fspath(path)
+    return path + (suffix if isinstance(path, str) else os.fsencode(suffix))
+
+class ModelFile:
+    # random access to the records of an NDJSON file, the file is memory mapped
+    # and only the line offsets are held, in an index persisted next to it
+    def __init__(self, cls, path, index_path=None):
+        if not issubclass(cls, SchemaModel):
+            raise TypeError("Class must be a subclass of SchemaModel")
+        self.cls = cls
+        self.path = path
+        self.index_path = _suffixed(path, '.idx') if index_path is None else index_path
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size > 0 else b''
+        self._offsets = self._load_index(stat)
+
+    def _load_index(self, stat):
+        header = array.array('Q', [_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, 0])
+        try:
+            with open(self.index_path, 'rb') as f:
+                offsets = array.array('Q', f.read())
+            if offsets[:_INDEX_HEADER - 1] == header[:_INDEX_HEADER - 1] and len(offsets) == _INDEX_HEADER + offsets[_INDEX_HEADER - 1]:
+                return offsets[_INDEX_HEADER:]
+        except (OSError, ValueError):
+            pass
+
+        offsets = array.array('Q')
+        position = 0
+        self._file.seek(0)
+        for line in self._file:
+            if not line.isspace():
+                offsets.append(position)
+            position = position + len(line)
+        header[_INDEX_HEADER - 1] = len(offsets)
+        try:
+            tmp_path = _suffixed(self.index_path, '.tmp')
+            with open(tmp_path, 'wb') as f:
+                header.tofile(f)
+                offsets.tofile(f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            # an index that can not be written is rebuilt on the next open
+            pass
+        return offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def raw(self, index):
+        start = self._offsets[index]
+        end = self._mmap.find(b'\n', start)
+        if end < 0:
+            end = len(self._mmap)
+        return self._mmap[start:end]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(self.iter_range(*key.indices(len(self))))
+        return deserialize(self.cls, self.raw(key))
+
+    def __iter__(self):
+        return self.iter_range(0, len(self))
+
+    def iter_range(self, start, stop, step=1):
+        for idx in range(start, stop, step):
+            yield deserialize(self.cls, self.raw(idx))
+
+    def ranges(self, parts):
+        return _ranges(len(self), parts)
+
+def _sortable(value):
+    return type(value) in (int, float) and value == value
+
+class _SortedIndex:
+    # ascending unique keys and their models in chunks of at most 2 * _LOAD
+    # entries, an insert or delete moves one chunk instead of the whole index
+    _LOAD = 1000
+
+    def __init__(self):
+        self._keys = []
+        self._models = []
+        self._maxes = []
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._keys)
+
+    def build(self, pairs):
+        # pairs of (key, model) with unique keys, in any order
+        pairs.sort(key=operator.itemgetter(0))
+        load = self._LOAD
+        self._keys = [[pair[0] for pair in pairs[i:i + load]] for i in range(0, len(pairs), load)]
+        self._models = [[pair[1] for pair in pairs[i:i + load]] for i in range(0, len(pairs), load)]
+        self._maxes = [keys[-1] for keys in self._keys]
+
+    def items(self):
+        for keys, models in zip(self._keys, self._models):
+            yield from zip(keys, models)
+
+    def insert(self, key, obj):
+        if not self._maxes:
+            self._keys.append([key])
+            self._models.append([obj])
+            self._maxes.append(key)
+            return
+        chunk = min(bisect.bisect_left(self._maxes, key), len(self._maxes) - 1)
+        keys = self._keys[chunk]
+        pos = bisect.bisect_left(keys, key)
+        keys.insert(pos, key)
+        self._models[chunk].insert(pos, obj)
+        self._maxes[chunk] = keys[-1]
+        if len(keys) > 2 * self._LOAD:
+            models = self._models[chunk]
+            self._keys[chunk:chunk + 1] = [keys[:self._LOAD], keys[self._LOAD:]]
+            self._models[chunk:chunk + 1] = [models[:self._LOAD], models[self._LOAD:]]
+            self._maxes[chunk:chunk + 1] = [keys[self._LOAD - 1], keys[-1]]
+
+    def delete(self, key):
+        chunk = bisect.bisect_left(self._maxes, key)
+        keys = self._keys[chunk]
+        pos = bisect.bisect_left(keys, key)
+        del keys[pos]
+        del self._models[chunk][pos]
+        if keys:
+            self._maxes[chunk] = keys[-1]
+        else:
+            del self._keys[chunk]
+            del self._models[chunk]
+            del self._maxes[chunk]
+
+    def between(self, low, high):
+        # the models of low <= key <= high, None leaves a bound open
+        result = []
+        chunk = 0 if low is None else bisect.bisect_left(self._maxes, low)
+        while chunk < len(self._keys):
+            keys = self._keys[chunk]
+            start = 0 if low is None else bisect.bisect_left(keys, low)
+            if high is not None and keys[-1] > high:
+                result.extend(self._models[chunk][start:bisect.bisect_right(keys, high)])
+                break
+            result.extend(self._models[chunk][start:])
+            low = None
+            chunk = chunk + 1
+        return result
+
+class ModelCollection:
+    # models of one class with hash indexes for equality lookups and sorted
+    # indexes for range queries on numeric fields, the indexed values of each
+    # model are kept so its entries can be found again after it changed
+    def __init__(self, cls, hash_indexes=(), sorted_indexes=()):
+        if not issubclass(cls, SchemaModel):
+            raise TypeError("Class must be a subclass of SchemaModel")
+        fields = getattr(cls, '__plan').fields
+        for name in itertools.chain(hash_indexes, sorted_indexes):
+            if not name in fields:
+                raise ValueError(str.format('index field "{}" is not defined in the schema of {}', name, cls.__name__))
+        for name in hash_indexes:
+            if fields[name]._nested:
+                raise TypeError(str.format('hash index field "{}" must hold scalar values', name))
+        for name in sorted_indexes:
+            if not isinstance(fields[name], (IntegerField, FloatField)):
+                raise TypeError(str.format('sorted index field "{}" must be an IntegerField or a FloatField', name))
+        self.cls = cls
+        self._names = tuple(dict.fromkeys(itertools.chain(hash_indexes, sorted_indexes)))
+        self._absent = (_ABSENT,) * len(self._names)
+        # value -> {id: model}
+        self._hashed = [(idx, {}) for idx, name in enumerate(self._names) if name in hash_indexes]
+        # keyed by (value, sequence number), the sequence number keeps equal
+        # values in insertion order and makes every key unique so a model's
+        # entry is found by bisection
+        self._sorted = [(idx, _SortedIndex()) for idx, name in enumerate(self._names) if name in sorted_indexes]
+        self._indexes = {self._names[idx]: index for idx, index in self._hashed}
+        self._ranges = {self._names[idx]: index for idx, index in self._sorted}
+        # id -> (model, indexed values, sequence number)
+        self._models = {}
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._models)
+
+    def __iter__(self):
+        return (entry[0] for entry in list(self._models.values()))
+
+    def __contains__(self, obj):
+        return id(obj) in self._models
+
+    def _values(self, obj):
+        if not isinstance(obj, self.cls):
+            raise TypeError(str.format('Model must be an instance of {}', self.cls.__name__))
+        return tuple(map(obj.__dict__.get, self._names, self._absent))
+
+    def _add_hashed(self, obj, values):
+        key = id(obj)
+        for idx, index in self._hashed:
+            value = values[idx]
+            if value is not _ABSENT:
+                try:
+                    index.setdefault(value, {})[key] = obj
+                except TypeError:
+                    pass
+
+    def _add_sorted(self, obj, values, seq):
+        for idx, index in self._sorted:
+            if _sortable(values[idx]):
+                index.insert((values[idx], seq), obj)
+
+    def _remove_entries(self, obj, values, seq):
+        key = id(obj)
+        for idx, index in self._hashed:
+            value = values[idx]
+            if value is not _ABSENT:
+                try:
+                    bucket = index.get(value)
+                except TypeError:
+                    continue
+                if bucket is not None:
+                    bucket.pop(key, None)
+                    if not bucket:
+                        del index[value]
+        for idx, index in self._sorted:
+            if _sortable(values[idx]):
+                index.delete((values[idx], seq))
+
+    def add(self, obj):
+        values = self._values(obj)
+        if not id(obj) in self._models:
+            seq = next(self._sequence)
+            self._models[id(obj)] = (obj, values, seq)
+            self._add_hashed(obj, values)
+            self._add_sorted(obj, values, seq)
+
+    def extend(self, models):
+        added = []
+        for obj in models:
+            values = self._values(obj)
+            if not id(obj) in self._models:
+                entry = (obj, values, next(self._sequence))
+                self._models[id(obj)] = entry
+                self._add_hashed(obj, values)
+                added.append(entry)
+        if len(added) < 8:
+            for obj, values, seq in added:
+                self._add_sorted(obj, values, seq)
+            return
+        # a large batch is merged into the sorted indexes with one sort each
+        for idx, index in self._sorted:
+            pairs = list(index.items())
+            pairs.extend([((values[idx], seq), obj) for obj, values, seq in added if _sortable(values[idx])])
+            index.build(pairs)
+
+    def load(self, source, **options):
+        # NDJSON from a path, a file or an iterable of json strings, see pipeline
+        self.extend(pipeline(self.cls, source, **options))
+
+    def remove(self, obj):
+        entry = self._models.pop(id(obj), None)
+        if entry is None:
+            raise KeyError(obj)
+        self._remove_entries(*entry)
+
+    def update(self, obj, **values):
+        if not id(obj) in self._models:
+            raise KeyError(obj)
+        for k, v in values.items():
+            setattr(obj, k, v)
+        self.reindex(obj)
+
+    def reindex(self, obj=None):
+        # picks up changes made to models without going through update
+        if obj is None:
+            for entry in list(self._models.values()):
+                self.reindex(entry[0])
+            return
+        entry = self._models.get(id(obj))
+        if entry is None:
+            raise KeyError(obj)
+        values = self._values(obj)
+        if any(map(operator.is_not, values, entry[1])):
+            self._remove_entries(*entry)
+            self._models[id(obj)] = (obj, values, entry[2])
+            self._add_hashed(obj, values)
+            self._add_sorted(obj, values, entry[2])
+
+    def lookup(self, name, value):
+        index = self._indexes.get(name)
+        if index is not None:
+            try:
+                return list(index.get(value, {}).values())
+            except TypeError:
+                return []
+        if name in self._ranges:
+            return self.between(name, value, value)
+        raise ValueError(str.format('field "{}" is not indexed', name))
+
+    def between(self, name, low=None, high=None):
+        # models with low <= value <= high in ascending order, either bound may be left open
+        if not name in self._ranges:
+            raise ValueError(str.format('field "{}" has no sorted index', name))
+        # (value,) sorts before and (value, inf) after every key holding value
+        return self._ranges[name].between(None if low is None else (low,), None if high is None else (high, math.inf))
+
+_CSV_BOOLS = {'true': True, 'false': False, '1': True, '0': False}
+
+def _csv_bool(s):
+    return _CSV_BOOLS[s.lower()]
+
+_CSV_CONVERTERS = (
+    (BoolField, _csv_bool),
+    (IntegerField, int),
+    (FloatField, float),
+    (StringField, None)
+)
+
+def _csv_field(cls, path):
+    # the scalar field at the end of a dotted path through ObjectFields
+    names = path.split('.')
+    field = None
+    for idx, name in enumerate(names):
+        if field is not None:
+            if not isinstance(field, ObjectField):
+                raise ValueError(str.format('csv column "{}" must only pass through ObjectFields', path))
+            cls = field.cls
+        field = getattr(cls, '__plan').fields.get(name)
+        if field is None:
+            if idx == 0 and len(names) == 1 and getattr(cls, '__plan').allow_unknowns:
+                return names, StringField()
+            raise ValueError(str.format('csv column "{}" is not defined in the schema', path))
+    if field._nested:
+        raise ValueError(str.format('csv column "{}" must be a scalar field', path))
+    return names, field
+
+def _csv_columns(cls, prefix='', seen=()):
+    # every scalar field path, ObjectFields are flattened unless they recurse
+    columns = []
+    for k, v in getattr(cls, '__plan').items:
+        if isinstance(v, ObjectField):
+            if not v.cls in seen and not v.cls is cls:
+                columns.extend(_csv_columns(v.cls, prefix + k + '.', seen + (cls,)))
+        elif not v._nested:
+            columns.append(prefix + k)
+    return columns
+
+def _csv_converter(field):
+    for field_type, converter in _CSV_CONVERTERS:
+        if isinstance(field, field_type):
+            return converter
+    return None
+
+def from_csv(cls, fp, delimiter=',', skip_invalid=False):
+    # yields a model per row, the header names the fields with dotted paths for
+    # ObjectFields, an empty cell leaves its field unset or None when it is
+    # required and nullable
+    if not issubclass(cls, SchemaModel):
+        raise TypeError("Class must be a subclass of SchemaModel")
+    rows = csv.reader(fp, delimiter=delimiter)
+    header = next(rows, None)
+    if header is None:
+        return iter(())
+    columns = []
+    for idx, path in enumerate(header):
+        names, field = _csv_field(cls, path)
+        columns.append((idx, names[:-1], names[-1], _csv_converter(field), field.required and field.nullable))
+    return _csv_records(cls, rows, tuple(columns), skip_invalid)
+
+def _csv_records(cls, rows, columns, skip_invalid):
+    for row in rows:
+        if len(row) == 0:
+            continue
+        d = {}
+        nulls = None
+        for idx, parents, name, converter, null in columns:
+            if idx >= len(row) or row[idx] == '':
+                if null:
+                    nulls = [] if nulls is None else nulls
+                    nulls.append((parents, name))
+                continue
+            value = row[idx]
+            if converter is not None:
+                try:
+                    value = converter(value)
+                except (ValueError, KeyError):
+                    # left as text for the validation to report
+                    pass
+            target = d
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[name] = value
+        if nulls is not None:
+            # None is written as an empty cell, a required field can only have
+            # held None, unless the model holding it was unset
+            for parents, name in nulls:
+                target = d
+                for parent in parents:
+                    target = target.get(parent)
+                    if target is None:
+                        break
+                else:
+                    target.setdefault(name, None)
+        try:
+            yield _deserialize_data(cls, d, None)
+        except ValidationError:
+            if not skip_invalid:
+                raise
+
+def _csv_text(value):
+    if value is None:
+        return ''
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, float):
+        return float.__repr__(value)
+    return str(value)
+
+def to_csv(models, fp, delimiter=',', columns=None, cls=None):
+    # writes the header and a validated row per model, returns the row count
+    models = iter(models)
+    if cls is None:
+        first = next(models, None)
+        if first is None:
+            return 0
+        cls = type(first)
+        models = itertools.chain((first,), models)
+    if columns is None:
+        columns = _csv_columns(cls)
+    paths = [_csv_field(cls, path)[0] for path in columns]
+    writer = csv.writer(fp, delimiter=delimiter)
+    writer.writerow(columns)
+    count = 0
+    for obj in models:
+        if not isinstance(obj, cls):
+            raise TypeError(str.format('Object must be an instance of {}', cls.__name__))
+        result, errors = obj.validate()
+        if not result:
+            raise ValidationError(errors)
+        row = []
+        for names in paths:
+            value = obj
+            for name in names:
+                value = value.__dict__.get(name) if isinstance(value, SchemaModel) else None
+            row.append(_csv_text(value))
+        writer.writerow(row)
+        count = count + 1
+    return count
+
+# the column kind of a field: array typecode for fixed width values, 's' for
+# utf-8 strings and 'j' for json
+_SHARED_KINDS = (
+    (BoolField, 'B', bool),
+    (IntegerField, 'q', int),
+    (FloatField, 'd', float),
+    (StringField, 's', str)
+)
+# status of a value in a column
+_SHARED_ABSENT = 0
+_SHARED_NULL = 1
+_SHARED_VALUE = 2
+_SHARED_EXTRA = 3
+
+def _shared_kind(field):
+    for field_type, kind, value_type in _SHARED_KINDS:
+        if isinstance(field, field_type):
+            return kind, value_type
+    return 'j', None
+
+def _shared_align(size):
+    return (size + 7) & ~7
+
+class SharedBatch:
+    # models of one class laid out by their schema in a shared memory block, a
+    # status byte and a fixed width or offset addressed value per field, values
+    # that do not fit their column and unknown attributes are kept as json,
+    # every column is read in place through a view of the block
+    def __init__(self, cls, shm, owner):
+        self.cls = cls
+        self.shm = shm
+        self.name = shm.name
+        self._owner = owner
+        self._columns = []
+        buf = shm.buf
+        header_size = int.from_bytes(buf[:8], 'little')
+        header = json.loads(str(buf[8:8 + header_size], 'utf-8'))
+        plan = getattr(cls, '__plan')
+        if [tuple(column[:2]) for column in header['columns']] != [(k, _shared_kind(v)[0]) for k, v in plan.items]:
+            raise TypeError(str.format('shared batch {} does not match the schema of {}', self.name, cls.__name__))
+        count = header['count']
+        base = _shared_align(8 + header_size)
+        self._count = count
+        self._columns = []
+        for name, kind, status, values, offsets, data in header['columns']:
+            if values is not None:
+                width = 8 if kind == 'q' or kind == 'd' else 1
+                values = buf[base + values:base + values + width * count].cast(kind if width == 8 else 'B')
+            if offsets is not None:
+                offsets = buf[base + offsets:base + offsets + 8 * (count + 1)].cast('Q')
+                data = buf[base + data:base + data + offsets[count]]
+            self._columns.append((name, kind, plan.fields[name], buf[base + status:base + status + count], values, offsets, data))
+        offsets, data = header['extras']
+        offsets = buf[base + offsets:base + offsets + 8 * (count + 1)].cast('Q')
+        self._extras = (offsets, buf[base + data:base + data + offsets[count]])
+
+    def __len__(self):
+        return self._count
+
+    def __reduce__(self):
+        # only the class and the block's name cross process boundaries
+        return (attach_batch, (self.cls, self.name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if self._owner:
+            self.shm.unlink()
+
+    def __del__(self):
+        if self._columns:
+            self.close()
+
+    def close(self):
+        # the views must be released before the block can be closed
+        for column in self._columns:
+            for view in column[3:]:
+                if view is not None:
+                    view.release()
+        self._columns = []
+        for view in self._extras:
+            view.release()
+        self._extras = ()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+    def ranges(self, parts):
+        return _ranges(self._count, parts)
+
+    def column(self, name):
+        # (status, values) views of a bool, int or float field, read in place
+        for column in self._columns:
+            if column[0] == name:
+                if column[5] is not None:
+                    raise TypeError(str.format('field "{}" has no fixed width column', name))
+                return column[3], column[4]
+        raise KeyError(name)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._decode(idx) for idx in range(*key.indices(self._count))]
+        if key < 0:
+            key = key + self._count
+        if not 0 <= key < self._count:
+            raise IndexError('shared batch index out of range')
+        return self._decode(key)
+
+    def __iter__(self):
+        return (self._decode(idx) for idx in range(self._count))
+
+    def iter_range(self, start, stop):
+        return (self._decode(idx) for idx in range(start, stop))
+
+    def _decode(self, idx):
+        obj = self.cls()
+        instance_attrs = obj.__dict__
+        for name, kind, field, status, values, offsets, data in self._columns:
+            state = status[idx]
+            if state == _SHARED_VALUE:
+                if offsets is None:
+                    value = values[idx]
+                    instance_attrs[name] = value == 1 if kind == 'B' else value
+                elif kind == 's':
+                    instance_attrs[name] = str(data[offsets[idx]:offsets[idx + 1]], 'utf-8')
+                else:
+                    instance_attrs[name] = _build_value(field, json.loads(str(data[offsets[idx]:offsets[idx + 1]], 'utf-8')))
+            elif state == _SHARED_NULL:
+                instance_attrs[name] = None
+        offsets, data = self._extras
+        if offsets[idx] != offsets[idx + 1]:
+            fields = getattr(self.cls, '__plan').fields
+            for k, v in json.loads(str(data[offsets[idx]:offsets[idx + 1]], 'utf-8')).items():
+                instance_attrs[k] = _build_value(fields[k], v) if k in fields else v
+        plan = getattr(self.cls, '__plan')
+        if len(plan.strings) > 0:
+            _intern_strings(plan, instance_attrs)
+        return obj
+
+def _shared_columns(cls, models):
+    # (name, kind, status, values) per field, values being an array, a
+    # bytearray of bools or a list of encoded values, and the extras per model
+    columns = []
+    for k, v in getattr(cls, '__plan').items:
+        kind, value_type = _shared_kind(v)
+        values = array.array(kind) if kind == 'q' or kind == 'd' else ([] if kind == 's' or kind == 'j' else bytearray())
+        columns.append((k, kind, value_type, bytearray(), values))
+    extras = []
+    known = getattr(cls, '__plan').known
+    for obj in models:
+        if not isinstance(obj, cls):
+            raise TypeError(str.format('Object must be an instance of {}', cls.__name__))
+        instance_attrs = obj.__dict__
+        extra = {}
+        for name, kind, value_type, status, values in columns:
+            value = instance_attrs.get(name, _UNSET)
+            if value is _UNSET or value is None:
+                status.append(_SHARED_ABSENT if value is _UNSET else _SHARED_NULL)
+                encoded = 0 if kind != 's' and kind != 'j' else b''
+            elif kind == 'j':
+                status.append(_SHARED_VALUE)
+                if isinstance(value, SchemaModel):
+                    value = value.to_json_obj()
+                elif isinstance(value, list):
+                    value = _encode_iterative(value, [])
+                encoded = _json_dumps(value).encode('utf-8')
+            elif type(value) is not value_type or (kind == 'q' and not _MIN_INT <= value <= _MAX_INT):
+                status.append(_SHARED_EXTRA)
+                extra[name] = value
+                encoded = 0 if kind != 's' else b''
+            else:
+                status.append(_SHARED_VALUE)
+                encoded = value.encode('utf-8', 'surrogatepass') if kind == 's' else value
+            values.append(encoded)
+        if not known.issuperset(instance_attrs):
+            for k, v in instance_attrs.items():
+                if not k in known:
+                    extra[k] = v.to_json_obj() if isinstance(v, SchemaModel) else v
+        extras.append(_json_dumps(extra).encode('utf-8') if extra else b'')
+    return columns, extras
+
+def _shared_offsets(encoded):
+    offsets = array.array('Q', [0])
+    size = 0
+    for value in encoded:
+        size = size + len(value)
+        offsets.append(size)
+    return offsets
+
+def share_batch(cls, models):
+    # copies models into a new shared memory block, the caller unlinks it
+    if not issubclass(cls, SchemaModel):
+        raise TypeError("Class must be a subclass of SchemaModel")
+    # imported here, it only exists on Python 3.8+
+    from multiprocessing import shared_memory
+    columns, extras = _shared_columns(cls, models)
+
+    # the block holds the header size, the json header and then every part 8
+    # byte aligned, the header gives the parts' positions after itself
+    parts = []
+
+    def place(part):
+        parts.append(memoryview(part).cast('B') if not isinstance(part, bytes) else part)
+        return sum(_shared_align(len(p)) for p in parts[:-1])
+
+    layout = []
+    for name, kind, value_type, status, values in columns:
+        if kind == 's' or kind == 'j':
+            layout.append([name, kind, place(status), None, place(_shared_offsets(values)), place(b''.join(values))])
+        else:
+            layout.append([name, kind, place(status), place(values), None, None])
+    header = json.dumps({
+        'count': len(extras),
+        'columns': layout,
+        'extras': [place(_shared_offsets(extras)), place(b''.join(extras))]
+    }).encode('utf-8')
+
+    base = _shared_align(8 + len(header))
+    size = base + sum(_shared_align(len(p)) for p in parts)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        buf = shm.buf
+        buf[:8] = len(header).to_bytes(8, 'little')
+        buf[8:8 + len(header)] = header
+        position = base
+        for part in parts:
+            buf[position:position + len(part)] = part
+            position = position + _shared_align(len(part))
+        return SharedBatch(cls, shm, True)
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+def attach_batch(cls, name):
+    # maps a block made by share_batch, typically in a worker process
+    if not issubclass(cls, SchemaModel):
+        raise TypeError("Class must be a subclass of SchemaModel")
+    from multiprocessing import shared_memory
+    return SharedBatch(cls, shared_memory.SharedMemory(name=name), False)
+
+# optional nested models and lists are left out below this depth
+_GENERATE_DEPTH = 4
+# maps random bytes to letters and digits
+_GENERATE_LETTERS = bytes((b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789' * 5)[:256])
+
+def _generate_int(rng, low, high):
+    # random.randint is exact for any span but several times slower
+    span = high - low + 1
+    if span > 1 << 53:
+        return lambda: rng.randint(low, high)
+    random = rng.random
+    return lambda: low + int(random() * span)
+
+def _generate_string(rng):
+    random = rng.random
+    getrandbits = rng.getrandbits
+    def gen():
+        length = 4 + int(random() * 9)
+        return getrandbits(8 * length).to_bytes(length, 'little').translate(_GENERATE_LETTERS).decode('ascii')
+    return gen
+
+# allowed sets up to this size are filtered up front, larger ones are drawn
+# from until a value passes
+_GENERATE_CHOICES = 10000
+
+def _generate_choices(field, rng, name):
+    allowed = field.allowed
+    if allowed._size > _GENERATE_CHOICES:
+        def draw():
+            for attempt in range(100):
+                value = allowed._pick(rng)
+                if field.is_valid(name, value)[0]:
+                    return value
+            raise ValueError(str.format('Field "{}" has no allowed value that is valid', name))
+        return draw
+    # the allowed values that pass the rest of the field's checks
+    choices = [v for v in allowed if field.is_valid(name, v)[0]]
+    if not choices:
+        raise ValueError(str.format('Field "{}" has no allowed value that is valid', name))
+    return lambda: rng.choice(choices)
+
+def _generate_scalar(field, rng, name):
+    if field.allowed:
+        return _generate_choices(field, rng, name)
+    if isinstance(field, BoolField):
+        return lambda: rng.random() < 0.5
+    if isinstance(field, IntegerField):
+        gen = _generate_int(rng, field.min, field.max)
+    elif isinstance(field, FloatField):
+        low, high = float(field.min), float(field.max)
+        gen = lambda: rng.uniform(low, high)
+    elif isinstance(field, StringField):
+        gen = _generate_string(rng)
+    else:
+        gen = _generate_int(rng, 0, 1000)
+    if not field.forbidden:
+        return gen
+    forbidden = field.forbidden
+    def permitted():
+        for attempt in range(100):
+            value = gen()
+            if not value in forbidden:
+                return value
+        raise ValueError(str.format('Field "{}" forbids every generated value', name))
+    return permitted
+
+def _generate_union(field, rng, models, depth):
+    # a model of a randomly picked class, its key field set to the value mapped to it
+    choices = [(tag, _generate_model(cls, rng, models, depth + 1)) for tag, cls in field.mapping.items()]
+    key = field.key
+    def gen():
+        tag, record = rng.choice(choices)
+        record = record()
+        (record.__dict__ if models else record)[key] = tag
+        return record
+    return gen
+
+def _generate_dict(field, rng, name, models, depth):
+    # keys are drawn until the length is reached or they keep colliding
+    key = _generate_scalar(field.key_field, rng, name)
+    value = _generate_field(field.value_field, rng, name, models, depth + 1)
+    length = _generate_int(rng, field.min_length, min(field.max_length, field.min_length + 4))
+    def gen():
+        d = {}
+        wanted = length()
+        for attempt in range(100 * (wanted + 1)):
+            if len(d) >= wanted:
+                break
+            d[key()] = value()
+        if models and field.lazy:
+            return LazyDict(field, d, set())
+        return d
+    return gen
+
+def _generate_field(field, rng, name, models, depth):
+    if isinstance(field, ObjectField):
+        gen = _generate_model(field.cls, rng, models, depth + 1)
+    elif isinstance(field, UnionField):
+        gen = _generate_union(field, rng, models, depth)
+    elif isinstance(field, DictField) and depth >= _GENERATE_DEPTH and field.min_length == 0:
+        gen = lambda: {}
+    elif isinstance(field, DictField):
+        gen = _generate_dict(field, rng, name, models, depth)
+    elif isinstance(field, ListField) and depth >= _GENERATE_DEPTH and field.min_length == 0 and len(field.type_mapping) == 1:
+        gen = lambda: []
+    elif isinstance(field, ListField):
+        elements = [_generate_field(t, rng, name, models, depth + 1) for t in field.type_mapping]
+        if len(elements) > 1:
+            gen = lambda: [element() for element in elements]
+        else:
+            element = elements[0]
+            length = _generate_int(rng, field.min_length, min(field.max_length, field.min_length + 4))
+            gen = lambda: [element() for i in range(length())]
+    else:
+        gen = _generate_scalar(field, rng, name)
+    if field.nullable:
+        return lambda: None if rng.random() < 0.1 else gen()
+    return gen
+
+def _generate_model(cls, rng, models, depth):
+    plan = getattr(cls, '__plan')
+    fields = []
+    for k, v in plan.items:
+        if v._nested and not v.required and depth >= _GENERATE_DEPTH:
+            continue
+        if v._nested and v.nullable and depth >= _GENERATE_DEPTH:
+            fields.append((k, True, lambda: None))
+            continue
+        fields.append((k, v.required, _generate_field(v, rng, k, models, depth)))
+    random = rng.random
+    def gen():
+        d = {k: field() for k, required, field in fields if required or random() < 0.9}
+        if not models:
+            return d
+        obj = plan()
+        obj.__dict__.update(d)
+        return obj
+    return gen
+
+def _generate_violations(cls):
+    # the ways a record of cls can be made invalid, one is picked per record
+    plan = getattr(cls, '__plan')
+    violations = []
+    for k, v in plan.items:
+        if v._value_type is not object:
+            violations.append(('type', k, v))
+        if not v.nullable:
+            violations.append(('null', k, v))
+        if v.required:
+            violations.append(('missing', k, v))
+        if isinstance(v, (IntegerField, FloatField)) and (v.min > _MIN_INT or v.max < _MAX_INT):
+            violations.append(('bounds', k, v))
+        if v.forbidden:
+            violations.append(('forbidden', k, v))
+        if isinstance(v, ListField) and len(v.type_mapping) == 1 and v.max_length < 1000:
+            violations.append(('length', k, v))
+    if not plan.allow_unknowns:
+        violations.append(('unknown', '_generated', None))
+    return violations
+
+def _violate(d, violation, rng, models):
+    kind, k, field = violation
+    if kind == 'type':
+        d[k] = 12345 if isinstance(field, StringField) else 'invalid'
+    elif kind == 'null':
+        d[k] = None
+    elif kind == 'missing':
+        d.pop(k, None)
+    elif kind == 'bounds':
+        value = field.max + 1 if field.max < _MAX_INT else field.min - 1
+        d[k] = float(value) if isinstance(field, FloatField) else value
+    elif kind == 'forbidden':
+        d[k] = field.forbidden._pick(rng)
+    elif kind == 'length':
+        element = _generate_field(field.type_mapping[0], rng, k, models, _GENERATE_DEPTH)
+        d[k] = [element() for i in range(field.max_length + 1)]
+    else:
+        d[k] = True
+
+def generate(cls, n, seed=None, invalid_ratio=0.0, json_lines=False):
+    # n random instances of cls, or their json lines, drawn from the schema,
+    # about invalid_ratio of them break exactly one rule
+    if not issubclass(cls, SchemaModel):
+        raise TypeError("Class must be a subclass of SchemaModel")
+    if not 0.0 <= invalid_ratio <= 1.0:
+        raise ValueError('"invalid_ratio" must be between 0 and 1')
+    rng = random.Random(seed)
+    records = _generate_model(cls, rng, not json_lines, 0)
+    violations = _generate_violations(cls) if invalid_ratio > 0 else []
+    return _generated(n, rng, records, violations, invalid_ratio, json_lines)
+
+def _generated(n, rng, records, violations, invalid_ratio, json_lines):
+    for i in range(n):
+        record = records()
+        if violations and rng.random() < invalid_ratio:
+            _violate(record if json_lines else record.__dict__, rng.choice(violations), rng, not json_lines)
+        if json_lines:
+            yield _json_dumps(record)
+        else:
+            yield record
+
+def snapshot(obj):
+    if not isinstance(obj, SchemaModel):
+        raise TypeError("Object must be an instance of a SchemaModel")
+    return obj.to_json_obj()
+
+def _json_equal(a, b):
+    # == alone treats 1, 1.0 and True as the same value
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if type(a) is not type(b):
+            return False
+        if type(a) is list:
+            if len(a) != len(b):
+                return False
+            stack.extend(zip(a, b))
+        elif type(a) is dict:
+            if a.keys() != b.keys():
+                return False
+            for k, v in a.items():
+                stack.append((v, b[k]))
+        elif a != b:
+            return False
+    return True
+
+def _diff_json_obj(cls, old, new):
+    sets = {}
+    unsets = []
+    stack = [('', cls, old, new)]
+    while stack:
+        prefix, cls, old, new = stack.pop()
+        schema = getattr(cls, '__schema')
+        for k, v in new.items():
+            if k in old:
+                old_v = old[k]
+                if _json_equal(old_v, v):
+                    continue
+                field = schema.get(k)
+                if isinstance(field, ObjectField) and isinstance(old_v, dict) and isinstance(v, dict):
+                    stack.append((prefix + k + '.', field.cls, old_v, v))
+                    continue
+            sets[prefix + k] = v
+        for k in old:
+            if not k in new:
+                unsets.append(prefix + k)
+    return sets, unsets
+
+def _patch_target(obj, path):
+    # walks the ObjectFields of a dotted path, returns the model owning its last name
+    names = path.split('.')
+    target = obj
+    for idx in range(len(names) - 1):
+        field = getattr(target, '__schema').get(names[idx])
+        if not isinstance(field, ObjectField):
+            return None, None, str.format('patch path "{}" must only pass through ObjectFields', path)
+        target = target.__dict__.get(names[idx])
+        if not isinstance(target, SchemaModel):
+            return None, None, str.format('patch path "{}" has no object at "{}"', path, '.'.join(names[:idx + 1]))
+    return target, names[-1], None
+
+_UNSET = object()
+
+def _stage_patch(obj, sets, unsets):
+    # validates only the touched fields, returns the changes to apply and the errors
+    changes = []
+    errors = []
+    for path, value in sets.items():
+        target, name, error = _patch_target(obj, path)
+        if error is not None:
+            errors.append(error)
+            continue
+        plan = getattr(target, '__plan')
+        field = plan.fields.get(name)
+        if field is None:
+            if not plan.allow_unknowns:
+                errors.append(str.format('unknown fields not permitted, attribute must be defined in schema: {}', path))
+                continue
+        else:
+            if isinstance(field, (ObjectField, UnionField)) and isinstance(value, dict) and field._payload_cls(value) is not None:
+                value = _instantiate_obj_field(field._payload_cls(value), value)
+            elif isinstance(field, ListField) and isinstance(value, list):
+                value = _instantiate_list_field(field, value)
+            elif isinstance(field, DictField) and isinstance(value, dict):
+                value = field._build(value)
+            elif field._interns():
+                value = field._canonical(value)
+            result, field_errors = field.is_valid(path, value)
+            if not result:
+                errors.extend(field_errors)
+                continue
+        changes.append((target, name, value))
+    for path in unsets:
+        target, name, error = _patch_target(obj, path)
+        if error is not None:
+            errors.append(error)
+            continue
+        field = getattr(target, '__plan').fields.get(name)
+        if field is not None and field.required:
+            errors.append(str.format('required field is missing: {}', path))
+            continue
+        changes.append((target, name, _UNSET))
+    return changes, errors
+
+def diff(old, new):
+    if not isinstance(new, SchemaModel):
+        raise TypeError("Object must be an instance of a SchemaModel")
+    if isinstance(old, SchemaModel):
+        old = old.to_json_obj()
+    elif not isinstance(old, dict):
+        raise TypeError("Old state must be an instance of a SchemaModel or a snapshot")
+    sets, unsets = _diff_json_obj(type(new), old, new.to_json_obj())
+    changes, errors = _stage_patch(new, sets, unsets)
+    if len(errors) > 0:
+        raise ValidationError(errors)
+    patch = {}
+    if len(sets) > 0:
+        patch['set'] = sets
+    if len(unsets) > 0:
+        patch['unset'] = unsets
+    return _json_dumps(patch)
+
+def apply_patch(obj, patch_json):
+    if not isinstance(obj, SchemaModel):
+        raise TypeError("Object must be an instance of a SchemaModel")
+    patch = _json_loads(patch_json)
+    if not isinstance(patch, dict) or not set(patch.keys()) <= {'set', 'unset'}:
+        raise ValueError('patch must be an object with "set" and/or "unset" members')
+    sets = patch.get('set', {})
+    unsets = patch.get('unset', [])
+    if not isinstance(sets, dict) or not isinstance(unsets, list) or not all(isinstance(path, str) for path in unsets):
+        raise ValueError('patch "set" must map paths to values and "unset" must list paths')
+
+    # nothing is written unless every touched field is valid
+    changes, errors = _stage_patch(obj, sets, unsets)
+    if len(errors) > 0:
+        raise ValidationError(errors)
+    for target, name, value in changes:
+        if target._frozen_state is not None:
+            raise AttributeError(str.format('cannot patch "{}", {} is frozen', name, type(target).__name__))
+    for target, name, value in changes:
+        if value is _UNSET:
+            target.__dict__.pop(name, None)
+        else:
+            target.__dict__[name] = value
+    return obj
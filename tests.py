@@ -1,4 +1,16 @@
+import concurrent.futures
+import copy
+import copyreg
+import gzip
+import io
+import json
+import os
+import pathlib
+import pickle
 import psm
+import sys
+import tempfile
+import threading
 import unittest
 
 class is_built_in_name_tests(unittest.TestCase):
@@ -1001,5 +1013,1823 @@ class ObjectField_tests(unittest.TestCase):
         self.assertIsInstance(m1.obj_field, SubModel)
         self.assertEqual(m1.obj_field.field, 'greetings')
 
+class DeepNesting_tests(unittest.TestCase):
+    def nested_list_model(self, depth):
+        field = psm.ListField(type_mapping=[psm.IntegerField()])
+        for i in range(depth - 1):
+            field = psm.ListField(type_mapping=[field])
+
+        class Model(psm.SchemaModel):
+            data = field
+
+        return Model
+
+    def test_deep_nested_lists(self):
+        Model = self.nested_list_model(10000)
+        m1_str = '{"data": ' + '[' * 10000 + '1' + ']' * 10000 + '}'
+        m1 = psm.deserialize(Model, m1_str)
+        self.assertEqual(m1_str, psm.serialize(m1))
+
+        with self.assertRaises(psm.ValidationError) as context:
+            psm.deserialize(Model, '{"data": ' + '[' * 10000 + '"1"' + ']' * 10000 + '}')
+        self.assertEqual(['invalid type: list, expected: ListField for Field "data"'], context.exception.errors)
+
+    def test_deep_nested_objects(self):
+        class Model(psm.SchemaModel):
+            value = psm.IntegerField(required=True)
+
+        for i in range(2000):
+            Model = psm.Schema('Model', (psm.SchemaModel,), {
+                'value': psm.IntegerField(required=True),
+                'child': psm.ObjectField(Model, required=True)
+            })
+
+        m1_str = '{"value": 0, "child": ' * 2000 + '{"value": 0}' + '}' * 2000
+        m1 = psm.deserialize(Model, m1_str)
+        self.assertEqual(m1_str, psm.serialize(m1))
+
+        with self.assertRaises(psm.ValidationError) as context:
+            psm.deserialize(Model, m1_str.replace('{"value": 0}', '{}'))
+        self.assertEqual(['required field is missing: value'], context.exception.errors)
+
+    def test_iterative_matches_recursive(self):
+        class SubModel(psm.SchemaModel):
+            a = psm.IntegerField(required=True, _max=10)
+            b = psm.ListField(type_mapping=[psm.ListField(type_mapping=[psm.FloatField()], max_length=1)])
+
+        class Model(psm.SchemaModel):
+            obj = psm.ObjectField(SubModel, required=True)
+            objs = psm.ListField(type_mapping=[psm.ObjectField(SubModel)], min_length=3)
+            mixed = psm.ListField(type_mapping=[psm.IntegerField(), psm.ObjectField(SubModel)])
+            flag = psm.BoolField()
+
+        data = {
+            'obj': {'a': 11, 'b': [[1.0, 2.0], ['x'], None]},
+            'objs': [{'a': 1, 'b': [[0.5]]}, {'b': []}],
+            'mixed': [1, {'a': 2, 'c': 3}],
+            'flag': 'yes'
+        }
+        m1 = psm._build_obj_field(Model, data)
+        m2 = psm._build_iterative(Model, data, Model())
+        self.assertEqual(m1.to_json_obj(), m2.to_json_obj())
+        self.assertEqual(m1.to_json_obj(), psm._encode_iterative(m1, {}))
+
+        result, errors = m1.validate()
+        self.assertFalse(result)
+        self.assertEqual((result, errors), psm._run_checks(psm._ModelCheck(m1)))
+
+        with self.assertRaises(TypeError):
+            psm._build_iterative(Model, {'mixed': [1]}, Model())
+
+        m1_str = json.dumps(m1.to_json_obj())
+        self.assertEqual(m1_str, psm._dumps_iterative(m1.to_json_obj()))
+        self.assertEqual(json.loads(m1_str), psm._loads_iterative(m1_str))
+
+    def test_circular_reference(self):
+        class Model(psm.SchemaModel, allow_unknowns=True):
+            field = psm.IntegerField()
+
+        m1 = Model(field=1)
+        m1.itself = m1
+        with self.assertRaises(ValueError):
+            m1.to_json_obj()
+
+        class Node(Model):
+            child = psm.ObjectField(Model)
+
+        m2 = Node(field=1)
+        m2.child = Node(child=m2)
+        with self.assertRaises(ValueError):
+            m2.validate()
+
+class SchemaPlan_tests(unittest.TestCase):
+    def test_inherited_fields(self):
+        class Model(psm.SchemaModel):
+            field = psm.IntegerField(required=True)
+            other = psm.StringField()
+
+        class SubModel(Model):
+            other = psm.BoolField()
+            sub_field = psm.StringField(required=True)
+
+        m1 = SubModel(sub_field='str')
+        missing_result, missing_errors = m1.validate()
+        self.assertFalse(missing_result)
+        self.assertEqual(['required field is missing: field'], missing_errors)
+
+        m2 = psm.deserialize(SubModel, '{"sub_field": "str", "field": 1, "other": true}')
+        self.assertEqual('{"field": 1, "other": true, "sub_field": "str"}', psm.serialize(m2))
+
+        with self.assertRaises(psm.ValidationError):
+            psm.deserialize(SubModel, '{"sub_field": "str", "field": 1, "other": "str"}')
+
+    def test_plan(self):
+        class SubModel(psm.SchemaModel):
+            field = psm.StringField()
+
+        class Model(psm.SchemaModel, allow_unknowns=True):
+            a = psm.IntegerField(required=True)
+            b = psm.ObjectField(SubModel)
+            c = psm.ListField(type_mapping=[psm.IntegerField()], required=True)
+
+        class SubClassModel(Model):
+            d = psm.FloatField()
+
+        plan = psm.schema_plan(SubClassModel)
+        self.assertIs(plan, psm.schema_plan(SubClassModel()))
+        self.assertEqual(['a', 'b', 'c', 'd'], list(plan.fields))
+        self.assertEqual(frozenset(['a', 'c']), plan.required)
+        self.assertEqual(frozenset(['a', 'b', 'c', 'd']), plan.known)
+        self.assertEqual(('b', 'c'), plan.nested_names)
+        self.assertTrue(plan.allow_unknowns)
+        self.assertEqual(['d'], list(plan.declared))
+
+        with self.assertRaises(TypeError):
+            psm.schema_plan(1)
+
+    def test_unknown_field_errors(self):
+        class Model(psm.SchemaModel):
+            field = psm.IntegerField()
+
+        m1 = Model(field=1, greeting='hello')
+        result, errors = m1.validate()
+        self.assertFalse(result)
+        self.assertEqual(['unknown fields not permitted, attribute must be defined in schema: greeting'], errors)
+
+class Patch_tests(unittest.TestCase):
+    def models(self):
+        class SubModel(psm.SchemaModel):
+            level = psm.IntegerField(required=True, _min=0, _max=60)
+            time = psm.FloatField(nullable=True)
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        class Model(psm.SchemaModel):
+            name = psm.StringField(required=True, forbidden=['bob'])
+            sub = psm.ObjectField(SubModel)
+            flag = psm.BoolField()
+
+        return SubModel, Model
+
+    def test_diff(self):
+        SubModel, Model = self.models()
+        m1 = Model(name='john', sub=SubModel(level=1, time=1.0, tags=[]), flag=True)
+        snap = psm.snapshot(m1)
+        self.assertEqual('{}', psm.diff(snap, m1))
+
+        m1.sub.level = 2
+        m1.sub.tags.append('new')
+        del m1.sub.time
+        self.assertEqual('{"set": {"sub.level": 2, "sub.tags": ["new"]}, "unset": ["sub.time"]}', psm.diff(snap, m1))
+
+        # a changed type is a change even when the values compare equal
+        m2 = Model(name='john', flag=1)
+        m3 = Model(name='john', flag=True)
+        self.assertEqual('{"set": {"flag": true}}', psm.diff(m2, m3))
+
+        m4 = Model(name='john', sub=SubModel(level=1), flag=1)
+        self.assertEqual('{"set": {"sub": {"level": 1}}}', psm.diff(m2, m4))
+
+        m4.sub.level = 100
+        with self.assertRaises(psm.ValidationError):
+            psm.diff(m2, m4)
+
+    def test_apply_patch(self):
+        SubModel, Model = self.models()
+        m1 = psm.deserialize(Model, '{"name": "john", "sub": {"level": 1, "time": null}}')
+        psm.apply_patch(m1, '{"set": {"sub.level": 2, "flag": false}, "unset": ["sub.time"]}')
+        self.assertEqual('{"name": "john", "sub": {"level": 2}, "flag": false}', psm.serialize(m1))
+
+        psm.apply_patch(m1, '{"set": {"sub": {"level": 3, "tags": ["a"]}}}')
+        self.assertIsInstance(m1.sub, SubModel)
+        self.assertEqual(['a'], m1.sub.tags)
+
+    def test_apply_patch_invalid(self):
+        SubModel, Model = self.models()
+        m1 = psm.deserialize(Model, '{"name": "john"}')
+        with self.assertRaises(psm.ValidationError) as context:
+            psm.apply_patch(m1, '{"set": {"flag": true, "name": "bob", "greeting": "hello", "sub.level": 1}, "unset": ["name"]}')
+        self.assertEqual([
+            'Field "name" is not a permitted value',
+            'unknown fields not permitted, attribute must be defined in schema: greeting',
+            'patch path "sub.level" has no object at "sub"',
+            'required field is missing: name'
+        ], context.exception.errors)
+        # nothing is applied when any part of the patch is invalid
+        self.assertEqual('{"name": "john"}', psm.serialize(m1))
+
+        with self.assertRaises(ValueError):
+            psm.apply_patch(m1, '{"replace": {}}')
+        with self.assertRaises(ValueError):
+            psm.apply_patch(m1, '{"unset": "name"}')
+
+class StringInterning_tests(unittest.TestCase):
+    def test_intern_field(self):
+        class Model(psm.SchemaModel):
+            interned = psm.StringField(intern=True)
+            plain = psm.StringField()
+
+        m1 = psm.deserialize(Model, '{"interned": "a value of some length", "plain": "a value of some length"}')
+        m2 = psm.deserialize(Model, '{"interned": "a value of some length", "plain": "a value of some length"}')
+        self.assertIs(m1.interned, m2.interned)
+        self.assertIsNot(m1.plain, m2.plain)
+
+    def test_intern_allowed(self):
+        allowed = [''.join(['lord of ', 'goats']), ''.join(['first ', 'wave'])]
+
+        class Model(psm.SchemaModel):
+            field = psm.StringField(allowed=allowed, intern=True)
+            tags = psm.ListField(type_mapping=[psm.StringField(allowed=allowed, intern=True)])
+
+        m1 = psm.deserialize(Model, '{"field": "lord of goats", "tags": ["first wave", "lord of goats"]}')
+        self.assertIs(allowed[0], m1.field)
+        self.assertIs(allowed[1], m1.tags[0])
+        self.assertIs(allowed[0], m1.tags[1])
+
+        m2 = psm._build_iterative(Model, {'field': 'first wave', 'tags': ['lord of goats']}, Model())
+        self.assertIs(allowed[1], m2.field)
+        self.assertIs(allowed[0], m2.tags[0])
+
+        with self.assertRaises(psm.ValidationError):
+            psm.deserialize(Model, '{"field": "smeller of cheese"}')
+
+    def test_intern_global(self):
+        class Model(psm.SchemaModel):
+            field = psm.StringField()
+            opt_out = psm.StringField(intern=False)
+
+        data = '{"field": "a value of some length", "opt_out": "a value of some length"}'
+        psm.set_string_interning(True)
+        try:
+            m1 = psm.deserialize(Model, data)
+            m2 = psm.deserialize(Model, data)
+        finally:
+            psm.set_string_interning(False)
+        self.assertIs(m1.field, m2.field)
+        self.assertIsNot(m1.opt_out, m2.opt_out)
+
+        m3 = psm.deserialize(Model, data)
+        self.assertIsNot(m1.field, m3.field)
+
+class SharedObjects_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Address(psm.SchemaModel, frozen=True):
+            street = psm.StringField(required=True)
+            geo = psm.ListField(type_mapping=[psm.FloatField()])
+
+        class User(psm.SchemaModel):
+            name = psm.StringField()
+            address = psm.ObjectField(Address)
+            previous = psm.ListField(type_mapping=[psm.ObjectField(Address)])
+
+        self.Address = Address
+        self.User = User
+
+    def test_shared_instances(self):
+        shared = psm.SharedObjects([self.Address])
+        u1 = psm.deserialize(self.User, '{"name": "a", "address": {"street": "main", "geo": [1.0, 2.0]}, "previous": [{"geo": [1.0, 2.0], "street": "main"}]}', shared=shared)
+        u2 = psm.deserialize(self.User, '{"name": "b", "address": {"street": "main", "geo": [1.0, 2.0]}}', shared=shared)
+        self.assertIs(u1.address, u1.previous[0])
+        self.assertIs(u1.address, u2.address)
+        self.assertEqual(2, shared.hits)
+        self.assertEqual(1, shared.misses)
+        self.assertEqual(1, len(shared))
+        self.assertEqual('{"name": "b", "address": {"street": "main", "geo": [1.0, 2.0]}}', psm.serialize(u2))
+
+    def test_invalid_not_shared(self):
+        shared = psm.SharedObjects([self.Address])
+        for _ in range(2):
+            with self.assertRaises(psm.ValidationError):
+                psm.deserialize(self.User, '{"address": {"geo": [1.0]}}', shared=shared)
+        self.assertEqual(0, len(shared))
+        self.assertEqual(0, shared.hits)
+
+    def test_lru_bound(self):
+        shared = psm.SharedObjects([self.Address], maxsize=2)
+        for street in ['a', 'b', 'c', 'a']:
+            psm.deserialize(self.User, '{"address": {"street": "%s"}}' % street, shared=shared)
+        self.assertEqual(2, len(shared))
+        self.assertEqual(0, shared.hits)
+
+        with self.assertRaises(TypeError):
+            psm.SharedObjects([dict])
+        with self.assertRaises(TypeError):
+            psm.SharedObjects([self.User])
+        with self.assertRaises(ValueError):
+            psm.SharedObjects([self.Address], maxsize=0)
+
+    def test_shared_instances_are_not_changed(self):
+        shared = psm.SharedObjects([self.Address])
+        u1 = psm.deserialize(self.User, '{"address": {"street": "main"}}', shared=shared)
+        u2 = psm.deserialize(self.User, '{"address": {"street": "main"}}', shared=shared)
+        psm.deserialize_into(u1, '{"address": {"street": "side"}}')
+        self.assertEqual('main', u2.address.street)
+        self.assertIsNot(u1.address, u2.address)
+        with self.assertRaises(AttributeError):
+            psm.apply_patch(u2, '{"set": {"address.street": "rome"}}')
+        self.assertEqual('main', psm.deserialize(self.User, '{"address": {"street": "main"}}', shared=shared).address.street)
+
+class FrozenModel_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Config(psm.SchemaModel, frozen=True):
+            name = psm.StringField(required=True)
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        class Owner(psm.SchemaModel):
+            config = psm.ObjectField(Config)
+
+        self.Config = Config
+        self.Owner = Owner
+
+    def test_immutable(self):
+        c = psm.deserialize(self.Config, '{"name": "a", "tags": ["x"]}')
+        with self.assertRaises(AttributeError):
+            c.name = 'b'
+        with self.assertRaises(AttributeError):
+            del c.tags
+        with self.assertRaises(AttributeError):
+            psm.apply_patch(c, '{"set": {"name": "b"}}')
+        with self.assertRaises(AttributeError):
+            psm.apply_patch(psm.deserialize(self.Owner, '{"config": {"name": "a"}}'), '{"set": {"config.name": "b"}}')
+        self.assertEqual('a', c.name)
+        self.assertEqual({'name': 'a', 'tags': ['x']}, c.__dict__)
+
+        o = self.Owner(config=c)
+        o.config = self.Config(name='b')
+        self.assertEqual('{"config": {"name": "b"}}', psm.serialize(o))
+
+    def test_memoized(self):
+        c = self.Config(name='a', tags=['x'])
+        self.assertIs(psm.serialize(c), psm.serialize(c))
+        self.assertEqual(b'{"name": "a", "tags": ["x"]}', psm.serialize_bytes(c))
+        self.assertIs(psm.serialize_bytes(c), psm.serialize_bytes(c))
+
+        invalid = self.Config(tags=[])
+        self.assertEqual((False, ['required field is missing: name']), invalid.validate())
+        with self.assertRaises(psm.ValidationError):
+            psm.serialize(invalid)
+        result, errors = invalid.validate()
+        errors.append('mutated')
+        self.assertEqual((False, ['required field is missing: name']), invalid.validate())
+
+    def test_equality(self):
+        c1 = psm.deserialize(self.Config, '{"name": "a", "tags": ["x"]}')
+        c2 = psm.deserialize(self.Config, '{"tags": ["x"], "name": "a"}')
+        c3 = self.Config(name='a', tags=['y'])
+        self.assertEqual(c1, c2)
+        self.assertEqual(hash(c1), hash(c2))
+        self.assertNotEqual(c1, c3)
+        self.assertEqual(2, len({c1, c2, c3}))
+
+        class Other(psm.SchemaModel, frozen=True):
+            name = psm.StringField()
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        self.assertNotEqual(c1, Other(name='a', tags=['x']))
+        self.assertNotEqual(self.Owner(), self.Owner())
+
+    def test_inheritance(self):
+        class Child(self.Config):
+            level = psm.IntegerField()
+
+        child = Child(name='a', level=1)
+        with self.assertRaises(AttributeError):
+            child.level = 2
+        self.assertTrue(psm.schema_plan(Child).frozen)
+        self.assertEqual('{"name": "a", "level": 1}', psm.serialize(child))
+
+        with self.assertRaises(TypeError):
+            class Mutable(self.Config, frozen=False):
+                pass
+
+    def test_deep_freeze(self):
+        class Limited(psm.SchemaModel, frozen=True):
+            tags = psm.ListField(type_mapping=[psm.StringField()], max_length=2)
+            nested = psm.ListField(type_mapping=[psm.ListField(type_mapping=[psm.IntegerField()])])
+            config = psm.ObjectField(self.Config)
+
+        tags = ['a']
+        for cfg in (Limited(tags=tags, nested=[[1]]), psm.deserialize(Limited, '{"tags": ["a"], "nested": [[1]]}')):
+            self.assertEqual((True, []), cfg.validate())
+            before = hash(cfg)
+            for mutate in (lambda: cfg.tags.append('b'), lambda: cfg.tags.extend('bc'), lambda: cfg.nested[0].append(2), lambda: cfg.tags.__setitem__(0, 'z')):
+                with self.assertRaises(TypeError):
+                    mutate()
+            tags.append('b')
+            tags.append('c')
+            self.assertEqual(['a'], cfg.tags)
+            self.assertEqual((True, []), cfg.validate())
+            self.assertEqual('{"tags": ["a"], "nested": [[1]]}', psm.serialize(cfg))
+            self.assertEqual(before, hash(cfg))
+            self.assertIs(psm.FrozenList, type(cfg.nested[0]))
+            self.assertEqual(cfg, copy.deepcopy(cfg))
+            self.assertIs(psm.FrozenList, type(pickle.loads(pickle.dumps(cfg.tags))))
+            tags = ['a']
+
+        with self.assertRaises(TypeError):
+            class Holder(psm.SchemaModel, frozen=True):
+                owners = psm.ListField(type_mapping=[psm.ObjectField(self.Owner)])
+        with self.assertRaises(TypeError):
+            class Lazy(psm.SchemaModel, frozen=True):
+                configs = psm.DictField(psm.StringField(), psm.ObjectField(self.Config), lazy=True)
+
+    def test_unsealed_not_cached(self):
+        class Open(psm.SchemaModel, frozen=True, allow_unknowns=True):
+            name = psm.StringField()
+
+        owner = self.Owner()
+        cfg = Open(name='a', meta={'owner': owner})
+        self.assertIs(psm.FrozenDict, type(cfg.meta))
+        with self.assertRaises(TypeError):
+            cfg.meta['x'] = 1
+        self.assertEqual('{"name": "a", "meta": {"owner": {}}}', psm.serialize(cfg))
+        owner.config = self.Config(name='b')
+        self.assertEqual('{"name": "a", "meta": {"owner": {"config": {"name": "b"}}}}', psm.serialize(cfg))
+        self.assertEqual(b'{"name": "a", "meta": {"owner": {"config": {"name": "b"}}}}', psm.serialize_bytes(cfg))
+
+class DeserializeCache_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Flag(psm.SchemaModel):
+            name = psm.StringField(required=True)
+            rules = psm.ListField(type_mapping=[psm.StringField()])
+
+        class Flags(psm.SchemaModel, allow_unknowns=True):
+            flags = psm.ListField(type_mapping=[psm.ObjectField(Flag)])
+
+        class Frozen(psm.SchemaModel, frozen=True):
+            name = psm.StringField()
+
+        class Tagged(psm.SchemaModel, frozen=True):
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        self.Flags = Flags
+        self.Frozen = Frozen
+        self.Tagged = Tagged
+
+    def test_copy_on_hit(self):
+        cache = psm.DeserializeCache()
+        payload = '{"flags": [{"name": "a", "rules": ["x"]}], "meta": {"k": [1]}}'
+        f1 = psm.deserialize(self.Flags, payload, cache=cache)
+        f1.flags[0].rules.append('y')
+        f1.meta['k'].append(2)
+        f2 = psm.deserialize(self.Flags, payload, cache=cache)
+        self.assertIsNot(f1, f2)
+        self.assertEqual(payload, psm.serialize(f2))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+        fr1 = psm.deserialize(self.Frozen, b'{"name": "a"}', cache=cache)
+        self.assertIs(fr1, psm.deserialize(self.Frozen, b'{"name": "a"}', cache=cache))
+        self.assertIsNot(fr1, psm.deserialize(self.Frozen, '{"name": "a"}', cache=cache))
+
+    def test_frozen_hit_sealed(self):
+        cache = psm.DeserializeCache()
+        t1 = psm.deserialize(self.Tagged, '{"tags": ["a"]}', cache=cache)
+        with self.assertRaises(TypeError):
+            t1.tags.append('b')
+        t2 = psm.deserialize(self.Tagged, '{"tags": ["a"]}', cache=cache)
+        self.assertIs(t1, t2)
+        self.assertEqual(['a'], t2.tags)
+
+    def test_limits_on_hit(self):
+        cache = psm.DeserializeCache()
+        payload = '{"flags": [], "meta": "%s"}' % ('x' * 1024)
+        psm.deserialize(self.Flags, payload, cache=cache)
+        with self.assertRaises(psm.ValidationError):
+            psm.deserialize(self.Flags, payload, cache=cache,
+                            limits=psm.Limits(max_bytes=10))
+        self.assertEqual(0, cache.hits)
+
+    def test_invalid_not_cached(self):
+        cache = psm.DeserializeCache()
+        for _ in range(2):
+            with self.assertRaises(psm.ValidationError):
+                psm.deserialize(self.Flags, '{"flags": [{"rules": []}]}', cache=cache)
+        self.assertEqual(0, len(cache))
+        self.assertEqual(2, cache.misses)
+
+    def test_bounds(self):
+        cache = psm.DeserializeCache(maxsize=2)
+        for name in ['a', 'b', 'c']:
+            psm.deserialize(self.Frozen, '{"name": "%s"}' % name, cache=cache)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(26, cache.nbytes)
+
+        cache = psm.DeserializeCache(maxbytes=30)
+        psm.deserialize(self.Frozen, '{"name": "a"}', cache=cache)
+        psm.deserialize(self.Frozen, '{"name": "b"}', cache=cache)
+        psm.deserialize(self.Frozen, '{"name": "c"}', cache=cache)
+        psm.deserialize(self.Frozen, '{"name": "%s"}' % ('x' * 40), cache=cache)
+        self.assertEqual(2, len(cache))
+        psm.deserialize(self.Frozen, '{"name": "b"}', cache=cache)
+        self.assertEqual(1, cache.hits)
+
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.nbytes)
+        with self.assertRaises(ValueError):
+            psm.DeserializeCache(maxbytes=0)
+
+class Sampling_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Flag(psm.SchemaModel):
+            name = psm.StringField(required=True, allowed=['a', 'b'])
+
+        class Doc(psm.SchemaModel):
+            id = psm.IntegerField(required=True)
+            level = psm.IntegerField(_max=10)
+            flags = psm.ListField(type_mapping=[psm.ObjectField(Flag)])
+
+        self.Doc = Doc
+        self.valid = '{"id": 1, "level": 5, "flags": [{"name": "a"}]}'
+        self.deep_invalid = '{"id": 1, "level": 50, "flags": [{"name": "z"}]}'
+
+    def test_stream(self):
+        lines = [self.valid + '\n', '\n', self.valid]
+        docs = list(psm.deserialize_stream(self.Doc, lines))
+        self.assertEqual(2, len(docs))
+        self.assertEqual('a', docs[1].flags[0].name)
+
+        with self.assertRaises(psm.ValidationError):
+            psm.deserialize_many(self.Doc, [self.valid, self.deep_invalid])
+        self.assertEqual(1, len(psm.deserialize_many(self.Doc, [self.valid, self.deep_invalid], skip_invalid=True)))
+        with self.assertRaises(TypeError):
+            psm.deserialize_many(dict, [])
+
+    def test_every(self):
+        sampling = psm.Sampling(every=3)
+        docs = psm.deserialize_many(self.Doc, [self.deep_invalid] * 7, sampling=sampling, skip_invalid=True)
+        self.assertEqual(4, len(docs))
+        self.assertEqual(50, docs[0].level)
+        self.assertEqual(7, sampling.records)
+        self.assertEqual(3, sampling.sampled)
+        self.assertEqual(3, sampling.invalid)
+        self.assertEqual({'level': 1.0, 'flags': 1.0}, sampling.failure_rates())
+
+    def test_mandatory_check(self):
+        sampling = psm.Sampling(every=1000)
+        psm.deserialize_many(self.Doc, [self.valid], sampling=sampling)
+        for payload in ['{"level": 1}', '{"id": "1"}', '{"id": null}', '{"id": 1, "flags": {}}', '{"id": 1, "other": 1}']:
+            with self.assertRaises(psm.ValidationError):
+                psm.deserialize_many(self.Doc, [payload], sampling=sampling)
+        self.assertEqual(6, sampling.records)
+        self.assertEqual(1, sampling.sampled)
+        self.assertEqual(5, sampling.invalid)
+        self.assertEqual({}, sampling.failure_rates())
+
+    def test_fraction(self):
+        s1 = psm.Sampling(fraction=0.5, seed=3)
+        s2 = psm.Sampling(fraction=0.5, seed=3)
+        psm.deserialize_many(self.Doc, [self.deep_invalid] * 100, sampling=s1, skip_invalid=True)
+        psm.deserialize_many(self.Doc, [self.deep_invalid] * 100, sampling=s2, skip_invalid=True)
+        self.assertEqual(s1.sampled, s2.sampled)
+        self.assertTrue(20 < s1.sampled < 80)
+
+        with self.assertRaises(ValueError):
+            psm.Sampling()
+        with self.assertRaises(ValueError):
+            psm.Sampling(every=2, fraction=0.5)
+        with self.assertRaises(ValueError):
+            psm.Sampling(fraction=2)
+
+class ModelFile_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Record(psm.SchemaModel):
+            id = psm.IntegerField(required=True)
+
+        self.Record = Record
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'records.ndjson')
+        with open(self.path, 'w') as f:
+            for i in range(10):
+                f.write(json.dumps({'id': i}) + '\n')
+                if i == 4:
+                    f.write('\n')
+            f.write('{"id": "invalid"}')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_path_types(self):
+        # every case writes its own index, none may find one already written
+        cases = [
+            (os.fsencode(self.path), None, self.path + '.idx'),
+            (pathlib.Path(self.path), None, self.path + '.idx'),
+            (self.path, pathlib.Path(self.dir.name, 'p.idx'), os.path.join(self.dir.name, 'p.idx')),
+            (self.path, os.fsencode(os.path.join(self.dir.name, 'b.idx')), os.path.join(self.dir.name, 'b.idx')),
+        ]
+        for path, index_path, written in cases:
+            with psm.ModelFile(self.Record, path, index_path=index_path) as records:
+                self.assertEqual(3, records[3].id)
+            self.assertTrue(os.path.exists(written))
+            os.remove(written)
+
+    def test_access(self):
+        with psm.ModelFile(self.Record, self.path) as records:
+            self.assertEqual(11, len(records))
+            self.assertEqual(5, records[5].id)
+            self.assertEqual(9, records[-2].id)
+            self.assertEqual([7, 8], [r.id for r in records[7:9]])
+            self.assertEqual([0, 3, 6, 9], [r.id for r in records[0:10:3]])
+            self.assertEqual([2, 3], [r.id for r in records.iter_range(2, 4)])
+            self.assertEqual(b'{"id": 4}', records.raw(4))
+            with self.assertRaises(IndexError):
+                records[11]
+            with self.assertRaises(psm.ValidationError):
+                records[10]
+            self.assertEqual([(0, 4), (4, 8), (8, 11)], records.ranges(3))
+            self.assertEqual([(0, 11)], records.ranges(1))
+
+    def test_index(self):
+        psm.ModelFile(self.Record, self.path).close()
+        self.assertTrue(os.path.exists(self.path + '.idx'))
+        with psm.ModelFile(self.Record, self.path) as records:
+            self.assertEqual(11, len(records))
+
+        with open(self.path, 'a') as f:
+            f.write('\n{"id": 11}\n')
+        with psm.ModelFile(self.Record, self.path) as records:
+            self.assertEqual(12, len(records))
+            self.assertEqual(11, records[11].id)
+
+        empty = os.path.join(self.dir.name, 'empty.ndjson')
+        open(empty, 'w').close()
+        index_path = os.path.join(self.dir.name, 'empty.index')
+        with psm.ModelFile(self.Record, empty, index_path=index_path) as records:
+            self.assertEqual(0, len(records))
+            self.assertEqual([], list(records))
+        self.assertTrue(os.path.exists(index_path))
+
+class Where_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Stats(psm.SchemaModel):
+            level = psm.IntegerField(required=True)
+
+        class Player(psm.SchemaModel):
+            name = psm.StringField()
+            stats = psm.ObjectField(Stats)
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        self.Player = Player
+        self.lines = [json.dumps({'name': 'p%d' % i, 'stats': {'level': i}, 'tags': ['t%d' % (i % 2)]}) for i in range(10)]
+
+    def test_filters(self):
+        players = psm.deserialize_many(self.Player, self.lines, where={'stats.level': ('>=', 7)})
+        self.assertEqual(['p7', 'p8', 'p9'], [p.name for p in players])
+        players = psm.deserialize_many(self.Player, self.lines, where={'stats.level': ('<', 5), 'name': ('in', ['p1', 'p4', 'p7'])})
+        self.assertEqual(['p1', 'p4'], [p.name for p in players])
+        players = psm.deserialize_many(self.Player, self.lines, where={'tags': lambda v: v == ['t1'], 'name': ('!=', 'p3')})
+        self.assertEqual(['p1', 'p5', 'p7', 'p9'], [p.name for p in players])
+
+    def test_rejected_not_validated(self):
+        lines = ['{"name": "a", "stats": {"level": "high"}}', '{"name": "b"}', '{"name": "c", "stats": {"level": 3}, "unknown": 1}']
+        self.assertEqual([], psm.deserialize_many(self.Player, lines, where={'stats.level': ('>', 1), 'name': ('==', 'a')}))
+        self.assertEqual([], psm.deserialize_many(self.Player, lines, where={'stats.level': ('not in', [3]), 'name': ('!=', 'a')}))
+        with self.assertRaises(psm.ValidationError):
+            psm.deserialize_many(self.Player, lines, where={'stats.level': ('==', 3)})
+
+    def test_checked_against_schema(self):
+        for where in [{'level': ('>', 1)}, {'name.first': ('==', 'a')}]:
+            with self.assertRaises(ValueError):
+                psm.deserialize_stream(self.Player, [], where=where)
+        for where in [{'stats.level': ('>', 1.5)}, {'name': ('in', ['a', 1])}, {'tags': ('==', [])}, {'name': ('~', 'a')}, {'name': 'a'}]:
+            with self.assertRaises(TypeError):
+                psm.deserialize_stream(self.Player, [], where=where)
+
+class PipelineRecord(psm.SchemaModel):
+    id = psm.IntegerField(required=True)
+    name = psm.StringField()
+
+class Pipeline_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'records.ndjson')
+        self.lines = [json.dumps({'id': i, 'name': 'r%d' % i}) for i in range(250)]
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(self.lines))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_sources(self):
+        expected = list(range(250))
+        self.assertEqual(expected, [r.id for r in psm.pipeline(PipelineRecord, self.path, batch_size=7, chunk_size=64)])
+        with open(self.path) as f:
+            self.assertEqual(expected, [r.id for r in psm.pipeline(PipelineRecord, f, batch_size=100, chunk_size=1000)])
+        self.assertEqual(expected, [r.id for r in psm.pipeline(PipelineRecord, iter(self.lines), batch_size=33)])
+
+    def test_workers(self):
+        p = psm.pipeline(PipelineRecord, self.path, workers=2, batch_size=20, queue_size=2)
+        self.assertEqual(list(range(250)), [r.id for r in p])
+        p = psm.pipeline(PipelineRecord, self.path, workers=2, ordered=False, batch_size=20, where={'id': ('<', 100)})
+        self.assertEqual(list(range(100)), sorted(r.id for r in p))
+
+        class Local(psm.SchemaModel):
+            id = psm.IntegerField()
+
+        with self.assertRaises(TypeError):
+            psm.pipeline(PipelineRecord, self.path, workers=2, where={'id': lambda v: v < 100})
+        with self.assertRaises(TypeError):
+            psm.pipeline(Local, self.path, workers=2)
+        self.assertEqual(100, len(list(psm.pipeline(PipelineRecord, self.path, where={'id': lambda v: v < 100}))))
+
+        with self.assertRaises(psm.ValidationError):
+            list(psm.pipeline(PipelineRecord, self.lines + ['{"id": "x"}'], workers=2, batch_size=20))
+        records = iter(psm.pipeline(PipelineRecord, self.path, workers=2, batch_size=1, queue_size=2))
+        self.assertEqual(0, next(records).id)
+        records.close()
+
+    def test_stats(self):
+        p = psm.pipeline(PipelineRecord, self.lines + ['{"id": "x"}', ''], skip_invalid=True, batch_size=50)
+        self.assertEqual(250, len(list(p)))
+        self.assertEqual(252, p.stats['read'].items)
+        self.assertEqual(250, p.stats['deserialize'].items)
+        self.assertEqual(250, p.stats['consume'].items)
+        self.assertTrue(p.stats['deserialize'].throughput() > 0)
+        self.assertTrue(p.stats['read'].queue_depth <= 4)
+
+    def test_errors(self):
+        with self.assertRaises(psm.ValidationError):
+            list(psm.pipeline(PipelineRecord, self.lines + ['{"id": "x"}']))
+        with self.assertRaises(OSError):
+            list(psm.pipeline(PipelineRecord, os.path.join(self.dir.name, 'missing.ndjson')))
+        with self.assertRaises(ValueError):
+            psm.pipeline(PipelineRecord, self.path, batch_size=0)
+        with self.assertRaises(ValueError):
+            psm.pipeline(PipelineRecord, self.path, where={'missing': ('==', 1)})
+
+        records = iter(psm.pipeline(PipelineRecord, self.path, batch_size=1, queue_size=1))
+        self.assertEqual(0, next(records).id)
+        records.close()
+
+class Csv_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Stats(psm.SchemaModel):
+            level = psm.IntegerField(required=True)
+            hp = psm.FloatField()
+            alive = psm.BoolField()
+
+        class Player(psm.SchemaModel):
+            name = psm.StringField(required=True)
+            stats = psm.ObjectField(Stats)
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        class Node(psm.SchemaModel):
+            value = psm.IntegerField()
+            child = psm.ObjectField(psm.SchemaModel)
+
+        self.Stats = Stats
+        self.Player = Player
+        self.Node = Node
+
+    def test_round_trip(self):
+        players = [self.Player(name='a', stats=self.Stats(level=1, hp=0.5, alive=True)), self.Player(name='b,"c"')]
+        out = io.StringIO()
+        self.assertEqual(2, psm.to_csv(players, out))
+        self.assertEqual('name,stats.level,stats.hp,stats.alive\r\na,1,0.5,true\r\n"b,""c""",,,\r\n', out.getvalue())
+        loaded = list(psm.from_csv(self.Player, io.StringIO(out.getvalue())))
+        self.assertEqual([psm.serialize(p) for p in players], [psm.serialize(p) for p in loaded])
+
+        out = io.StringIO()
+        psm.to_csv(players[:1], out, delimiter='\t', columns=['stats.level', 'name'])
+        self.assertEqual('stats.level\tname\r\n1\ta\r\n', out.getvalue())
+        loaded = list(psm.from_csv(self.Player, io.StringIO(out.getvalue()), delimiter='\t'))
+        self.assertEqual({'stats': {'level': 1}, 'name': 'a'}, loaded[0].to_json_obj())
+
+        out = io.StringIO()
+        self.assertEqual(0, psm.to_csv([], out, cls=self.Node))
+        self.assertEqual('value\r\n', out.getvalue())
+
+    def test_required_nulls(self):
+        class Bonus(psm.SchemaModel):
+            level = psm.IntegerField()
+            factor = psm.FloatField(required=True, nullable=True)
+
+        class Score(psm.SchemaModel):
+            name = psm.StringField(required=True)
+            best = psm.IntegerField(required=True, nullable=True)
+            bonus = psm.ObjectField(Bonus)
+
+        scores = [Score(name='a', best=None, bonus=Bonus(level=1, factor=None)), Score(name='b', best=3)]
+        out = io.StringIO()
+        psm.to_csv(scores, out)
+        self.assertEqual('name,best,bonus.level,bonus.factor\r\na,,1,\r\nb,3,,\r\n', out.getvalue())
+        loaded = list(psm.from_csv(Score, io.StringIO(out.getvalue())))
+        self.assertEqual([psm.serialize(s) for s in scores], [psm.serialize(s) for s in loaded])
+
+    def test_invalid_rows(self):
+        data = 'name,stats.level,stats.alive\na,one,true\nb,2,yes\n\nc,3,False\n'
+        with self.assertRaises(psm.ValidationError):
+            list(psm.from_csv(self.Player, io.StringIO(data)))
+        players = list(psm.from_csv(self.Player, io.StringIO(data), skip_invalid=True))
+        self.assertEqual(['c'], [p.name for p in players])
+        self.assertFalse(players[0].stats.alive)
+        self.assertEqual([], list(psm.from_csv(self.Player, io.StringIO(''))))
+
+        with self.assertRaises(psm.ValidationError):
+            psm.to_csv([self.Player()], io.StringIO())
+        with self.assertRaises(TypeError):
+            psm.to_csv([self.Player(name='a'), self.Stats(level=1)], io.StringIO())
+
+    def test_headers(self):
+        for header in ['missing', 'tags', 'stats', 'name.first', 'stats.missing']:
+            with self.assertRaises(ValueError):
+                psm.from_csv(self.Player, io.StringIO(header + '\n'))
+
+class Limits_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Item(psm.SchemaModel):
+            tags = psm.ListField(type_mapping=[psm.StringField()], max_length=3)
+            pair = psm.ListField(type_mapping=[psm.IntegerField(), psm.ListField(type_mapping=[psm.IntegerField()], max_length=2)])
+
+        class Doc(psm.SchemaModel, allow_unknowns=True):
+            items = psm.ListField(type_mapping=[psm.ObjectField(Item)], max_length=100)
+            name = psm.StringField()
+            groups = psm.DictField(psm.StringField(), psm.ListField(type_mapping=[psm.IntegerField()], max_length=2))
+            by_name = psm.DictField(psm.StringField(), psm.ObjectField(Item))
+
+        self.Doc = Doc
+
+    def assertRejected(self, payload, limits, message):
+        with self.assertRaises(psm.ValidationError) as context:
+            psm.deserialize(self.Doc, payload, limits=limits)
+        self.assertEqual([message], context.exception.errors)
+
+    def test_schema_lists(self):
+        limits = psm.Limits()
+        self.assertEqual(3, len(psm.deserialize(self.Doc, '{"items": [{"tags": ["a", "b", "c"]}]}', limits=limits).items[0].tags))
+        self.assertRejected('{"items": [{"tags": ["a", "b", "c", "d"]}]}', limits, 'List Field "tags" exceeded its maximum length: 3')
+        self.assertRejected('{"items": [{"pair": [1, [1, 2, 3]]}]}', limits, 'List Field "pair" exceeded its maximum length: 2')
+        self.assertRejected('{"items": [' + ', '.join(['{}'] * 101) + ']}', limits, 'List Field "items" exceeded its maximum length: 100')
+        self.assertEqual([1, 2], psm.deserialize(self.Doc, '{"groups": {"a": [1, 2], "b": []}}', limits=limits).groups['a'])
+        self.assertRejected('{"groups": {"a": [1], "b": [1, 2, 3]}}', limits, 'List Field "groups" exceeded its maximum length: 2')
+        self.assertRejected('{"by_name": {"a": {"tags": ["a", "b", "c", "d"]}}}', limits, 'List Field "tags" exceeded its maximum length: 3')
+        with self.assertRaises(psm.ValidationError) as context:
+            psm.deserialize(self.Doc, '{"items": [{"tags": ["a", "b", "c", "d"]}]}', limits=psm.Limits(schema=False))
+        self.assertEqual(['invalid type: Item, expected: ObjectField for Field "items"'], context.exception.errors)
+
+    def test_global_caps(self):
+        limits = psm.Limits(max_bytes=200, max_depth=4, max_string=10, max_list=2)
+        self.assertEqual('abc', psm.deserialize(self.Doc, '{"name": "abc", "other": [[1, 2]]}', limits=limits).name)
+        self.assertRejected('{"name": "%s"}' % ('x' * 300), limits, 'payload exceeds the maximum size: 200 bytes')
+        self.assertEqual('\u00e9' * 14, psm.deserialize(self.Doc, '{"name": "%s"}' % ('\u00e9' * 14), limits=psm.Limits(max_bytes=40)).name)
+        self.assertRejected('{"name": "%s"}' % ('\u00e9' * 19), psm.Limits(max_bytes=40), 'payload exceeds the maximum size: 40 bytes')
+        self.assertRejected(('{"name": "%s"}' % ('\u00e9' * 19)).encode('utf-8'), psm.Limits(max_bytes=40), 'payload exceeds the maximum size: 40 bytes')
+        self.assertRejected('{"x": [[[[1]]]]}', limits, 'payload exceeds the maximum depth: 4')
+        self.assertRejected('{"x": {"abcdefghijk": 1}}', limits, 'payload has a string exceeding the maximum length: 10')
+        self.assertRejected('{"x": [1, 2, 3]}', limits, 'payload has a list exceeding the maximum length: 2')
+        self.assertEqual('aaaaaaaaaa', psm.deserialize(self.Doc, '{"name": "\\u0061aaaaaaaaa"}', limits=limits).name)
+        self.assertRejected('{"x": [0]}', psm.Limits(max_list=0), 'payload has a list exceeding the maximum length: 0')
+        psm.deserialize(self.Doc, b'{"x": [ ]}', limits=psm.Limits(max_list=0))
+        with self.assertRaises(json.JSONDecodeError):
+            psm.deserialize(self.Doc, '{"x": [1, 2], ]]' + ' ' * 10, limits=limits)
+        with self.assertRaises(ValueError):
+            psm.Limits(max_depth=-1)
+
+    def test_default_limits(self):
+        psm.set_limits(psm.Limits(max_string=4))
+        try:
+            with self.assertRaises(psm.ValidationError):
+                psm.deserialize(self.Doc, '{"name": "abcde"}')
+            docs = psm.deserialize_many(self.Doc, ['{"name": "abcde"}', '{"name": "abcd"}'], skip_invalid=True)
+            self.assertEqual(['abcd'], [d.name for d in docs])
+            self.assertEqual('abcde', psm.deserialize(self.Doc, '{"name": "abcde"}', limits=psm.Limits()).name)
+        finally:
+            psm.set_limits(None)
+        self.assertEqual('abcde', psm.deserialize(self.Doc, '{"name": "abcde"}').name)
+        with self.assertRaises(TypeError):
+            psm.set_limits({})
+
+class Compression_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.records = [PipelineRecord(id=i, name='r%d' % i) for i in range(300)]
+        self.content = ''.join(psm.serialize(r) + '\n' for r in self.records).encode('utf-8')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def test_round_trip(self):
+        for name in ['records.ndjson', 'records.ndjson.gz', 'records.ndjson.bz2', 'records.ndjson.xz']:
+            self.assertEqual(300, psm.serialize_many(self.records, self.path(name), chunk_size=100))
+            with psm.open_compressed(self.path(name)) as f:
+                self.assertEqual(self.content, f.read())
+            lines = list(psm.read_lines(self.path(name), chunk_size=64))
+            self.assertEqual(self.content.split(b'\n')[:-1], lines)
+            self.assertEqual(list(range(300)), [r.id for r in psm.deserialize_stream(PipelineRecord, psm.read_lines(self.path(name)))])
+            self.assertEqual(list(range(300)), [r.id for r in psm.pipeline(PipelineRecord, self.path(name), chunk_size=100)])
+
+    def test_magic_bytes(self):
+        out = io.BytesIO()
+        psm.serialize_many(self.records, out, compression='xz')
+        with open(self.path('records'), 'wb') as f:
+            f.write(out.getvalue())
+        with psm.open_compressed(self.path('records')) as f:
+            self.assertEqual(self.content, f.read())
+        with open(self.path('records'), 'rb') as f:
+            self.assertEqual(300, len(list(psm.read_lines(f))))
+        with open(self.path('records'), 'rb') as f:
+            self.assertEqual(300, len(list(psm.pipeline(PipelineRecord, f))))
+        self.assertEqual(['{"id": 0, "name": "r0"}'], list(psm.read_lines(io.StringIO('{"id": 0, "name": "r0"}\n'))))
+        with self.assertRaises(ValueError):
+            psm.serialize_many(self.records, io.BytesIO(), compression='zip')
+
+    def test_failures(self):
+        path = self.path('records.ndjson')
+        psm.serialize_many(self.records, path)
+        with self.assertRaises(ValueError):
+            psm.serialize_many(self.records, path, compression='zip')
+        with open(path, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+
+        threads = threading.active_count()
+        for queue_size in [1, 4]:
+            with self.assertRaises(TypeError):
+                psm.serialize_many(self.records + [object()], path, chunk_size=16, queue_size=queue_size)
+        self.assertEqual(threads, threading.active_count())
+
+    def test_gzip_members(self):
+        path = self.path('members.gz')
+        with open(path, 'wb') as f:
+            for idx in range(0, len(self.content), 997):
+                f.write(gzip.compress(self.content[idx:idx + 997]))
+            f.write(b'\x00' * 8)
+        for workers in [1, 3]:
+            self.assertEqual(self.content, b''.join(line + b'\n' for line in psm.read_lines(path, chunk_size=128, workers=workers)))
+        self.assertEqual(300, len(list(psm.pipeline(PipelineRecord, path, decompress_workers=3))))
+
+        with open(path, 'ab') as f:
+            f.write(b'garbage')
+        with self.assertRaises(OSError):
+            list(psm.read_lines(path, workers=2))
+
+        # a member cut short reads the same with or without workers
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(self.content[:997]))
+            f.write(gzip.compress(self.content[997:])[:-20])
+        for workers in [1, 4]:
+            with self.assertRaises(EOFError):
+                list(psm.read_lines(path, workers=workers))
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(self.content)[:5])
+        for workers in [1, 4]:
+            with self.assertRaises(EOFError):
+                list(psm.read_lines(path, workers=workers))
+
+def _shared_batch_ids(batch, start, stop):
+    try:
+        return [r.id for r in batch.iter_range(start, stop)]
+    finally:
+        batch.close()
+
+class SharedBatch_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Stats(psm.SchemaModel):
+            level = psm.IntegerField()
+
+        class Player(psm.SchemaModel, allow_unknowns=True):
+            name = psm.StringField()
+            stats = psm.ObjectField(Stats)
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+            alive = psm.BoolField(nullable=True)
+            score = psm.FloatField()
+
+        self.Stats = Stats
+        self.Player = Player
+
+    def test_round_trip(self):
+        players = [
+            self.Player(name='a\u00e9', stats=self.Stats(level=1), tags=['x', 'y'], alive=True, score=1.5),
+            self.Player(alive=None),
+            self.Player(name=3, score=2, alive=False, extra={'k': [1]}),
+            self.Player(name='', tags=[], stats=self.Stats())
+        ]
+        with psm.share_batch(self.Player, players) as batch:
+            self.assertEqual(4, len(batch))
+            for original, decoded in zip(players, batch):
+                self.assertEqual(json.dumps(original.to_json_obj(), sort_keys=True), json.dumps(decoded.to_json_obj(), sort_keys=True))
+            self.assertIsInstance(batch[0].stats, self.Stats)
+            self.assertIs(True, batch[0].alive)
+            self.assertEqual(3, batch[-2].name)
+            self.assertEqual(['a\u00e9', ''], [p.__dict__.get('name') for p in batch[0:4:3]])
+            status, values = batch.column('alive')
+            self.assertEqual([2, 1, 2, 0], list(status))
+            self.assertEqual([1, 0, 0, 0], list(values))
+            self.assertEqual(1.5, batch.column('score')[1][0])
+            with self.assertRaises(TypeError):
+                batch.column('name')
+            with self.assertRaises(IndexError):
+                batch[4]
+
+    def test_attach(self):
+        with psm.share_batch(PipelineRecord, [PipelineRecord(id=i) for i in range(100)]) as batch:
+            attached = psm.attach_batch(PipelineRecord, batch.name)
+            self.assertEqual(99, attached[99].id)
+            attached.close()
+            with self.assertRaises(TypeError):
+                psm.attach_batch(self.Player, batch.name)
+            with concurrent.futures.ProcessPoolExecutor(2) as pool:
+                futures = [pool.submit(_shared_batch_ids, batch, start, stop) for start, stop in batch.ranges(3)]
+                self.assertEqual(list(range(100)), [i for f in futures for i in f.result()])
+        with psm.share_batch(PipelineRecord, []) as batch:
+            self.assertEqual([], list(batch))
+
+class PickleRecord(psm.SchemaModel, allow_unknowns=True):
+    id = psm.IntegerField(required=True)
+    parent = psm.ObjectField(PipelineRecord)
+    children = psm.ListField(type_mapping=[psm.ObjectField(PipelineRecord)])
+
+class FrozenPickleRecord(psm.SchemaModel, frozen=True):
+    id = psm.IntegerField()
+    name = psm.StringField()
+
+class Pickle_tests(unittest.TestCase):
+
+    def test_round_trip(self):
+        record = PickleRecord(id=1, parent=PipelineRecord(id=2, name='p'), children=[PipelineRecord(id=3)])
+        loaded = pickle.loads(pickle.dumps(record))
+        self.assertIsInstance(loaded.parent, PipelineRecord)
+        self.assertEqual(record.to_json_obj(), loaded.to_json_obj())
+        self.assertEqual(['id', 'parent', 'children'], list(loaded.__dict__))
+
+        partial = PickleRecord(id=None, note=[1])
+        loaded = pickle.loads(pickle.dumps(partial))
+        self.assertEqual({'id': None, 'note': [1]}, loaded.__dict__)
+        self.assertFalse(hasattr(loaded, 'parent'))
+
+    def test_smaller_than_dict_state(self):
+        class DictState(pickle.Pickler):
+            def reducer_override(self, obj):
+                if isinstance(obj, psm.SchemaModel):
+                    return (copyreg.__newobj__, (type(obj),), obj.__dict__)
+                return NotImplemented
+
+        def dict_state(obj):
+            f = io.BytesIO()
+            DictState(f).dump(obj)
+            return f.getvalue()
+
+        records = [PickleRecord(id=i, parent=PipelineRecord(id=i, name='p'), children=[]) for i in range(100)]
+        self.assertLess(len(pickle.dumps(records)), len(dict_state(records)))
+
+        # pickles written before the state became a tuple still load
+        loaded = pickle.loads(dict_state(records[:2]))
+        self.assertEqual([r.to_json_obj() for r in records[:2]], [r.to_json_obj() for r in loaded])
+        loaded = pickle.loads(dict_state(PickleRecord(id=None, note=[1])))
+        self.assertEqual({'id': None, 'note': [1]}, loaded.__dict__)
+        loaded = pickle.loads(dict_state(FrozenPickleRecord(id=1, name='a')))
+        self.assertEqual(FrozenPickleRecord(id=1, name='a'), loaded)
+        with self.assertRaises(AttributeError):
+            loaded.name = 'b'
+
+    def test_cycles(self):
+        record = PickleRecord(id=1)
+        record.children = [record]
+        loaded = pickle.loads(pickle.dumps(record))
+        self.assertIs(loaded, loaded.children[0])
+
+    def test_frozen(self):
+        record = FrozenPickleRecord(id=1, name='a')
+        hash(record)
+        for loaded in (pickle.loads(pickle.dumps(record)), copy.deepcopy(record), copy.copy(record)):
+            self.assertEqual(record, loaded)
+            self.assertEqual(hash(record), hash(loaded))
+            self.assertEqual((True, []), loaded.validate())
+            with self.assertRaises(AttributeError):
+                loaded.id = 2
+
+    def test_schema_mismatch(self):
+        data = pickle.dumps(PipelineRecord(id=1))
+        plan = psm.schema_plan(PipelineRecord)
+        plan.fingerprint += 1
+        try:
+            with self.assertRaises(TypeError):
+                pickle.loads(data)
+        finally:
+            plan.fingerprint -= 1
+        self.assertEqual(1, pickle.loads(data).id)
+
+class ModelCollection_tests(unittest.TestCase):
+
+    def setUp(self):
+        class User(psm.SchemaModel):
+            id = psm.IntegerField()
+            email = psm.StringField()
+            age = psm.IntegerField(nullable=True)
+            score = psm.FloatField()
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        self.User = User
+        self.users = [User(id=i, email=str.format('u{}@x', i), age=i % 10, score=i / 2) for i in range(50)]
+        self.collection = psm.ModelCollection(User, hash_indexes=['id', 'email', 'age'], sorted_indexes=['age', 'score'])
+        self.collection.extend(self.users)
+
+    def test_lookup(self):
+        collection = self.collection
+        self.assertEqual(50, len(collection))
+        self.assertEqual([self.users[7]], collection.lookup('email', 'u7@x'))
+        self.assertEqual(self.users[3::10], collection.lookup('age', 3))
+        self.assertEqual([], collection.lookup('id', 100))
+        with self.assertRaises(ValueError):
+            collection.lookup('tags', [])
+
+    def test_between(self):
+        collection = self.collection
+        self.assertEqual(self.users[4:9], collection.between('score', 2, 4))
+        self.assertEqual(self.users[:2], collection.between('score', high=0.5))
+        self.assertEqual(self.users[48:], collection.between('score', low=24))
+        ages = [u.age for u in collection.between('age', 8)]
+        self.assertEqual([8] * 5 + [9] * 5, ages)
+        self.assertEqual(self.users[8::10], collection.between('age', 8, 8))
+        self.assertEqual([self.users[2]], collection.lookup('score', 1.0))
+        with self.assertRaises(ValueError):
+            collection.between('id', 1, 2)
+
+    def test_update_and_remove(self):
+        collection = self.collection
+        user = self.users[3]
+        collection.update(user, email='new@x', age=None, score=100.0)
+        self.assertEqual([], collection.lookup('email', 'u3@x'))
+        self.assertEqual([user], collection.lookup('email', 'new@x'))
+        self.assertEqual([user], collection.lookup('age', None))
+        self.assertNotIn(user, collection.between('age', 3, 3))
+        self.assertEqual([user], collection.between('score', 99))
+
+        user.id = 1000
+        del user.email
+        collection.reindex()
+        self.assertEqual([user], collection.lookup('id', 1000))
+        self.assertEqual([], collection.lookup('email', 'new@x'))
+
+        collection.remove(user)
+        self.assertNotIn(user, collection)
+        self.assertEqual([], collection.lookup('id', 1000))
+        self.assertEqual([], collection.between('score', 99))
+        with self.assertRaises(KeyError):
+            collection.remove(user)
+        for u in self.users[:20]:
+            if u in collection:
+                collection.remove(u)
+        self.assertEqual(self.users[20:], list(collection))
+        self.assertEqual(self.users[20:], collection.between('score'))
+
+    def test_incremental_matches_bulk(self):
+        collection = psm.ModelCollection(self.User, sorted_indexes=['age'])
+        for u in self.users:
+            collection.add(u)
+        self.assertEqual(collection.between('age'), self.collection.between('age'))
+
+    def test_chunked_index(self):
+        index = psm._SortedIndex()
+        index._LOAD = 4
+        for i in [5, 1, 9, 3, 7, 2, 8, 4, 6, 0, 11, 10]:
+            index.insert((i, 0), i)
+        self.assertEqual(list(range(12)), index.between(None, None))
+        self.assertEqual([3, 4, 5, 6, 7, 8], index.between((3,), (8, 1)))
+        for i in [0, 5, 11, 6]:
+            index.delete((i, 0))
+        self.assertEqual([1, 2, 3, 4, 7, 8, 9, 10], index.between(None, None))
+        self.assertEqual(8, len(index))
+
+    def test_load_and_errors(self):
+        collection = psm.ModelCollection(self.User, hash_indexes=['email'])
+        collection.load(['{"id": 1, "email": "a@x"}', '{"id": 2, "email": 3}'], skip_invalid=True)
+        self.assertEqual(1, len(collection))
+        self.assertEqual(1, collection.lookup('email', 'a@x')[0].id)
+        with self.assertRaises(TypeError):
+            collection.add(PipelineRecord(id=1))
+        with self.assertRaises(ValueError):
+            psm.ModelCollection(self.User, hash_indexes=['missing'])
+        with self.assertRaises(TypeError):
+            psm.ModelCollection(self.User, hash_indexes=['tags'])
+        with self.assertRaises(TypeError):
+            psm.ModelCollection(self.User, sorted_indexes=['email'])
+
+class Generate_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Stats(psm.SchemaModel):
+            level = psm.IntegerField(required=True, _min=1, _max=10)
+            hp = psm.FloatField(nullable=True, _min=0, _max=1)
+
+        class Player(psm.SchemaModel):
+            name = psm.StringField(required=True, forbidden=['admin'])
+            kind = psm.StringField(allowed=['a', 'b', 5])
+            age = psm.IntegerField(_min=0, _max=120, forbidden=[13])
+            alive = psm.BoolField()
+            stats = psm.ObjectField(Stats, required=True)
+            tags = psm.ListField(type_mapping=[psm.StringField()], min_length=1, max_length=3)
+            pair = psm.ListField(type_mapping=[psm.IntegerField(), psm.StringField()])
+            friends = psm.ListField(type_mapping=[psm.ObjectField(Stats)], nullable=True)
+
+        self.Stats = Stats
+        self.Player = Player
+
+    def test_valid(self):
+        players = list(psm.generate(self.Player, 500, seed=1))
+        self.assertEqual(500, len(players))
+        for player in players:
+            self.assertEqual((True, []), player.validate())
+            self.assertIsInstance(player.stats, self.Stats)
+            self.assertIn(player.__dict__.get('kind', 'a'), ['a', 'b'])
+        self.assertTrue(any(player.__dict__.get('friends') is None for player in players))
+        self.assertTrue(any(player.__dict__.get('friends') for player in players))
+
+    def test_seed_and_json_lines(self):
+        lines = list(psm.generate(self.Player, 50, seed=3, json_lines=True))
+        self.assertEqual(lines, list(psm.generate(self.Player, 50, seed=3, json_lines=True)))
+        self.assertEqual(lines, [psm.serialize(p) for p in psm.generate(self.Player, 50, seed=3)])
+        for line in lines:
+            self.assertEqual((True, []), psm.deserialize(self.Player, line).validate())
+
+    def test_invalid_ratio(self):
+        players = list(psm.generate(self.Player, 2000, seed=4, invalid_ratio=0.3))
+        invalid = [p for p in players if not p.validate()[0]]
+        self.assertTrue(450 < len(invalid) < 750)
+        self.assertTrue(all(not p.validate()[0] for p in psm.generate(self.Player, 200, seed=5, invalid_ratio=1)))
+
+    def test_depth(self):
+        optional = required = PipelineRecord
+        for i in range(6):
+            optional = psm.Schema('Optional', (psm.SchemaModel,), {'child': psm.ObjectField(optional)})
+            required = psm.Schema('Required', (psm.SchemaModel,), {'child': psm.ObjectField(required, required=True)})
+
+        def depth(d):
+            return 1 + depth(d['child']) if 'child' in d else 0
+
+        self.assertTrue(all(depth(json.loads(line)) <= 4 for line in psm.generate(optional, 100, seed=1, json_lines=True)))
+        self.assertTrue(all(depth(json.loads(line)) == 6 for line in psm.generate(required, 10, seed=1, json_lines=True)))
+
+    def test_errors(self):
+        class Impossible(psm.SchemaModel):
+            kind = psm.StringField(allowed=['a'], forbidden=['a'])
+
+        with self.assertRaises(ValueError):
+            psm.generate(Impossible, 1)
+        with self.assertRaises(ValueError):
+            psm.generate(self.Player, 1, invalid_ratio=2)
+        with self.assertRaises(TypeError):
+            psm.generate(dict, 1)
+
+class Validators_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def even(value):
+            return value % 2 == 0
+
+        def known_domains(values):
+            self.calls.append(list(values))
+            return [v.endswith('@x.com') for v in values]
+
+        class Stats(psm.SchemaModel):
+            level = psm.IntegerField(validators=[even])
+
+        class User(psm.SchemaModel):
+            id = psm.IntegerField(_min=0, validators=[even])
+            email = psm.StringField(nullable=True, validators=[psm.BatchValidator(known_domains)])
+            stats = psm.ObjectField(Stats)
+
+        self.Stats = Stats
+        self.User = User
+
+    def test_plain(self):
+        self.assertEqual((True, []), self.User(id=2).validate())
+        self.assertEqual((False, ['Field "id" failed validator: even']), self.User(id=3).validate())
+        result, errors = self.User(id=-1).validate()
+        self.assertEqual(1, len(errors))
+        self.assertEqual((False, ['Field "level" failed validator: even']), self.User(stats=self.Stats(level=1)).validate())
+        self.assertEqual((False, ['Field "level" failed validator: even']), psm._run_checks(psm._ModelCheck(self.User(stats=self.Stats(level=1)))))
+        with self.assertRaises(TypeError):
+            psm.IntegerField(validators=[1])
+        with self.assertRaises(TypeError):
+            psm.BatchValidator(None)
+
+    def test_nested_fields(self):
+        def short(value):
+            return len(value) < 2
+
+        def level_set(value):
+            return 'level' in value.__dict__
+
+        class Point(psm.SchemaModel, frozen=True):
+            x = psm.IntegerField()
+
+        class Group(psm.SchemaModel):
+            stats = psm.ObjectField(self.Stats, validators=[level_set])
+            points = psm.ListField(type_mapping=[psm.ObjectField(Point)], validators=[short])
+            tags = psm.ListField(type_mapping=[psm.StringField()], validators=[short])
+            matrix = psm.ListField(type_mapping=[psm.ListField(type_mapping=[psm.IntegerField()], validators=[short])])
+            scores = psm.DictField(psm.StringField(), psm.ListField(type_mapping=[psm.ObjectField(Point)], validators=[short]))
+            weights = psm.DictField(psm.StringField(), psm.IntegerField(), validators=[short])
+
+        payloads = [
+            '{"stats": {}}',
+            '{"points": [{"x": 1}, {"x": 2}]}',
+            '{"tags": ["a", "b"]}',
+            '{"matrix": [[1, 2]]}',
+            '{"scores": {"a": [{"x": 1}, {"x": 2}]}}',
+            '{"weights": {"a": 1, "b": 2}}',
+        ]
+        for payload in payloads:
+            with self.assertRaises(psm.ValidationError) as plain:
+                psm.deserialize(Group, payload)
+            with self.assertRaises(psm.ValidationError) as shared:
+                psm.deserialize(Group, payload, shared=psm.SharedObjects([Point]))
+            self.assertEqual(plain.exception.errors, shared.exception.errors)
+        group = psm.deserialize(Group, '{"stats": {"level": 2}, "points": [{"x": 1}], "scores": {"a": [{"x": 1}]}}', shared=psm.SharedObjects([Point]))
+        self.assertEqual((True, []), psm._run_checks(psm._ModelCheck(group)))
+        group = Group(stats=self.Stats(), matrix=[[1, 2]])
+        self.assertEqual(group.validate(), psm._run_checks(psm._ModelCheck(group)))
+
+    def test_batch_per_record(self):
+        self.assertEqual((False, ['Field "email" failed validator: known_domains']), self.User(email='a@y.com').validate())
+        self.assertEqual((True, []), self.User(email=None).validate())
+        self.assertEqual([['a@y.com']], self.calls)
+
+    def test_validate_many(self):
+        users = [self.User(id=i * 2, email=str.format('{}@{}', i, 'x.com' if i % 3 else 'y.com')) for i in range(10)]
+        users.append(self.User(id=1, email=None))
+        users.append(self.User(id=2, email=5))
+        results = psm.validate_many(users)
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual(10, len(self.calls[0]))
+        self.assertEqual([i % 3 != 0 for i in range(10)] + [False, False], [r[0] for r in results])
+        self.assertEqual(['Field "email" failed validator: known_domains'], results[0][1])
+        self.assertEqual(['Field "id" failed validator: even'], results[10][1])
+        self.assertEqual(['Field "email" must be a str'], results[11][1])
+        self.assertEqual([user.validate() for user in users], results)
+
+    def test_deserialize_many(self):
+        lines = [json.dumps({'id': i * 2, 'email': 'a@x.com' if i != 3 else 'a@y.com'}) for i in range(20)]
+        self.assertEqual(19, len(psm.deserialize_many(self.User, lines, skip_invalid=True)))
+        self.assertEqual(1, len(self.calls))
+        with self.assertRaises(psm.ValidationError) as raised:
+            psm.deserialize_many(self.User, lines)
+        self.assertEqual(['Field "email" failed validator: known_domains'], raised.exception.errors)
+
+    def test_frozen_and_bad_results(self):
+        class Frozen(psm.SchemaModel, frozen=True):
+            code = psm.StringField(validators=[psm.BatchValidator(lambda values: [v.isdigit() for v in values])])
+
+        self.assertEqual([True, False], [r[0] for r in psm.validate_many([Frozen(code='1'), Frozen(code='a')])])
+
+        class Broken(psm.SchemaModel):
+            code = psm.StringField(validators=[psm.BatchValidator(lambda values: [])])
+
+        with self.assertRaises(ValueError):
+            psm.validate_many([Broken(code='a')])
+
+class DeserializeInto_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Stats(psm.SchemaModel):
+            level = psm.IntegerField(_min=0)
+
+        class Player(psm.SchemaModel, allow_unknowns=True):
+            name = psm.StringField()
+            stats = psm.ObjectField(Stats)
+            items = psm.ListField(type_mapping=[psm.ObjectField(Stats)])
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        self.Stats = Stats
+        self.Player = Player
+
+    def test_reuses_nested(self):
+        player = psm.deserialize(self.Player, '{"name": "a", "stats": {"level": 1}, "items": [{"level": 2}, {"level": 3}], "tags": ["x"]}')
+        stats, items, first, tags = player.stats, player.items, player.items[0], player.tags
+        self.assertIs(player, psm.deserialize_into(player, '{"name": "b", "stats": {"level": 4}, "items": [{"level": 5}], "tags": ["y", "z"]}'))
+        self.assertIs(stats, player.stats)
+        self.assertIs(items, player.items)
+        self.assertIs(first, player.items[0])
+        self.assertIs(tags, player.tags)
+        self.assertEqual({'name': 'b', 'stats': {'level': 4}, 'items': [{'level': 5}], 'tags': ['y', 'z']}, json.loads(psm.serialize(player)))
+        psm.deserialize_into(player, '{"items": [{"level": 1}, {"level": 2}, {"level": 3}]}')
+        self.assertIs(first, player.items[0])
+        self.assertEqual({'items': [{'level': 1}, {'level': 2}, {'level': 3}]}, json.loads(psm.serialize(player)))
+
+    def test_absent_and_unknowns(self):
+        player = psm.deserialize(self.Player, '{"name": "a", "stats": {"level": 1}, "extra": 1}')
+        psm.deserialize_into(player, '{"name": "b", "other": 2}')
+        self.assertEqual({'name': 'b', 'other': 2}, player.__dict__)
+        self.assertEqual(psm.deserialize(self.Player, '{"name": "b", "other": 2}').__dict__, player.__dict__)
+
+    def test_shared_sub_objects_are_not_aliased(self):
+        stats = self.Stats(level=1)
+        player = self.Player(stats=stats, items=[stats])
+        psm.deserialize_into(player, '{"stats": {"level": 2}, "items": [{"level": 3}]}')
+        self.assertIsNot(player.stats, player.items[0])
+        self.assertEqual(2, player.stats.level)
+        self.assertEqual(3, player.items[0].level)
+
+    def test_errors(self):
+        player = self.Player()
+        with self.assertRaises(psm.ValidationError):
+            psm.deserialize_into(player, '{"stats": {"level": -1}}')
+        self.assertEqual(-1, player.stats.level)
+        with self.assertRaises(TypeError):
+            psm.deserialize_into({}, '{}')
+
+        class Frozen(psm.SchemaModel, frozen=True):
+            name = psm.StringField()
+
+        with self.assertRaises(AttributeError):
+            psm.deserialize_into(Frozen(name='a'), '{"name": "b"}')
+        with self.assertRaises(TypeError):
+            psm.ModelPool(Frozen)
+
+    def test_pooled_stream(self):
+        pool = psm.ModelPool(self.Player, maxsize=2)
+        lines = [json.dumps({'name': str(i), 'stats': {'level': i}}) for i in range(10)]
+        names = []
+        for player in psm.deserialize_stream(self.Player, lines, pool=pool):
+            names.append(player.name)
+            pool.release(player)
+            pool.release(player)
+        self.assertEqual([str(i) for i in range(10)], names)
+        self.assertEqual((1, 9, 1), (pool.created, pool.reused, len(pool)))
+        with self.assertRaises(TypeError):
+            pool.release(self.Stats())
+        with self.assertRaises(TypeError):
+            psm.deserialize_stream(self.Stats, lines, pool=pool)
+
+    def test_pooled_invalid(self):
+        pool = psm.ModelPool(self.Player)
+        lines = ['{"stats": {"level": -1}}', '{"stats": {"level": 1}}']
+        players = list(psm.deserialize_stream(self.Player, lines, skip_invalid=True, pool=pool))
+        self.assertEqual(1, len(players))
+        self.assertEqual(1, players[0].stats.level)
+        self.assertEqual((1, 1, 0), (pool.created, pool.reused, len(pool)))
+
+class Clone_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Point(psm.SchemaModel, frozen=True):
+            x = psm.IntegerField()
+
+        class Stats(psm.SchemaModel):
+            level = psm.IntegerField()
+
+        class Player(psm.SchemaModel, allow_unknowns=True):
+            name = psm.StringField()
+            stats = psm.ObjectField(Stats)
+            items = psm.ListField(type_mapping=[psm.ObjectField(Stats)])
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+            origin = psm.ObjectField(Point)
+
+        self.Point = Point
+        self.Stats = Stats
+        self.Player = Player
+
+    def test_copies_containers(self):
+        player = psm.deserialize(self.Player, '{"name": "a", "stats": {"level": 1}, "items": [{"level": 2}], "tags": ["x"], "origin": {"x": 1}, "meta": {"k": [1]}}')
+        copied = player.clone()
+        self.assertIs(type(player), type(copied))
+        self.assertEqual(psm.serialize(player), psm.serialize(copied))
+        self.assertIsNot(player.stats, copied.stats)
+        self.assertIsNot(player.items, copied.items)
+        self.assertIsNot(player.items[0], copied.items[0])
+        self.assertIsNot(player.tags, copied.tags)
+        self.assertIsNot(player.meta['k'], copied.meta['k'])
+        self.assertIs(player.origin, copied.origin)
+        self.assertIs(player.name, copied.name)
+        copied.stats.level = 5
+        copied.tags.append('y')
+        self.assertEqual(1, player.stats.level)
+        self.assertEqual(['x'], player.tags)
+        self.assertEqual({'name'}, set(self.Player(name='b').clone().__dict__))
+
+    def test_frozen(self):
+        point = self.Point(x=1)
+        self.assertIs(point, point.clone())
+
+    def test_shared_and_cycles(self):
+        stats = self.Stats(level=1)
+        player = self.Player(stats=stats, items=[stats, stats])
+        player.me = player
+        player.items.append(player.items)
+        copied = player.clone()
+        self.assertIs(copied, copied.me)
+        self.assertIs(copied.stats, copied.items[0])
+        self.assertIs(copied.stats, copied.items[1])
+        self.assertIsNot(stats, copied.stats)
+        self.assertIs(copied.items, copied.items[2])
+
+    def test_deep(self):
+        player = self.Player(tags=[])
+        inner = player.tags
+        for i in range(5000):
+            inner.append([])
+            inner = inner[0]
+        copied = player.clone()
+        inner = copied.tags
+        for i in range(5000):
+            self.assertEqual(1, len(inner))
+            inner = inner[0]
+        self.assertEqual([], inner)
+
+class Footprint_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Stats(psm.SchemaModel):
+            level = psm.IntegerField()
+
+        class Player(psm.SchemaModel, allow_unknowns=True):
+            name = psm.StringField()
+            stats = psm.ObjectField(Stats)
+            tags = psm.ListField(type_mapping=[psm.StringField()])
+
+        self.Stats = Stats
+        self.Player = Player
+
+    def test_breakdown(self):
+        player = self.Player(name='a' * 100, stats=self.Stats(level=1000), tags=['x' * 10, 'y' * 10], extra={'k': 2000})
+        footprint = psm.footprint(player)
+        self.assertEqual(sys.getsizeof(player) + sys.getsizeof(player.__dict__), footprint.by_class[self.Player])
+        self.assertEqual(sys.getsizeof(player.stats) + sys.getsizeof(player.stats.__dict__), footprint.by_class[self.Stats])
+        self.assertEqual(sys.getsizeof(player.name), footprint.by_field[(self.Player, 'name')])
+        self.assertEqual(sys.getsizeof(1000), footprint.by_field[(self.Stats, 'level')])
+        self.assertEqual(sys.getsizeof(player.tags) + 2 * sys.getsizeof('x' * 10), footprint.by_field[(self.Player, 'tags')])
+        self.assertEqual(sys.getsizeof(player.extra) + sys.getsizeof('k') + sys.getsizeof(2000), footprint.by_field[(self.Player, 'extra')])
+        self.assertEqual(sum(footprint.by_class.values()) + sum(footprint.by_field.values()), footprint.total)
+        self.assertEqual({self.Player: 1, self.Stats: 1}, footprint.counts)
+
+    def test_shared_counted_once(self):
+        name = 'n' * 100
+        stats = self.Stats(level=1000)
+        players = [self.Player(name=name, stats=stats) for i in range(3)]
+        players[0].me = players[0]
+        footprint = psm.footprint_many(self.Player, players)
+        self.assertEqual({self.Player: 3, self.Stats: 1}, footprint.counts)
+        self.assertEqual(sys.getsizeof(name), footprint.by_field[(self.Player, 'name')])
+        self.assertEqual(psm.footprint(players[1]).total * 3 - 2 * (sys.getsizeof(name) + sys.getsizeof(1000) + footprint.by_class[self.Stats]), footprint.total)
+
+    def test_frozen_state(self):
+        class Point(psm.SchemaModel, frozen=True):
+            x = psm.IntegerField()
+
+        point = Point(x=1)
+        before = psm.footprint(point).total
+        psm.serialize(point)
+        self.assertTrue(psm.footprint(point).total > before)
+
+    def test_errors(self):
+        with self.assertRaises(TypeError):
+            psm.footprint({})
+        with self.assertRaises(TypeError):
+            psm.footprint_many(self.Player, [self.Stats()])
+
+class ConstraintSet_tests(unittest.TestCase):
+
+    def test_membership(self):
+        for compact in (False, True):
+            constraints = psm.ConstraintSet([5, 1, 3, 3], ranges=[range(10, 20), range(15, 30), range(40, 40)], compact=compact)
+            self.assertEqual(compact, constraints._sorted is not None)
+            self.assertEqual(23, len(constraints))
+            for value in (1, 3, 5, 10, 29, 10.0, True):
+                self.assertIn(value, constraints)
+            for value in (0, 2, 9, 30, 40, 10.5, '1', None, [1]):
+                self.assertNotIn(value, constraints)
+            self.assertEqual([1, 3, 5] + list(range(10, 30)), sorted(constraints))
+        self.assertIn('a', psm.ConstraintSet(['a', 1]))
+        self.assertFalse(psm.ConstraintSet())
+        with self.assertRaises(TypeError):
+            psm.ConstraintSet(ranges=[range(0, 10, 2)])
+        with self.assertRaises(TypeError):
+            psm.ConstraintSet(ranges=[(0, 10)])
+
+    def test_fields(self):
+        tenants = psm.ConstraintSet(range(0, 200000, 2))
+        self.assertIsNotNone(tenants._sorted)
+
+        class Order(psm.SchemaModel):
+            tenant = psm.IntegerField(allowed=tenants, forbidden=[4])
+            code = psm.IntegerField(allowed=range(0, 10 ** 12))
+
+        class Refund(psm.SchemaModel):
+            tenant = psm.IntegerField(allowed=tenants)
+
+        self.assertIs(getattr(Order, '__schema')['tenant'].allowed, getattr(Refund, '__schema')['tenant'].allowed)
+        self.assertTrue(Order(tenant=2, code=10 ** 11).validate()[0])
+        self.assertFalse(Order(tenant=3).validate()[0])
+        self.assertFalse(Order(tenant=4).validate()[0])
+        self.assertFalse(Order(code=-1).validate()[0])
+        self.assertIsNot(psm.StringField().allowed, None)
+        self.assertFalse(psm.StringField().allowed)
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'ids.txt.gz')
+            with gzip.open(path, 'wt') as f:
+                f.write('# tenants\n1\n\n5..7\n20\n')
+            constraints = psm.load_constraint_set(path, kind=int)
+            self.assertEqual([1, 5, 6, 7, 20], sorted(constraints))
+            self.assertIs(constraints, psm.load_constraint_set(path, kind=int))
+            self.assertIsNot(constraints, psm.load_constraint_set(path))
+            self.assertEqual(['1', '5..7', '20'], list(psm.load_constraint_set(path)))
+
+    def test_generate(self):
+        class Order(psm.SchemaModel):
+            tenant = psm.IntegerField(required=True, allowed=range(100, 10 ** 5), _max=50000)
+            code = psm.IntegerField(required=True, forbidden=range(0, 10))
+
+        orders = psm.generate(Order, 50, seed=1)
+        self.assertTrue(all(100 <= order.tenant <= 50000 for order in orders))
+        self.assertTrue(all(order.validate()[0] for order in orders))
+
+class UnionField_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Click(psm.SchemaModel):
+            kind = psm.StringField(required=True)
+            x = psm.IntegerField(_min=0)
+
+        class Key(psm.SchemaModel):
+            kind = psm.StringField(required=True)
+            code = psm.StringField()
+
+        class Envelope(psm.SchemaModel):
+            event = psm.UnionField('kind', {'click': Click, 'key': Key})
+            history = psm.ListField(type_mapping=[psm.UnionField('kind', {'click': Click, 'key': Key})])
+
+        self.Click = Click
+        self.Key = Key
+        self.Envelope = Envelope
+
+    def test_deserialize(self):
+        line = '{"event": {"kind": "key", "code": "a"}, "history": [{"kind": "click", "x": 1}, {"kind": "key"}]}'
+        envelope = psm.deserialize(self.Envelope, line)
+        self.assertIs(self.Key, type(envelope.event))
+        self.assertEqual([self.Click, self.Key], [type(e) for e in envelope.history])
+        self.assertEqual(json.loads(line), json.loads(psm.serialize(envelope)))
+        self.assertEqual(2, len(psm.deserialize_many(self.Envelope, [line, line])))
+        self.assertEqual(3, len(psm.footprint(envelope).counts))
+
+    def test_limits(self):
+        shared_tags = psm.ListField(type_mapping=[psm.StringField()], max_length=1)
+
+        class Small(psm.SchemaModel):
+            kind = psm.IntegerField(required=True)
+            items = psm.ListField(type_mapping=[psm.IntegerField()], max_length=2)
+            tags = shared_tags
+
+        class Large(psm.SchemaModel):
+            kind = psm.IntegerField(required=True)
+            items = psm.ListField(type_mapping=[psm.IntegerField()], max_length=100)
+            tags = shared_tags
+
+        class Batch(psm.SchemaModel):
+            ev = psm.UnionField('kind', {1: Small, 2: Large})
+
+        def errors(payload):
+            with self.assertRaises(psm.ValidationError) as raised:
+                psm.deserialize(Batch, payload, limits=psm.Limits())
+            return raised.exception.errors
+
+        scanned = ['List Field "items" exceeded its maximum length: 2']
+        self.assertEqual(scanned, errors('{"ev": {"kind": 1, "items": [%s]}}' % ', '.join(['0'] * 100)))
+        self.assertEqual(scanned, errors('{"ev": {"kind" : 1.0, "items": [0, 0, 0]}}'))
+        self.assertEqual(50, len(psm.deserialize(Batch, '{"ev": {"kind": 2, "items": [%s]}}' % ', '.join(['0'] * 50), limits=psm.Limits()).ev.items))
+        # before the key is read only the fields the members share are typed
+        self.assertEqual(['List Field "tags" exceeded its maximum length: 1'], errors('{"ev": {"tags": ["a", "b"], "kind": 2}}'))
+        self.assertEqual(['List Field "items" exceeded its maximum length: 2, with length: 3'], errors('{"ev": {"items": [0, 0, 0], "kind": 1}}'))
+
+    def test_validation(self):
+        self.assertEqual((True, []), self.Envelope(event=self.Click(kind='click', x=1)).validate())
+        self.assertEqual((False, ['Value out of bounds: -1. Field "x" must be within bounds [{}, {}]'.format(0, psm._MAX_INT)]), self.Envelope(event=self.Click(kind='click', x=-1)).validate())
+        self.assertEqual((False, ['Field "event" holds a Click that its key "kind" does not select']), self.Envelope(event=self.Click(kind='key')).validate())
+        self.assertEqual((False, ['Field "event" must be of type: Click | Key']), self.Envelope(event={'kind': 'click'}).validate())
+        with self.assertRaises(psm.ValidationError) as raised:
+            psm.deserialize(self.Envelope, '{"event": {"kind": "drag"}}')
+        self.assertEqual(['Field "event" must be of type: Click | Key'], raised.exception.errors)
+        with self.assertRaises(psm.ValidationError):
+            psm.deserialize(self.Envelope, '{"event": {"kind": ["click"]}}')
+        with self.assertRaises(psm.ValidationError):
+            psm.deserialize(self.Envelope, '{"history": [{"kind": "click", "x": -1}]}')
+
+    def test_definition_errors(self):
+        with self.assertRaises(TypeError):
+            psm.UnionField('kind', [self.Click])
+        with self.assertRaises(ValueError):
+            psm.UnionField('kind', {})
+        with self.assertRaises(TypeError):
+            psm.UnionField('kind', {'a': dict})
+        with self.assertRaises(ValueError):
+            psm.UnionField('type', {'click': self.Click})
+
+    def test_iterative_and_refill(self):
+        line = '{"history": [' + ', '.join('{"kind": "click", "x": %d}' % i for i in range(3)) + ']}'
+        envelope = psm.deserialize(self.Envelope, line)
+        first = envelope.history[0]
+        psm.deserialize_into(envelope, '{"history": [{"kind": "click", "x": 7}, {"kind": "key"}]}')
+        self.assertIs(first, envelope.history[0])
+        self.assertEqual(7, first.x)
+        self.assertIs(self.Key, type(envelope.history[1]))
+        built = psm._build_iterative(self.Envelope, json.loads(line), self.Envelope())
+        self.assertEqual([self.Click] * 3, [type(e) for e in built.history])
+
+    def test_generate_and_patch(self):
+        for envelope in psm.generate(self.Envelope, 30, seed=3):
+            self.assertEqual((True, []), envelope.validate())
+            if hasattr(envelope, 'event'):
+                self.assertIs(psm.schema_plan(self.Envelope).fields['event'].mapping[envelope.event.kind], type(envelope.event))
+        old = self.Envelope(event=self.Click(kind='click', x=1))
+        new = self.Envelope(event=self.Key(kind='key', code='b'))
+        psm.apply_patch(old, psm.diff(old, new))
+        self.assertIs(self.Key, type(old.event))
+
+class DictField_tests(unittest.TestCase):
+
+    def setUp(self):
+        class Account(psm.SchemaModel):
+            name = psm.StringField()
+            balance = psm.IntegerField(_min=0)
+
+        class Ledger(psm.SchemaModel):
+            accounts = psm.DictField(psm.IntegerField(_min=0), psm.ObjectField(Account))
+            lazy_accounts = psm.DictField(psm.IntegerField(), psm.ObjectField(Account), lazy=True)
+            totals = psm.DictField(psm.StringField(), psm.IntegerField(), max_length=2)
+
+        self.Account = Account
+        self.Ledger = Ledger
+
+    def test_deserialize(self):
+        line = '{"accounts": {"1": {"name": "a", "balance": 5}, "-0": {"name": "b"}}, "totals": {"x": 1}}'
+        with self.assertRaises(psm.ValidationError) as raised:
+            psm.deserialize(self.Ledger, line)
+        self.assertEqual(["invalid key: '-0', expected: IntegerField for Field \"accounts\""], raised.exception.errors)
+        line = '{"accounts": {"1": {"name": "a", "balance": 5}, "20": {"name": "b"}}, "totals": {"x": 1}}'
+        ledger = psm.deserialize(self.Ledger, line)
+        self.assertEqual([1, 20], list(ledger.accounts))
+        self.assertIs(self.Account, type(ledger.accounts[20]))
+        self.assertEqual(json.loads(line), json.loads(psm.serialize(ledger)))
+        self.assertEqual(json.loads(line), json.loads(json.dumps(psm._encode_iterative(ledger, {}))))
+        built = psm._build_iterative(self.Ledger, json.loads(line), self.Ledger())
+        self.assertIs(self.Account, type(built.accounts[1]))
+
+    def test_validation(self):
+        self.assertEqual((True, []), self.Ledger(accounts={1: self.Account(balance=1)}).validate())
+        self.assertEqual((False, ['Field "accounts" must be a dict']), self.Ledger(accounts=[]).validate())
+        self.assertEqual((False, ['Value out of bounds: -1. Field "balance" must be within bounds [0, {}]'.format(psm._MAX_INT)]), self.Ledger(accounts={1: self.Account(balance=-1)}).validate())
+        self.assertEqual((False, ['Field "totals" must be a int', 'Dict Field "totals" exceeded its maximum length: 2, with length: 3']), self.Ledger(totals={'a': 1, 'b': 2, 'c': 'x'}).validate())
+        ledger = self.Ledger(accounts={1: self.Account(balance=-1), 2: {}})
+        self.assertEqual(ledger.validate(), psm._run_checks(psm._ModelCheck(ledger)))
+        with self.assertRaises(TypeError):
+            psm.DictField(psm.FloatField(), psm.IntegerField())
+        with self.assertRaises(TypeError):
+            psm.DictField(psm.StringField(), int)
+
+    def test_lazy(self):
+        payload = {str(i): {'name': str(i), 'balance': i} for i in range(100)}
+        payload['7'] = {'balance': -1}
+        ledger = psm.deserialize(self.Ledger, json.dumps({'lazy_accounts': payload}))
+        accounts = ledger.lazy_accounts
+        self.assertIs(psm.LazyDict, type(accounts))
+        self.assertEqual(100, len(accounts))
+        self.assertEqual(100, len(accounts._pending))
+        self.assertEqual(3, accounts[3].balance)
+        self.assertIs(accounts[3], accounts[3])
+        self.assertEqual(99, len(accounts._pending))
+        self.assertIn(50, accounts)
+        with self.assertRaises(psm.ValidationError):
+            accounts[7]
+        with self.assertRaises(KeyError):
+            accounts[1000]
+        accounts[7] = self.Account(balance=1)
+        del accounts[8]
+        self.assertEqual((True, []), ledger.validate())
+        payload['7'] = {'balance': 1}
+        del payload['8']
+        self.assertEqual(payload, json.loads(psm.serialize(ledger))['lazy_accounts'])
+        copied = ledger.clone()
+        self.assertEqual(97, len(copied.lazy_accounts._pending))
+        self.assertIsNot(accounts[3], copied.lazy_accounts[3])
+        self.assertEqual(payload, json.loads(psm.serialize(copy.deepcopy(ledger)))['lazy_accounts'])
+        self.assertTrue(psm.footprint(ledger).by_field[(self.Ledger, 'lazy_accounts')] > 0)
+
+    def test_generate_and_patch(self):
+        for ledger in psm.generate(self.Ledger, 20, seed=5):
+            self.assertEqual((True, []), ledger.validate())
+        for line in psm.generate(self.Ledger, 20, seed=5, json_lines=True):
+            psm.deserialize(self.Ledger, line)
+        old = self.Ledger(accounts={1: self.Account(balance=1)})
+        new = self.Ledger(accounts={1: self.Account(balance=2)})
+        psm.apply_patch(old, psm.diff(old, new))
+        self.assertEqual(2, old.accounts[1].balance)
+
 if __name__ == '__main__':
     unittest.main()